@@ -0,0 +1,104 @@
+"""
+Micro-benchmark of the parsing of the groums done by the groum index.
+
+Compares the parsing of the whole Acdfg (what the index did before)
+against the scan of the header fields used by the index
+(groum_index._parse_acdfg_header) on the groums of a graph directory (by
+default the ones shipped with the tests).
+
+The index scans the header only with the pure python implementation of
+protobuf, the benchmark always scans it. To compare the implementations
+run the benchmark with PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python and
+with PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=cpp.
+
+Usage:
+python benchmarks/bench_groum_scan.py [-g graphs_dir] [-r 20]
+"""
+
+import optparse
+import os
+import sys
+import time
+
+# run from the root of the repository without installing fixrsearch
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixrgraph.annotator.protobuf.proto_acdfg_pb2 import Acdfg
+import fixrsearch.groum_index
+from fixrsearch.groum_index import _parse_acdfg_header
+
+
+def load_groums(graph_path):
+  groums = []
+  for root, dirs, files in os.walk(graph_path):
+    for groum_file in files:
+      if groum_file.endswith(".acdfg.bin"):
+        with open(os.path.join(root, groum_file), "rb") as f:
+          groums.append(f.read())
+  return groums
+
+
+def get_implementation():
+  try:
+    from google.protobuf.internal import api_implementation
+    return api_implementation.Type()
+  except ImportError:
+    return "python"
+
+
+def parse_full(data):
+  acdfg = Acdfg()
+  acdfg.ParseFromString(data)
+  return acdfg
+
+
+def bench(parse, groums, repeat):
+  start = time.time()
+  for i in range(repeat):
+    for data in groums:
+      acdfg = parse(data)
+      [method_node.name for method_node in acdfg.method_node]
+      acdfg.repo_tag.commit_hash
+      acdfg.source_info.method_line_number
+  return time.time() - start
+
+
+def main():
+  p = optparse.OptionParser()
+  p.add_option('-g', '--graphs', help="Directory of the groums")
+  p.add_option('-r', '--repeat', type="int", default=20,
+               help="Number of times each groum is parsed")
+  opts, args = p.parse_args()
+
+  if opts.graphs:
+    graph_path = opts.graphs
+  else:
+    graph_path = os.path.join(os.path.dirname(__file__), os.pardir,
+                              "fixrsearch", "test", "data", "graphs")
+  groums = load_groums(graph_path)
+  fixrsearch.groum_index.SCAN_HEADER = True
+  if len(groums) == 0:
+    print("No groums in %s!" % graph_path)
+    sys.exit(1)
+
+  # check that the two parsers read the same header
+  for data in groums:
+    full = parse_full(data)
+    header = _parse_acdfg_header(data)
+    assert full.repo_tag == header.repo_tag
+    assert full.source_info == header.source_info
+    assert ([m.name for m in full.method_node] ==
+            [m.name for m in header.method_node])
+
+  size = sum([len(data) for data in groums])
+  print("%d groums, %.1f KB, %d repetitions (protobuf %s)" %
+        (len(groums), size / 1e3, opts.repeat, get_implementation()))
+  full_time = bench(parse_full, groums, opts.repeat)
+  header_time = bench(_parse_acdfg_header, groums, opts.repeat)
+  print("  full parse   %8.3fs" % full_time)
+  print("  header scan  %8.3fs" % header_time)
+  print("  speedup %.2fx" % (full_time / header_time))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,283 @@
+"""
+Micro-benchmark of the SetTrie used by the cluster index.
+
+Compares the current IndexNode (iterative, bisect on the children keys)
+against the previous recursive implementation (LegacyIndexNode below),
+on a clusters file (by default the one shipped with the tests) and on a
+synthetic clusters file.
+
+Usage:
+python benchmarks/bench_settrie.py [-c clusters.txt] [-n 100000]
+
+The legacy trie is quadratic to build on large files, by default it is
+skipped on more than 20000 clusters (-l -1 to always run it).
+
+With -M the benchmark only reports the memory used by the IndexNode
+trie built on the synthetic clusters (requires tracemalloc, python 3).
+"""
+
+import gc
+import optparse
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+# run from the root of the repository without installing fixrsearch
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fixrgraph.solr.patterns_utils import parse_clusters
+from fixrsearch.index import IndexNode
+
+
+class LegacyIndexNode(object):
+  """ Recursive SetTrie as implemented before the rewrite of IndexNode.
+
+  The only change is the integer division in _find_index.
+  """
+  def __init__(self, key):
+    self.key = key
+    self.children = []
+    self.clusters = []
+
+  def is_root(self):
+    return self.key < 0
+
+  @staticmethod
+  def _find_index(children, key):
+    found = False
+    low = 0
+    high = len(children) - 1
+    res = None
+    while (not found):
+      if low > high:
+        res = (low,high)
+        found = True
+        break
+      else:
+        idx = (low + high) // 2
+        if children[idx].key == key:
+          res = (idx,idx)
+          found = True
+        elif key < children[idx].key:
+          high = idx-1
+        else:
+          low = low + 1
+    return res
+
+  def _insert_rec(self, int_list, value, l, h):
+    if (l > h):
+      self.clusters.append(value)
+    else:
+      first_elem = int_list[l]
+      (i1,i2) = LegacyIndexNode._find_index(self.children, first_elem)
+
+      if i1 == i2:
+        index_elem = self.children[i1]
+        index_elem._insert_rec(int_list, value, l + 1, h)
+      else:
+        index_elem = LegacyIndexNode(first_elem)
+        self.children.insert(i1 + 1, index_elem)
+        index_elem._insert_rec(int_list, value, l + 1, h)
+
+  def insert(self, int_list, value):
+    self._insert_rec(int_list, value, 0, len(int_list) - 1)
+
+  def _get_all_supersets_rec(self, int_list, supersets, l, h, found):
+    if (l > h and found):
+      supersets.extend(self.clusters)
+      for c in self.children:
+        c._get_all_supersets_rec(int_list, supersets, l,h, found)
+    else:
+      match_current = ((not self.is_root() and self.key == int_list[l]) or
+                       (self.is_root()))
+      current_less_than = ((not self.is_root() and self.key <= int_list[l]) or
+                           (self.is_root()))
+      if (l == h and match_current):
+        self._get_all_supersets_rec(int_list, supersets, l+1, h, True)
+      elif match_current:
+        next_elem = int_list[l+1]
+        for child in self.children:
+          if child.key <= next_elem:
+            child._get_all_supersets_rec(int_list, supersets, l+1, h, False)
+      elif current_less_than:
+        current_elem = int_list[l]
+        for child in self.children:
+          if child.key <= current_elem:
+            child._get_all_supersets_rec(int_list, supersets, l, h, False)
+
+  def get_all_supersets(self, int_list):
+    supersets = []
+    self._get_all_supersets_rec(int_list, supersets,
+                                -1, len(int_list) - 1, False)
+    return supersets
+
+
+def write_synthetic_clusters(cluster_file, n_clusters, n_methods, seed):
+  """ Write a clusters file with n_clusters random clusters over a
+  vocabulary of n_methods method names.
+  """
+  rand = random.Random(seed)
+  with open(cluster_file, "w") as f:
+    for i in range(n_clusters):
+      size = rand.randint(2, 8)
+      methods = rand.sample(range(n_methods), size)
+      methods_str = ", ".join(["android.synthetic.C%d.m%d" % (m % 97, m)
+                               for m in methods])
+      f.write("I:  %s( %d )\n" % (methods_str, rand.randint(2, 100)))
+      f.write("E\n")
+
+
+def load_int_lists(cluster_file):
+  with open(cluster_file, "r") as cluster_stream:
+    cluster_infos = parse_clusters(cluster_stream)
+
+  m2i = {}
+  for ci in cluster_infos:
+    for m in ci.methods_list:
+      if m not in m2i:
+        m2i[m] = len(m2i)
+
+  int_lists = [sorted([m2i[m] for m in ci.methods_list])
+               for ci in cluster_infos]
+  return (int_lists, len(m2i))
+
+
+def get_queries(int_lists, n_methods, n_queries, k, seed):
+  """ Simulate the queries of ClusterIndex.get_clusters: a groum is a
+  random set of methods, and we look for the supersets of each subset of
+  size k.
+  """
+  rand = random.Random(seed)
+  queries = []
+  for i in range(n_queries):
+    # start from a cluster so that the query hits something
+    groum = set(rand.choice(int_lists))
+    groum.update(rand.sample(range(n_methods), min(n_methods, 4)))
+    for s in itertools.combinations(sorted(groum), k):
+      queries.append(list(s))
+  return queries
+
+
+def bench(node_class, int_lists, queries):
+  start = time.time()
+  root = node_class(-1)
+  for (i, int_list) in enumerate(int_lists):
+    root.insert(int_list, i)
+  build_time = time.time() - start
+
+  start = time.time()
+  results = [root.get_all_supersets(q) for q in queries]
+  query_time = time.time() - start
+
+  return (build_time, query_time, results)
+
+
+def measure_memory(int_lists):
+  """ Memory (in bytes) allocated to build the trie on int_lists """
+  import tracemalloc
+
+  gc.collect()
+  tracemalloc.start()
+  root = IndexNode(-1)
+  for (i, int_list) in enumerate(int_lists):
+    root.insert(int_list, i)
+  gc.collect()
+  (current, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return current
+
+
+def run(name, int_lists, n_methods, n_queries, k, legacy_max_clusters):
+  queries = get_queries(int_lists, n_methods, n_queries, k, 0)
+
+  print("%s: %d clusters, %d methods, %d superset queries" %
+        (name, len(int_lists), n_methods, len(queries)))
+
+  if legacy_max_clusters >= 0 and len(int_lists) > legacy_max_clusters:
+    # The legacy insert does not keep the children sorted and then
+    # duplicates them, the build is quadratic in the number of clusters
+    print("  LegacyIndexNode  skipped (more than %d clusters)" %
+          legacy_max_clusters)
+    node_classes = [IndexNode]
+  else:
+    node_classes = [LegacyIndexNode, IndexNode]
+
+  timings = []
+  all_results = []
+  for node_class in node_classes:
+    (build_time, query_time, results) = bench(node_class, int_lists, queries)
+    timings.append((build_time, query_time))
+    all_results.append(results)
+    print("  %-16s build %8.3fs  query %8.3fs" % (node_class.__name__,
+                                                 build_time,
+                                                 query_time))
+
+  if len(node_classes) == 2:
+    for (r_legacy, r_new) in zip(all_results[0], all_results[1]):
+      assert sorted(r_legacy) == sorted(r_new)
+
+    if timings[1][0] > 0:
+      print("  build speedup %.2fx" % (timings[0][0] / timings[1][0]))
+    if timings[1][1] > 0:
+      print("  query speedup %.2fx" % (timings[0][1] / timings[1][1]))
+
+
+def main():
+  p = optparse.OptionParser()
+  p.add_option('-c', '--clusters', help="Clusters file to benchmark")
+  p.add_option('-n', '--synthetic_clusters', type="int", default=100000,
+               help="Number of clusters in the synthetic file")
+  p.add_option('-m', '--synthetic_methods', type="int", default=2000,
+               help="Number of distinct methods in the synthetic file")
+  p.add_option('-q', '--queries', type="int", default=10,
+               help="Number of groums to search")
+  p.add_option('-k', '--min_methods_in_common', type="int", default=2,
+               help="Size of the subsets searched in the trie")
+  p.add_option('-l', '--legacy_max_clusters', type="int", default=20000,
+               help="Run the legacy trie only on files with at most this " \
+               "number of clusters (-1 for no limit)")
+  p.add_option('-M', '--memory', action="store_true", default=False,
+               help="Only measure the memory of the trie")
+  opts, args = p.parse_args()
+
+  if opts.clusters:
+    cluster_file = opts.clusters
+  else:
+    cluster_file = os.path.join(os.path.dirname(__file__), os.pardir,
+                                "fixrsearch", "test", "clusters.txt")
+  if not os.path.isfile(cluster_file):
+    print("Cluster file %s does not exist!" % cluster_file)
+    sys.exit(1)
+
+  if not opts.memory:
+    (int_lists, n_methods) = load_int_lists(cluster_file)
+    run(cluster_file, int_lists, n_methods, opts.queries,
+        opts.min_methods_in_common, opts.legacy_max_clusters)
+
+  (fd, synthetic_file) = tempfile.mkstemp(suffix=".txt", prefix="clusters")
+  os.close(fd)
+  try:
+    write_synthetic_clusters(synthetic_file, opts.synthetic_clusters,
+                             opts.synthetic_methods, 0)
+    (int_lists, n_methods) = load_int_lists(synthetic_file)
+  finally:
+    os.remove(synthetic_file)
+
+  if opts.memory:
+    memory = measure_memory(int_lists)
+    print("synthetic: %d clusters, trie of %.1f MB" % (len(int_lists),
+                                                      memory / 1e6))
+    return
+
+  # Also compare the legacy trie on a prefix of the synthetic clusters
+  sizes = [s for s in [10000, 20000] if s < len(int_lists)]
+  for size in sizes + [len(int_lists)]:
+    run("synthetic", int_lists[:size], n_methods, opts.queries,
+        opts.min_methods_in_common, opts.legacy_max_clusters)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,219 @@
+"""
+Size-bounded caches used by the indexes and the search.
+"""
+
+import collections
+import logging
+import os
+import tempfile
+import threading
+
+
+class LRUCache(object):
+  """
+  Least recently used cache.
+
+  The cache is bounded in the number of entries (max_entries) and/or in
+  the estimated size in bytes of the entries (max_bytes, the size of an
+  entry is given when it is inserted). A bound set to None is not
+  enforced.
+
+  The cache counts the hits, misses and evictions and it is thread safe.
+
+  If on_evict is not None, on_evict(key, value) is called (without
+  holding the lock of the cache) for each evicted entry.
+  """
+
+  def __init__(self, max_entries = None, max_bytes = None, on_evict = None):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.on_evict = on_evict
+
+    self._lock = threading.Lock()
+    # key -> (value, size), from the least to the most recently used
+    self._entries = collections.OrderedDict()
+    self.current_bytes = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key, default = None):
+    with self._lock:
+      if key in self._entries:
+        # move the entry at the end (most recently used)
+        entry = self._entries.pop(key)
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+      else:
+        self.misses += 1
+        return default
+
+  def put(self, key, value, size = 0):
+    with self._lock:
+      if key in self._entries:
+        (old_value, old_size) = self._entries.pop(key)
+        self.current_bytes -= old_size
+      self._entries[key] = (value, size)
+      self.current_bytes += size
+      evicted = self._evict()
+
+    if not self.on_evict is None:
+      for (evicted_key, evicted_value) in evicted:
+        self.on_evict(evicted_key, evicted_value)
+
+  def remove(self, key):
+    with self._lock:
+      if key in self._entries:
+        (value, size) = self._entries.pop(key)
+        self.current_bytes -= size
+
+  def remove_if(self, predicate):
+    """ Remove all the entries with a key satisfying predicate """
+    with self._lock:
+      for key in [k for k in self._entries if predicate(k)]:
+        (value, size) = self._entries.pop(key)
+        self.current_bytes -= size
+
+  def values(self):
+    """ List of the values in the cache (without updating their use) """
+    with self._lock:
+      return [value for (value, size) in self._entries.values()]
+
+  def copy(self):
+    """ Copy of the cache with the same entries (the values are shared)
+    and new counters
+    """
+    new_cache = LRUCache(self.max_entries, self.max_bytes, self.on_evict)
+    with self._lock:
+      new_cache._entries = collections.OrderedDict(self._entries)
+      new_cache.current_bytes = self.current_bytes
+    return new_cache
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.current_bytes = 0
+
+  def _is_full(self):
+    if len(self._entries) == 0:
+      return False
+    if (not self.max_entries is None and
+        len(self._entries) > self.max_entries):
+      return True
+    if (not self.max_bytes is None and
+        self.current_bytes > self.max_bytes):
+      return True
+    return False
+
+  def _evict(self):
+    """ Evict the least recently used entries, returns the list of
+    the evicted pairs (key, value)
+    """
+    evicted = []
+    while self._is_full():
+      (key, (value, size)) = self._entries.popitem(last=False)
+      self.current_bytes -= size
+      self.evictions += 1
+      evicted.append((key, value))
+    return evicted
+
+  def get_stats(self):
+    return {"entries" : len(self._entries),
+            "bytes" : self.current_bytes,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions}
+
+
+class DiskCache(object):
+  """
+  Least recently used cache of binary data stored in the files of
+  cache_dir, bounded in the total size of the files (max_bytes).
+
+  The keys are strings that can be used as file names (e.g., the hex
+  digest of the cached content). The cache is persistent: the files
+  already in cache_dir are loaded when the cache is created, from the
+  least to the most recently used (the modification time of a file is
+  updated when it is read).
+  """
+
+  def __init__(self, cache_dir, max_bytes = None):
+    self.cache_dir = cache_dir
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+    self._entries = LRUCache(max_bytes = max_bytes,
+                             on_evict = self._remove_file)
+
+    files = []
+    for name in os.listdir(cache_dir):
+      path = os.path.join(cache_dir, name)
+      if name.startswith(".") or not os.path.isfile(path):
+        continue
+      stat = os.stat(path)
+      files.append((stat.st_mtime, name, stat.st_size))
+    for (mtime, name, size) in sorted(files):
+      self._entries.put(name, True, size)
+    # the files loaded are not hits nor misses
+    self._entries.hits = 0
+    self._entries.misses = 0
+
+  def _get_path(self, key):
+    return os.path.join(self.cache_dir, key)
+
+  def _remove_file(self, key, value):
+    try:
+      os.remove(self._get_path(key))
+    except OSError:
+      pass
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def get(self, key):
+    """ Returns the data cached for key or None """
+    if self._entries.get(key) is None:
+      return None
+
+    path = self._get_path(key)
+    try:
+      with open(path, "rb") as f:
+        data = f.read()
+      os.utime(path, None)
+    except EnvironmentError as e:
+      logging.warning("Cannot read the cached file %s (%s)" % (path, str(e)))
+      self._entries.remove(key)
+      return None
+    return data
+
+  def put(self, key, data):
+    # write a temporary file and rename it: a reader never sees a
+    # partial file
+    (fd, tmp_file) = tempfile.mkstemp(prefix=".cache", dir=self.cache_dir)
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.write(data)
+      os.rename(tmp_file, self._get_path(key))
+    except:
+      if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+      raise
+    self._entries.put(key, True, len(data))
+
+  def remove(self, key):
+    self._entries.remove(key)
+    self._remove_file(key, True)
+
+  def get_stats(self):
+    return self._entries.get_stats()
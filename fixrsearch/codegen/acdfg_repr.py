@@ -1,6 +1,7 @@
 from fixrgraph.annotator.protobuf.proto_acdfg_pb2 import Acdfg as AcdfgProto
 from fixrgraph.annotator.protobuf.proto_search_pb2 import SearchResults
 from enum import Enum
+from fixrsearch.symbols import get_method_symbols
 
 class Node(object):
   def __init__(self, node_id):
@@ -21,7 +22,8 @@ class MethodNode(Node):
 
     self.assignee = assignee
     self.invokee = invokee
-    self.name = name
+    # the method names are shared with the indexes
+    self.name = get_method_symbols().canonical(name)
     self.arguments = [l for l in arguments]
 
   def __eq__(self, other):
@@ -0,0 +1,236 @@
+"""
+Watch the graph directory and update the groum index of a running
+service.
+
+The watcher polls the directories of the graph path: only the
+directories with a different modification time are listed again, and
+the groum files added, removed or changed in them are given to the
+incremental update of the index (GroumIndexBase.update_files).
+
+Adding or removing a file changes the modification time of its
+directory, while writing a file in place does not: the graphs should be
+written in a temporary file and then renamed in the graph path.
+"""
+
+import logging
+import os
+import threading
+import time
+
+# seconds between two polls of the graph directory
+WATCH_INTERVAL = 10
+
+# resolution of the modification times (in seconds): a file added in the
+# same tick as the last listing of its directory may not change the
+# modification time of the directory
+MTIME_RESOLUTION = 1.0
+
+
+class GraphWatcher(object):
+  """ Thread polling the graph directory of groum_index.
+
+  If lock is not None, the index is updated holding the lock (the
+  readers of the index should hold the same lock).
+
+  When created, the watcher first records the files existing in the
+  graph directory (the following polls find the changes from this
+  baseline), and then updates the index with the files changed since
+  the index was written. A file changed after the baseline is found by
+  the next poll, even if the update already indexed it (indexing a file
+  again is harmless).
+
+  The watcher counts the files indexed, the files indexed per second and
+  the index lag (see get_stats).
+  """
+
+  def __init__(self, groum_index, interval = WATCH_INTERVAL,
+               n_workers = 1, lock = None):
+    self.groum_index = groum_index
+    self.graph_path = groum_index.graph_path
+    self.interval = interval
+    self.n_workers = n_workers
+    self.lock = lock
+
+    # directory -> modification time
+    self._dir_mtimes = {}
+    # directory -> {groum file name -> (size, modification time)}
+    self._dir_files = {}
+
+    self._stop = threading.Event()
+    self._thread = None
+    self._stats_lock = threading.Lock()
+
+    self.polls = 0
+    self.files_indexed = 0
+    self.files_removed = 0
+    self.indexing_time = 0.0
+    # seconds between the change of a file and the end of its indexing
+    # (for the oldest file indexed by the last update)
+    self.last_lag = 0.0
+    self.max_lag = 0.0
+    self.errors = 0
+
+    # the files existing when the watcher is created are not changes,
+    # once the index is up to date with them
+    self.poll_changes()
+    (read, removed, touched) = self._update_index()
+    logging.info("Graph watcher: updated the index (%d files indexed, " \
+                 "%d removed)" % (read, removed))
+
+  def _update_index(self):
+    if self.lock is None:
+      return self.groum_index.update_index(self.n_workers)
+    with self.lock:
+      return self.groum_index.update_index(self.n_workers)
+
+  def start(self):
+    self._thread = threading.Thread(target = self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stop.set()
+    if not self._thread is None:
+      self._thread.join()
+      self._thread = None
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      try:
+        self.poll()
+      except Exception as e:
+        logging.error("Error watching %s (%s)" % (self.graph_path, str(e)))
+        with self._stats_lock:
+          self.errors += 1
+
+  def poll(self):
+    """ Find the changed groum files and update the index.
+
+    Returns the tuple of GroumIndexBase.update_files.
+    """
+    (changed, removed) = self.poll_changes()
+    with self._stats_lock:
+      self.polls += 1
+    if len(changed) == 0 and len(removed) == 0:
+      return (0, 0, 0)
+
+    # the oldest change not yet in the index
+    oldest_change = min([mtime for (groum_file, mtime) in changed] +
+                        [time.time()])
+    groum_files = [groum_file for (groum_file, mtime) in changed] + removed
+
+    start = time.time()
+    if self.lock is None:
+      res = self.groum_index.update_files(groum_files, self.n_workers)
+    else:
+      with self.lock:
+        res = self.groum_index.update_files(groum_files, self.n_workers)
+    end = time.time()
+
+    (read, n_removed, touched) = res
+    logging.info("Graph watcher: indexed %d files, removed %d files" %
+                 (read, n_removed))
+    with self._stats_lock:
+      self.files_indexed += read
+      self.files_removed += n_removed
+      self.indexing_time += end - start
+      self.last_lag = max(0.0, end - oldest_change)
+      self.max_lag = max(self.max_lag, self.last_lag)
+    return res
+
+  def poll_changes(self):
+    """ Find the groum files changed since the last poll.
+
+    Returns the pair (changed, removed), where changed is the list of
+    pairs (path, modification time) of the new or changed files and
+    removed is the list of the paths of the removed files.
+    """
+    changed = []
+    removed = []
+    for dir_path in list(self._dir_mtimes.keys()):
+      if not dir_path in self._dir_mtimes:
+        # removed while visiting its parent
+        continue
+      try:
+        mtime = os.stat(dir_path).st_mtime
+      except OSError:
+        self._remove_dir(dir_path, removed)
+        continue
+      if mtime != self._dir_mtimes[dir_path]:
+        self._scan_dir(dir_path, changed, removed)
+
+    if not self.graph_path in self._dir_mtimes:
+      self._scan_dir(self.graph_path, changed, removed)
+    return (changed, removed)
+
+  def _scan_dir(self, dir_path, changed, removed):
+    """ List dir_path (and its new subdirectories) """
+    try:
+      while True:
+        mtime = os.stat(dir_path).st_mtime
+        names = os.listdir(dir_path)
+        # list the directory again if it changed while listing it
+        if os.stat(dir_path).st_mtime == mtime:
+          break
+    except OSError:
+      self._remove_dir(dir_path, removed)
+      return
+    if time.time() - mtime < MTIME_RESOLUTION:
+      # a file added later in the same tick would not change the
+      # modification time: the directory is listed again at the next poll
+      self._dir_mtimes[dir_path] = None
+    else:
+      self._dir_mtimes[dir_path] = mtime
+
+    old_files = self._dir_files.get(dir_path, {})
+    new_files = {}
+    subdirs = set()
+    for name in names:
+      path = os.path.join(dir_path, name)
+      if name.endswith(".bin"):
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        new_files[name] = (stat.st_size, stat.st_mtime)
+        if old_files.get(name) != new_files[name]:
+          changed.append((path, stat.st_mtime))
+      elif os.path.isdir(path):
+        subdirs.add(path)
+        if not path in self._dir_mtimes:
+          self._scan_dir(path, changed, removed)
+
+    for name in old_files:
+      if not name in new_files:
+        removed.append(os.path.join(dir_path, name))
+    self._dir_files[dir_path] = new_files
+
+    # subdirectories removed (or replaced by files)
+    for other_dir in list(self._dir_mtimes.keys()):
+      if (other_dir != dir_path and
+          os.path.dirname(other_dir) == dir_path and
+          not other_dir in subdirs):
+        self._remove_dir(other_dir, removed)
+
+  def _remove_dir(self, dir_path, removed):
+    """ Forget dir_path and its subdirectories """
+    prefix = os.path.join(dir_path, "")
+    for other_dir in list(self._dir_mtimes.keys()):
+      if other_dir == dir_path or other_dir.startswith(prefix):
+        del self._dir_mtimes[other_dir]
+        for name in self._dir_files.pop(other_dir, {}):
+          removed.append(os.path.join(other_dir, name))
+
+  def get_stats(self):
+    with self._stats_lock:
+      if self.indexing_time > 0:
+        files_per_second = self.files_indexed / self.indexing_time
+      else:
+        files_per_second = 0.0
+      return {"polls" : self.polls,
+              "files_indexed" : self.files_indexed,
+              "files_removed" : self.files_removed,
+              "files_per_second" : files_per_second,
+              "last_lag" : self.last_lag,
+              "max_lag" : self.max_lag,
+              "errors" : self.errors}
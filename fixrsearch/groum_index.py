@@ -3,19 +3,50 @@ Keeps an index of apps and groums existing in the
 dataset.
 """
 
+import hashlib
 import json
 import logging
 import itertools
 import sys
 import os
+import multiprocessing
+import sqlite3
+import threading
+from array import array
+
+from google.protobuf.message import DecodeError
 
 from fixrgraph.annotator.protobuf.proto_acdfg_pb2 import Acdfg
+from fixrsearch.cache import LRUCache
+from fixrsearch.symbols import get_method_symbols
+
+# log the progress of the index creation every PROGRESS_STEP groums
+PROGRESS_STEP = 1000
+
+# number of shards kept in memory by ShardedGroumIndex
+SHARDS_IN_MEMORY = 100
 
 class GroumIndexBase(object):
     def __init__(self, graph_path):
         self.apps = []
         self.appid2groums = {}
         self.groumid2path = {}
+        # groum id -> sorted array of the ids of the methods in the groum
+        # (the ids are the ones of the method table of the process)
+        self.groumid2methods = {}
+        # method id -> set of the keys of the groums calling the method
+        # (None if the index of the methods is not built, see
+        # build_method_index)
+        self.method2groums = None
+        # groum id -> digest of the content of the groum
+        self.groumid2digest = {}
+        # digest -> set of the keys of the groums with the digest
+        self.digest2groums = {}
+        self.symbols = get_method_symbols()
+        # path of the groum file (relative to graph_path) ->
+        # [size, mtime, sha1 of the content, groum key (None if the
+        # groum is not in the index)]
+        self.manifest = {}
         self.graph_path = os.path.abspath(graph_path)
 
     @staticmethod
@@ -29,31 +60,148 @@ class GroumIndexBase(object):
         return self.apps
 
     def get_groums(self, app_id):
-        """ Get all groums with the app_id
-
-        TODO: transforms this in an iterator
-        """
+        """ Get all groums with the app_id (see iter_groums) """
         if app_id in self.appid2groums:
             return self.appid2groums[app_id]
         else:
             return []
 
     def get_all_groums(self):
-        """ Get all groums in the index.
+        """ Get all groums in the index (see iter_all_groums) """
+        return list(self.iter_all_groums())
 
-        TODO: transforms this in an iterator
+    def iter_apps(self, cursor = None):
+        """ Iterates over the apps in the index.
+
+        Yields the pairs (cursor, app): iter_apps(cursor) continues the
+        iteration after app. The cursor is an opaque string, None starts
+        from the first app.
+
+        Raises ValueError if the cursor is not valid.
         """
-        all_groums = []
-        for key, groums in self.appid2groums.iteritems():
-            all_groums += groums
-        return all_groums
+        return _iter_list(self.apps, _get_cursor_position(cursor))
+
+    def iter_groums(self, app_id, cursor = None):
+        """ Iterates over the groums with the app_id.
+
+        Yields the pairs (cursor, groum), as iter_apps.
+        """
+        return _iter_list(self.appid2groums.get(app_id, []),
+                          _get_cursor_position(cursor))
+
+    def iter_all_groums(self):
+        """ Iterates over all the groums in the index """
+        for app_key in list(self.appid2groums.keys()):
+            for (cursor, groum) in self.iter_groums(app_key):
+                yield groum
 
     def get_groum_path(self, groum_id):
-        if groum_id in self.groumid2path:
-            return os.path.join(self.graph_path, self.groumid2path[groum_id])
+        groum_rel_path = self._get_groum_rel_path(groum_id)
+        if not groum_rel_path is None:
+            return os.path.join(self.graph_path, groum_rel_path)
         else:
             return None
 
+    def _get_groum_rel_path(self, groum_id):
+        return self.groumid2path.get(groum_id)
+
+    def _get_n_groums(self):
+        return len(self.groumid2path)
+
+    def get_groum_methods(self, groum_id):
+        """ Get the names of the methods called in the groum """
+        if groum_id in self.groumid2methods:
+            return self.symbols.get_names(self.groumid2methods[groum_id])
+        else:
+            return []
+
+    def build_method_index(self):
+        """ Build the index from the methods to the groums calling them.
+
+        Once built, the index is kept up to date when adding and removing
+        groums.
+        """
+        self.method2groums = {}
+        for groum_key, method_ids in self.groumid2methods.items():
+            self._index_groum_methods(groum_key, method_ids)
+
+    def _index_groum_methods(self, groum_key, method_ids):
+        for method_id in method_ids:
+            groum_keys = self.method2groums.get(method_id)
+            if groum_keys is None:
+                groum_keys = set()
+                self.method2groums[method_id] = groum_keys
+            groum_keys.add(groum_key)
+
+    def _unindex_groum_methods(self, groum_key, method_ids):
+        for method_id in method_ids:
+            groum_keys = self.method2groums.get(method_id)
+            if not groum_keys is None:
+                groum_keys.discard(groum_key)
+                if len(groum_keys) == 0:
+                    del self.method2groums[method_id]
+
+    def _get_method_groums(self, method_name):
+        """ Set of the keys of the groums calling method_name """
+        method_id = self.symbols.get_id(method_name)
+        if method_id is None:
+            return set()
+        if not self.method2groums is None:
+            return self.method2groums.get(method_id, set())
+        # without the index of the methods, scan all the groums
+        return set([groum_key for groum_key, method_ids
+                    in self.groumid2methods.items()
+                    if method_id in method_ids])
+
+    def get_groums_with_any_method(self, method_names):
+        """ Keys of the groums calling at least one of the methods """
+        groum_keys = set()
+        for method_name in set(method_names):
+            groum_keys.update(self._get_method_groums(method_name))
+        return sorted(groum_keys)
+
+    def get_groums_with_all_methods(self, method_names):
+        """ Keys of the groums calling all the methods (no groums if
+        method_names is empty)
+        """
+        method_groums = sorted([self._get_method_groums(method_name)
+                                for method_name in set(method_names)],
+                               key=len)
+        if len(method_groums) == 0:
+            return []
+        groum_keys = set(method_groums[0])
+        for other_keys in method_groums[1:]:
+            groum_keys.intersection_update(other_keys)
+        return sorted(groum_keys)
+
+    def get_groum_digest(self, groum_id):
+        """ Digest of the content of the groum (see the module function
+        get_groum_digest(data)), None if the groum is not in the index.
+
+        The groums with the same digest have the same search results.
+        """
+        return self.groumid2digest.get(groum_id)
+
+    def get_groums_with_digest(self, digest):
+        """ Keys of the groums with the digest """
+        return sorted(self.digest2groums.get(digest, []))
+
+    def _index_groum_digest(self, groum_key, digest):
+        self.groumid2digest[groum_key] = digest
+        groum_keys = self.digest2groums.get(digest)
+        if groum_keys is None:
+            groum_keys = set()
+            self.digest2groums[digest] = groum_keys
+        groum_keys.add(groum_key)
+
+    def _unindex_groum_digest(self, groum_key):
+        digest = self.groumid2digest.pop(groum_key, None)
+        groum_keys = self.digest2groums.get(digest)
+        if not groum_keys is None:
+            groum_keys.discard(groum_key)
+            if len(groum_keys) == 0:
+                del self.digest2groums[digest]
+
     def get_groum_key(self, user_name, repo_name, commit_id,
                       method_name, line_number):
         key = "%s/%s/%s/%s/%s" % (user_name, repo_name, commit_id,
@@ -66,75 +214,16 @@ class GroumIndexBase(object):
         return key
 
     def process_groum(self, apps_set, groum_abs_path):
-        # Read the groum
-        acdfg = Acdfg()
-        with open(groum_abs_path,'rb') as fgroum:
-            acdfg.ParseFromString(fgroum.read())
-            method_list = []
-            for method_node in acdfg.method_node:
-                method_list.append(method_node.name)
-            fgroum.close()
-
-        # get repo data
-        if (not acdfg.HasField("repo_tag")):
-            # logging.info("No repo_tag...")
-            return
-        repoTag = acdfg.repo_tag
-
-        if (not (repoTag.HasField("user_name") and
-                 repoTag.HasField("repo_name") and
-                 repoTag.HasField("url") and
-                 repoTag.HasField("commit_hash"))):
-            # logging.info("No repo info...")
-            return
-
-
-        app_key = "%s/%s/%s" % (repoTag.user_name,
-                                repoTag.repo_name,
-                                repoTag.commit_hash)
-
-        repo = {
-            "app_key" : app_key,
-            "repo_name" : repoTag.repo_name,
-            "user_name" : repoTag.user_name,
-            "url" : repoTag.url,
-            "commit_hash" : repoTag.commit_hash}
-
-        # get acdfg data
-        if (not acdfg.HasField("source_info")):
-            # logging.info("No source_info...")
-            return
-        protoSource = acdfg.source_info
-
-        if (not (protoSource.HasField("package_name") and
-                 protoSource.HasField("class_name") and
-                 protoSource.HasField("method_name") and
-                 protoSource.HasField("class_line_number") and
-                 protoSource.HasField("method_line_number") and
-                 protoSource.HasField("source_class_name") and
-                 protoSource.HasField("abs_source_class_name"))):
-            # logging.info("No source info...")
-            return;
-
-        groum_key = "%s/%s.%s/%s" % (app_key,
-                                     protoSource.class_name,
-                                     protoSource.method_name,
-                                     protoSource.method_line_number)
-        groum_data = {
-            "groum_key" : groum_key,
-            "method_line_number": protoSource.method_line_number,
-            "package_name": protoSource.package_name,
-            "class_name": protoSource.class_name,
-            "source_class_name" : protoSource.source_class_name,
-            "method_name": protoSource.method_name,
-            "repo" : repo
-        }
-
-        # get the path of the file relative to self.graph_path
-        assert(groum_abs_path[:len(self.graph_path)] == self.graph_path)
-        groum_rel_path = groum_abs_path[len(self.graph_path)+1:]
-
-        # logging.info("Adding info...")
+        groum_file_record = read_groum_file(self.graph_path, groum_abs_path)
+        self._add_groum_file(apps_set, groum_file_record)
+
+    def _add_groum_record(self, apps_set, groum_record):
+        (repo, groum_data, groum_rel_path, method_list, digest) = groum_record
+        app_key = repo["app_key"]
+        groum_key = groum_data["groum_key"]
+
+        if not self._get_groum_rel_path(groum_key) is None:
+            self._remove_groum(apps_set, groum_key)
 
         # Set the data structure
         if app_key not in apps_set:
@@ -147,45 +236,571 @@ class GroumIndexBase(object):
             self.appid2groums[app_key].append(groum_data)
 
         self.groumid2path[groum_key] = groum_rel_path
+        method_ids = set([self.symbols.intern(m) for m in method_list])
+        self.groumid2methods[groum_key] = array('i', sorted(method_ids))
+        if not self.method2groums is None:
+            self._index_groum_methods(groum_key, method_ids)
+        self._index_groum_digest(groum_key, digest)
+
+    def _remove_groum(self, apps_set, groum_key):
+        """ Remove the groum from the index (and its app, if it was the
+        last groum of the app).
+        """
+        del self.groumid2path[groum_key]
+        method_ids = self.groumid2methods.pop(groum_key, [])
+        if not self.method2groums is None:
+            self._unindex_groum_methods(groum_key, method_ids)
+        self._unindex_groum_digest(groum_key)
 
+        # the groum key starts with the app key (user/repo/commit)
+        app_key = "/".join(groum_key.split("/")[:3])
+        if app_key in self.appid2groums:
+            groums = [groum_data for groum_data in self.appid2groums[app_key]
+                      if groum_data["groum_key"] != groum_key]
+            if len(groums) > 0:
+                self.appid2groums[app_key] = groums
+            else:
+                del self.appid2groums[app_key]
+                self.apps = [repo for repo in self.apps
+                             if repo["app_key"] != app_key]
+                apps_set.discard(app_key)
 
-    def build_index(self):
-        logging.info("Creating graph index...")
+    def _get_apps_set(self):
+        return set([repo["app_key"] for repo in self.get_apps()])
+
+    def _get_manifest_entry(self, groum_rel_path):
+        return self.manifest.get(groum_rel_path)
+
+    def _set_manifest_entry(self, groum_rel_path, entry):
+        self.manifest[groum_rel_path] = entry
+
+    def _pop_manifest_entry(self, groum_rel_path):
+        return self.manifest.pop(groum_rel_path)
+
+    def _get_manifest_paths(self):
+        return list(self.manifest.keys())
+
+    def _add_groum_file(self, apps_set, groum_file_record):
+        (groum_rel_path, file_info, groum_record) = groum_file_record
+        if not self._get_manifest_entry(groum_rel_path) is None:
+            self._remove_groum_file(apps_set, groum_rel_path)
+        groum_key = None
+        if not groum_record is None:
+            self._add_groum_record(apps_set, groum_record)
+            groum_key = groum_record[1]["groum_key"]
+        self._set_manifest_entry(groum_rel_path,
+                                 list(file_info) + [groum_key])
+
+    def _remove_groum_file(self, apps_set, groum_rel_path):
+        entry = self._pop_manifest_entry(groum_rel_path)
+        groum_key = entry[3]
+        # the groum key may now be the one of another file
+        if (not groum_key is None and
+            self._get_groum_rel_path(groum_key) == groum_rel_path):
+            self._remove_groum(apps_set, groum_key)
+
+    def _read_groum_files(self, groum_files, n_workers, progress_step):
+        """ Read the groum files (with n_workers processes) and add them
+        to the index.
+        """
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+
+        tot_groums = len(groum_files)
+        jobs = [(self.graph_path, groum_file) for groum_file in groum_files]
+
+        pool = None
+        if n_workers > 1 and tot_groums > 1:
+            pool = multiprocessing.Pool(n_workers)
+            # imap returns the records in the order of groum_files
+            chunksize = max(1, min(100, tot_groums // (4 * n_workers)))
+            groum_file_records = pool.imap(_read_groum_file_job, jobs,
+                                           chunksize)
+        else:
+            groum_file_records = (_read_groum_file_job(job) for job in jobs)
+
+        apps_set = self._get_apps_set()
+        try:
+            for (count, groum_file_record) in enumerate(groum_file_records, 1):
+                self._add_groum_file(apps_set, groum_file_record)
+                if count % progress_step == 0 or count == tot_groums:
+                    logging.info("Indexed %d/%d graphs" % (count, tot_groums))
+        finally:
+            if not pool is None:
+                pool.close()
+                pool.join()
 
-        apps_set = set()
+    def _get_groum_files(self):
+        """ All the groum files, sorted so that the index does not
+        depend on the order of the files in the file system.
+        """
+        groum_files = []
         for root, subFolder, files in os.walk(self.graph_path):
             for item in files:
                 if item.endswith(".bin") :
                     full_file_name = os.path.join(root,item)
                     full_file_name = os.path.abspath(full_file_name)
-                    self.process_groum(apps_set, full_file_name)
+                    groum_files.append(full_file_name)
+        groum_files.sort()
+        return groum_files
+
+    def build_index(self, n_workers = 1,
+                    progress_step = PROGRESS_STEP):
+        """ Build the index reading all the groums in self.graph_path.
+
+        - n_workers: number of processes reading the groums (None for
+          one process for each cpu). The index is the same for any
+          number of workers.
+        - progress_step: log the progress every progress_step groums
+        """
+        logging.info("Creating graph index...")
+
+        self._read_groum_files(self._get_groum_files(), n_workers,
+                               progress_step)
 
         logging.info("Index created - stats:\n" \
                      "\tNumber of repos: %d\n" \
-                     "\tNumber of graphs: %d\n" % (len(self.apps),
-                                                   len(self.groumid2path)))
+                     "\tNumber of graphs: %d\n" % (len(self.get_apps()),
+                                                   self._get_n_groums()))
+
+    def update_index(self, n_workers = 1,
+                     progress_step = PROGRESS_STEP):
+        """ Update the index with the groum files added, changed or
+        removed since the index was built.
+
+        Only the new files and the files with a different content (the
+        size or the modification time are different, and then the hash
+        is different) are read.
+
+        Returns the tuple (number of groum files read, number of groum
+        files removed, number of groum files with only a different
+        modification time).
+        """
+        logging.info("Updating graph index...")
+
+        groum_files = self._get_groum_files()
+        current_files = set([_get_rel_path(self.graph_path, groum_file)
+                             for groum_file in groum_files])
+        removed = [groum_rel_path
+                   for groum_rel_path in self._get_manifest_paths()
+                   if not groum_rel_path in current_files]
+        return self._update_groum_files(groum_files, removed,
+                                        n_workers, progress_step)
+
+    def update_files(self, groum_files, n_workers = 1,
+                     progress_step = PROGRESS_STEP):
+        """ Update the index only for the groum_files (absolute paths),
+        for example the files found by a watcher of graph_path.
+
+        The files that do not exist anymore are removed from the index,
+        the others are read if they are new or changed (see update_index).
+
+        Returns the same tuple of update_index.
+        """
+        existing = set()
+        removed = set()
+        for groum_file in groum_files:
+            groum_file = os.path.abspath(groum_file)
+            if os.path.isfile(groum_file):
+                existing.add(groum_file)
+            else:
+                groum_rel_path = _get_rel_path(self.graph_path, groum_file)
+                if not self._get_manifest_entry(groum_rel_path) is None:
+                    removed.add(groum_rel_path)
+        return self._update_groum_files(sorted(existing), sorted(removed),
+                                        n_workers, progress_step)
+
+    def _update_groum_files(self, groum_files, removed,
+                            n_workers, progress_step):
+        """ Read the new or changed groum_files and remove the removed
+        files (relative paths) from the index.
+        """
+        apps_set = self._get_apps_set()
+        to_read = []
+        touched = 0
+        for groum_file in groum_files:
+            groum_rel_path = _get_rel_path(self.graph_path, groum_file)
+
+            entry = self._get_manifest_entry(groum_rel_path)
+            if entry is None:
+                to_read.append(groum_file)
+                continue
+
+            stat = os.stat(groum_file)
+            if entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+                continue
+            if (entry[0] == stat.st_size and
+                entry[2] == _get_file_hash(groum_file)):
+                # same content
+                entry[1] = stat.st_mtime
+                self._set_manifest_entry(groum_rel_path, entry)
+                touched += 1
+                continue
+
+            self._remove_groum_file(apps_set, groum_rel_path)
+            to_read.append(groum_file)
+
+        for groum_rel_path in removed:
+            self._remove_groum_file(apps_set, groum_rel_path)
+
+        self._read_groum_files(to_read, n_workers, progress_step)
+
+        logging.info("Index updated - read %d graphs, removed %d graphs" %
+                     (len(to_read), len(removed)))
+        return (len(to_read), len(removed), touched)
+
+
+def _get_cursor_position(cursor):
+    """ Position encoded in the cursor of the iterators of the index """
+    if cursor is None:
+        return 0
+    position = int(cursor)
+    if position < 0:
+        raise ValueError("Invalid cursor %s" % cursor)
+    return position
+
+
+def _iter_list(items, position):
+    """ Iterates over items from position, the cursor of an item is the
+    position of the next item.
+
+    The length of the list is read at each step, so the iteration sees
+    the items appended while iterating.
+    """
+    while position < len(items):
+        item = items[position]
+        position += 1
+        yield (str(position), item)
+
+
+def _list_dirs(path):
+    """ Sorted names of the (not hidden) directories in path """
+    return sorted([name for name in os.listdir(path)
+                   if (not name.startswith(".") and
+                       os.path.isdir(os.path.join(path, name)))])
+
+
+def _get_rel_path(graph_path, groum_abs_path):
+    """ Path of the groum relative to graph_path """
+    assert(groum_abs_path[:len(graph_path)] == graph_path)
+    return groum_abs_path[len(graph_path)+1:]
+
+
+def _get_file_hash(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_groum_record(graph_path, groum_abs_path):
+    """ Read the data of the groum stored in the index.
+
+    Returns the tuple (repo, groum_data, groum_rel_path, method_list,
+    digest), or None if the groum does not have the repository or source
+    data (digest is the result of get_groum_digest).
+    """
+    with open(groum_abs_path,'rb') as fgroum:
+        data = fgroum.read()
+        fgroum.close()
+    return _parse_groum_record(graph_path, groum_abs_path, data)
+
+
+def read_groum_file(graph_path, groum_abs_path):
+    """ Read the groum file.
+
+    Returns the tuple (groum_rel_path, file_info, groum_record), where
+    file_info is (size, mtime, sha1 of the content) and groum_record is
+    the result of read_groum_record.
+    """
+    stat = os.stat(groum_abs_path)
+    with open(groum_abs_path,'rb') as fgroum:
+        data = fgroum.read()
+        fgroum.close()
+    file_info = (stat.st_size, stat.st_mtime,
+                 hashlib.sha1(data).hexdigest())
+    groum_record = _parse_groum_record(graph_path, groum_abs_path, data)
+    return (_get_rel_path(graph_path, groum_abs_path), file_info,
+            groum_record)
+
+
+# Fields of the Acdfg read when indexing a groum
+HEADER_FIELDS = ["method_node", "repo_tag", "source_info"]
+
+# Fields of the Acdfg not in the digest of the groum: the same method in
+# different commits of a repo only differs in the repo tag
+DIGEST_EXCLUDED_FIELDS = ["repo_tag"]
+
+# names of the fields -> numbers of the fields
+_field_numbers = {}
+
+try:
+    from google.protobuf.internal import api_implementation
+    SCAN_HEADER = api_implementation.Type() == "python"
+except ImportError:
+    SCAN_HEADER = True
+
+def _get_field_numbers(field_names):
+    """ Numbers of the fields of the Acdfg in field_names """
+    key = tuple(field_names)
+    numbers = _field_numbers.get(key)
+    if numbers is None:
+        fields = Acdfg.DESCRIPTOR.fields_by_name
+        numbers = frozenset([fields[name].number for name in field_names])
+        _field_numbers[key] = numbers
+    return numbers
+
+
+def _scan_header(data):
+    """ Extract the header fields from the serialized Acdfg.
+
+    The scan reads only the tag of the top-level fields of the message
+    and skips the other fields (the nodes and the edges, that are most of
+    the groum) using their length, without decoding them.
+
+    Returns the serialized message that contains only the header fields,
+    or None if data is not a well formed message.
+    """
+    return _filter_fields(data, _get_field_numbers(HEADER_FIELDS), True)
+
+
+def get_groum_digest(data):
+    """ Digest of the content of the serialized Acdfg.
+
+    The digest does not include the fields in DIGEST_EXCLUDED_FIELDS, so
+    the groums of a method that did not change in different commits
+    have the same digest.
+    """
+    content = _filter_fields(data,
+                             _get_field_numbers(DIGEST_EXCLUDED_FIELDS),
+                             False)
+    if content is None:
+        content = data
+    return hashlib.sha1(content).hexdigest()
+
+
+def _filter_fields(data, field_numbers, keep):
+    """ Filter the top-level fields of the serialized message data.
+
+    Returns the serialized message with only the fields in field_numbers
+    (if keep is True) or without them (if keep is False), or None if data
+    is not a well formed message.
+    """
+    buf = bytearray(data)
+    size = len(buf)
+    chunks = []
+    pos = 0
+    while pos < size:
+        start = pos
+        (tag, pos) = _read_varint(buf, pos, size)
+        if pos < 0:
+            return None
+        wire_type = tag & 0x7
+        if wire_type == 0:
+            (value, pos) = _read_varint(buf, pos, size)
+            if pos < 0:
+                return None
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            (length, pos) = _read_varint(buf, pos, size)
+            if pos < 0:
+                return None
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            # groups are not used in the acdfg
+            return None
+        if pos > size:
+            return None
+
+        if ((tag >> 3) in field_numbers) == keep:
+            chunks.append(data[start:pos])
+    return b"".join(chunks)
+
+
+def _read_varint(buf, pos, size):
+    """ Read the varint at pos, returns (value, next position) or
+    (0, -1) if the varint is truncated.
+    """
+    value = 0
+    shift = 0
+    while pos < size:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, pos)
+        shift += 7
+    return (0, -1)
+
+
+def _parse_acdfg_header(data):
+    """ Parse the header fields of the Acdfg, or the whole message if
+    the header cannot be extracted.
+
+    The scan is done only with the pure python implementation of
+    protobuf: the C++ implementation parses the whole message faster
+    than the scan in python.
+    """
+    acdfg = Acdfg()
+    if not SCAN_HEADER:
+        acdfg.ParseFromString(data)
+        return acdfg
+
+    header = _scan_header(data)
+    if header is not None:
+        try:
+            acdfg.ParseFromString(header)
+            return acdfg
+        except DecodeError:
+            acdfg = Acdfg()
+    acdfg.ParseFromString(data)
+    return acdfg
+
+
+def _parse_groum_record(graph_path, groum_abs_path, data):
+    # Read the groum (only the fields used in the index)
+    acdfg = _parse_acdfg_header(data)
+    method_list = []
+    for method_node in acdfg.method_node:
+        method_list.append(method_node.name)
+
+    # get repo data
+    if (not acdfg.HasField("repo_tag")):
+        # logging.info("No repo_tag...")
+        return None
+    repoTag = acdfg.repo_tag
+
+    if (not (repoTag.HasField("user_name") and
+             repoTag.HasField("repo_name") and
+             repoTag.HasField("url") and
+             repoTag.HasField("commit_hash"))):
+        # logging.info("No repo info...")
+        return None
+
+
+    app_key = "%s/%s/%s" % (repoTag.user_name,
+                            repoTag.repo_name,
+                            repoTag.commit_hash)
 
+    repo = {
+        "app_key" : app_key,
+        "repo_name" : repoTag.repo_name,
+        "user_name" : repoTag.user_name,
+        "url" : repoTag.url,
+        "commit_hash" : repoTag.commit_hash}
+
+    # get acdfg data
+    if (not acdfg.HasField("source_info")):
+        # logging.info("No source_info...")
+        return None
+    protoSource = acdfg.source_info
+
+    if (not (protoSource.HasField("package_name") and
+             protoSource.HasField("class_name") and
+             protoSource.HasField("method_name") and
+             protoSource.HasField("class_line_number") and
+             protoSource.HasField("method_line_number") and
+             protoSource.HasField("source_class_name") and
+             protoSource.HasField("abs_source_class_name"))):
+        # logging.info("No source info...")
+        return None
+
+    groum_key = "%s/%s.%s/%s" % (app_key,
+                                 protoSource.class_name,
+                                 protoSource.method_name,
+                                 protoSource.method_line_number)
+    groum_data = {
+        "groum_key" : groum_key,
+        "method_line_number": protoSource.method_line_number,
+        "package_name": protoSource.package_name,
+        "class_name": protoSource.class_name,
+        "source_class_name" : protoSource.source_class_name,
+        "method_name": protoSource.method_name,
+        "repo" : repo
+    }
+
+    # get the path of the file relative to graph_path
+    groum_rel_path = _get_rel_path(graph_path, groum_abs_path)
+
+    return (repo, groum_data, groum_rel_path, method_list,
+            get_groum_digest(data))
+
+
+def _read_groum_file_job(args):
+    """ Job of the workers that read the groums """
+    (graph_path, groum_abs_path) = args
+    return read_groum_file(graph_path, groum_abs_path)
 
 
 class GroumIndex(GroumIndexBase):
     """
     Serializable version of the groum index
+
+    n_workers is the number of processes used to build the index (see
+    GroumIndexBase.build_index).
+
+    If method_index is True, the index also keeps (and stores in the
+    index file) the groums calling each method (see build_method_index).
     """
-    def __init__(self, graph_path):
+    def __init__(self, graph_path, n_workers = 1, method_index = False):
         super(GroumIndex, self).__init__(graph_path)
+        if method_index:
+            self.method2groums = {}
 
         self.index_file_name = os.path.join(self.graph_path, "graph_index.json")
         if (os.path.exists(self.index_file_name)):
             self.load_index(self.index_file_name)
         else:
-            self.build_index()
+            self.build_index(n_workers)
+            self.write_index(self.index_file_name)
+
+    def update_index(self, n_workers = 1,
+                     progress_step = PROGRESS_STEP):
+        """ Update the index and write it, only if it changed """
+        res = super(GroumIndex, self).update_index(n_workers, progress_step)
+        self._write_if_changed(res)
+        return res
+
+    def update_files(self, groum_files, n_workers = 1,
+                     progress_step = PROGRESS_STEP):
+        """ Update the index and write it, only if it changed """
+        res = super(GroumIndex, self).update_files(groum_files, n_workers,
+                                                   progress_step)
+        self._write_if_changed(res)
+        return res
+
+    def _write_if_changed(self, update_result):
+        (read, removed, touched) = update_result
+        if read > 0 or removed > 0 or touched > 0:
             self.write_index(self.index_file_name)
 
     def write_index(self, index_file_name):
         logging.info("Writing index...")
+        # store the method ids with the names they have in the index file
+        method_ids = set()
+        for groum_method_ids in self.groumid2methods.values():
+            method_ids.update(groum_method_ids)
+        method_ids = sorted(method_ids)
+        id2local = {}
+        for method_id in method_ids:
+            id2local[method_id] = len(id2local)
+        groumid2methods = {}
+        for groum_id, groum_method_ids in self.groumid2methods.items():
+            groumid2methods[groum_id] = [id2local[m] for m in groum_method_ids]
+
         index_data = {"apps" : self.apps,
                       "appid2groums" : self.appid2groums,
-                      "groumid2path" : self.groumid2path}
+                      "groumid2path" : self.groumid2path,
+                      "methods" : self.symbols.get_names(method_ids),
+                      "groumid2methods" : groumid2methods,
+                      "groumid2digest" : self.groumid2digest,
+                      "manifest" : self.manifest}
+        if not self.method2groums is None:
+            method2groums = {}
+            for method_id, groum_keys in self.method2groums.items():
+                method2groums[id2local[method_id]] = sorted(groum_keys)
+            index_data["method2groums"] = method2groums
         with open(index_file_name, "w") as index_file:
             json.dump(index_data, index_file)
             index_file.close()
@@ -201,3 +816,673 @@ class GroumIndex(GroumIndexBase):
         self.apps = index_data["apps"]
         self.appid2groums = index_data["appid2groums"]
         self.groumid2path = index_data["groumid2path"]
+
+        # index files written before storing the manifest do not have it
+        # (update_index reads all the groum files again)
+        self.manifest = index_data.get("manifest", {})
+
+        # index files written before storing the methods do not have them
+        self.groumid2methods = {}
+        if "methods" in index_data and "groumid2methods" in index_data:
+            remap = self.symbols.get_remap(index_data["methods"])
+            for groum_id, local_ids in index_data["groumid2methods"].items():
+                method_ids = sorted([remap[m] for m in local_ids])
+                self.groumid2methods[groum_id] = array('i', method_ids)
+
+        # index files written before storing the digests do not have them
+        # (get_groum_digest returns None for these groums)
+        self.groumid2digest = {}
+        self.digest2groums = {}
+        for groum_id, digest in index_data.get("groumid2digest", {}).items():
+            self._index_groum_digest(groum_id, digest)
+
+        if not self.method2groums is None:
+            if "methods" in index_data and "method2groums" in index_data:
+                self.method2groums = {}
+                for local_id, groum_keys in index_data["method2groums"].items():
+                    method_id = remap[int(local_id)]
+                    self.method2groums[method_id] = set(groum_keys)
+            else:
+                # the index file was written without the method index
+                self.build_method_index()
+
+
+class _ShardLoading(object):
+    """ Shard that is being loaded (or built) in the background """
+    def __init__(self):
+        self.event = threading.Event()
+        self.shard = None
+
+
+class ShardedGroumIndex(GroumIndexBase):
+    """
+    Groum index split in a shard for each app.
+
+    The groums of an app are in the directory user/repo/commit of
+    graph_path. The shard of the app is a GroumIndex of the directory,
+    stored in the graph_index.json file of the directory.
+
+    The shards are loaded only when a query needs them, and at most
+    max_shards shards are kept in memory (the least recently used ones
+    are dropped). A shard that is not in memory is loaded, or built if it
+    does not exist, in the background: the queries wait for it, while
+    prefetch only starts loading the shards.
+
+    The apps of each shard are also stored in the graph_apps.json file
+    of graph_path, with the mtime of the index file of the shard, so
+    get_apps and iter_apps only load the shards that changed. The other
+    queries that are not on a single app (get_all_groums,
+    get_groums_with_any_method, ...) load all the shards.
+    """
+    def __init__(self, graph_path, max_shards = SHARDS_IN_MEMORY,
+                 n_workers = 1, method_index = False):
+        super(ShardedGroumIndex, self).__init__(graph_path)
+        self.n_workers = n_workers
+        self.method_index = method_index
+        # app key -> GroumIndex of the app
+        self.shards = LRUCache(max_entries = max_shards)
+        self._lock = threading.Lock()
+        # app key -> _ShardLoading
+        self._loading = {}
+        # app key -> [mtime of the index file of the shard, apps of the
+        # shard]
+        self.apps_file_name = os.path.join(self.graph_path, "graph_apps.json")
+        self.app_manifest = {}
+        self._app_manifest_changed = False
+        if os.path.exists(self.apps_file_name):
+            with open(self.apps_file_name, "r") as apps_file:
+                self.app_manifest = json.load(apps_file)
+
+    def get_app_keys(self):
+        """ Keys of the apps in graph_path (the directories
+        user/repo/commit)
+        """
+        app_keys = []
+        for user_name in _list_dirs(self.graph_path):
+            user_path = os.path.join(self.graph_path, user_name)
+            for repo_name in _list_dirs(user_path):
+                repo_path = os.path.join(user_path, repo_name)
+                for commit_id in _list_dirs(repo_path):
+                    app_keys.append(GroumIndexBase.get_app_key(user_name,
+                                                               repo_name,
+                                                               commit_id))
+        return app_keys
+
+    def _get_app_path(self, app_key):
+        """ Directory of the app, None if the app does not exist """
+        parts = app_key.split("/")
+        if (len(parts) != 3 or
+            any([part in ["", os.curdir, os.pardir] for part in parts])):
+            return None
+        app_path = os.path.join(self.graph_path, *parts)
+        return app_path if os.path.isdir(app_path) else None
+
+    def get_shard(self, app_key, wait = True):
+        """ Get the shard of the app (None if the app does not exist).
+
+        If the shard is not in memory, it is loaded in the background. If
+        wait is False, returns None instead of waiting for the shard.
+        """
+        shard = self.shards.get(app_key)
+        if not shard is None:
+            return shard
+
+        app_path = self._get_app_path(app_key)
+        if app_path is None:
+            return None
+
+        with self._lock:
+            # the shard may have been loaded after the first lookup (the
+            # loading thread adds it before releasing the loading state)
+            shard = self.shards.get(app_key)
+            if not shard is None:
+                return shard
+            loading = self._loading.get(app_key)
+            if loading is None:
+                loading = _ShardLoading()
+                self._loading[app_key] = loading
+                thread = threading.Thread(target = self._load_shard,
+                                          args = (app_key, app_path, loading))
+                thread.daemon = True
+                thread.start()
+
+        if not wait:
+            return None
+        loading.event.wait()
+        return loading.shard
+
+    def prefetch(self, app_keys):
+        """ Start loading the shards of the apps """
+        for app_key in app_keys:
+            self.get_shard(app_key, wait = False)
+
+    def _load_shard(self, app_key, app_path, loading):
+        try:
+            if not os.path.exists(os.path.join(app_path, "graph_index.json")):
+                logging.info("Building the shard of %s..." % app_key)
+            shard = GroumIndex(app_path, self.n_workers, self.method_index)
+            if self.method_index and shard.method2groums is None:
+                # build_method_index was called while loading the shard
+                shard.build_method_index()
+                shard.write_index(shard.index_file_name)
+            self.shards.put(app_key, shard)
+            self._set_shard_apps(app_key, shard)
+            loading.shard = shard
+        except Exception as e:
+            logging.error("Cannot load the shard of %s (%s)" % (app_key,
+                                                                str(e)))
+        finally:
+            with self._lock:
+                del self._loading[app_key]
+            loading.event.set()
+
+    def _get_groum_shard(self, groum_id):
+        # the groum key starts with the app key (user/repo/commit)
+        return self.get_shard("/".join(groum_id.split("/")[:3]))
+
+    def _get_index_mtime(self, app_key):
+        """ mtime of the index file of the shard, None if the shard was
+        not built
+        """
+        app_path = self._get_app_path(app_key)
+        if app_path is None:
+            return None
+        index_file_name = os.path.join(app_path, "graph_index.json")
+        if not os.path.exists(index_file_name):
+            return None
+        return os.path.getmtime(index_file_name)
+
+    def _set_shard_apps(self, app_key, shard):
+        """ Store the apps of the shard in the manifest of the apps """
+        apps = shard.get_apps()
+        entry = [self._get_index_mtime(app_key), apps]
+        with self._lock:
+            if self.app_manifest.get(app_key) != entry:
+                self.app_manifest[app_key] = entry
+                self._app_manifest_changed = True
+        return apps
+
+    def _get_shard_apps(self, app_key):
+        """ Apps of the shard, the shard is loaded only if its index file
+        changed since the apps were stored in the manifest
+        """
+        mtime = self._get_index_mtime(app_key)
+        with self._lock:
+            entry = self.app_manifest.get(app_key)
+        if not entry is None and not mtime is None and entry[0] == mtime:
+            return entry[1]
+        shard = self.get_shard(app_key)
+        return [] if shard is None else self._set_shard_apps(app_key, shard)
+
+    def _write_app_manifest(self):
+        """ Write the manifest of the apps, only if it changed """
+        app_keys = set(self.get_app_keys())
+        with self._lock:
+            if not self._app_manifest_changed:
+                return
+            app_manifest = dict([(app_key, entry) for app_key, entry
+                                 in self.app_manifest.items()
+                                 if app_key in app_keys])
+            with open(self.apps_file_name, "w") as apps_file:
+                json.dump(app_manifest, apps_file)
+            self.app_manifest = app_manifest
+            self._app_manifest_changed = False
+
+    def get_apps(self):
+        return [app for (cursor, app) in self.iter_apps()]
+
+    def get_groums(self, app_id):
+        shard = self.get_shard(app_id)
+        return [] if shard is None else shard.get_groums(app_id)
+
+    def iter_apps(self, cursor = None):
+        """ Iterates over the apps, the cursor is the position of the
+        next app (counting the apps of all the shards, in the order of
+        the app directories).
+        """
+        return self._iter_apps(_get_cursor_position(cursor))
+
+    def _iter_apps(self, position):
+        n_apps = 0
+        try:
+            for app_key in self.get_app_keys():
+                for app in self._get_shard_apps(app_key):
+                    n_apps += 1
+                    if n_apps > position:
+                        yield (str(n_apps), app)
+        finally:
+            self._write_app_manifest()
+
+    def iter_groums(self, app_id, cursor = None):
+        position = _get_cursor_position(cursor)
+        shard = self.get_shard(app_id)
+        if shard is None:
+            return iter([])
+        return shard.iter_groums(app_id, str(position))
+
+    def iter_all_groums(self):
+        for app_key in self.get_app_keys():
+            shard = self.get_shard(app_key)
+            if not shard is None:
+                for groum in shard.iter_all_groums():
+                    yield groum
+
+    def _get_groum_rel_path(self, groum_id):
+        shard = self._get_groum_shard(groum_id)
+        if shard is None:
+            return None
+        groum_rel_path = shard._get_groum_rel_path(groum_id)
+        if groum_rel_path is None:
+            return None
+        app_rel_path = _get_rel_path(self.graph_path, shard.graph_path)
+        return os.path.join(app_rel_path, groum_rel_path)
+
+    def _get_n_groums(self):
+        n_groums = 0
+        for app_key in self.get_app_keys():
+            shard = self.get_shard(app_key)
+            if not shard is None:
+                n_groums += shard._get_n_groums()
+        return n_groums
+
+    def get_groum_methods(self, groum_id):
+        shard = self._get_groum_shard(groum_id)
+        return [] if shard is None else shard.get_groum_methods(groum_id)
+
+    def build_method_index(self):
+        """ Build the index of the methods in each shard: the shards in
+        memory build it now (and store it in their index file), the
+        other shards when they are loaded.
+        """
+        self.method_index = True
+        for shard in self.shards.values():
+            if shard.method2groums is None:
+                shard.build_method_index()
+                shard.write_index(shard.index_file_name)
+
+    def get_groum_digest(self, groum_id):
+        shard = self._get_groum_shard(groum_id)
+        return None if shard is None else shard.get_groum_digest(groum_id)
+
+    def get_groums_with_digest(self, digest):
+        groum_keys = []
+        for app_key in self.get_app_keys():
+            shard = self.get_shard(app_key)
+            if not shard is None:
+                groum_keys += shard.get_groums_with_digest(digest)
+        return sorted(groum_keys)
+
+    def _get_method_groums(self, method_name):
+        groum_keys = set()
+        for app_key in self.get_app_keys():
+            shard = self.get_shard(app_key)
+            if not shard is None:
+                groum_keys.update(shard._get_method_groums(method_name))
+        return groum_keys
+
+    def build_index(self, n_workers = 1, progress_step = PROGRESS_STEP):
+        """ Build the shards that do not exist (without keeping them in
+        memory)
+        """
+        for app_key in self.get_app_keys():
+            app_path = self._get_app_path(app_key)
+            if not os.path.exists(os.path.join(app_path, "graph_index.json")):
+                logging.info("Building the shard of %s..." % app_key)
+                GroumIndex(app_path, n_workers, self.method_index)
+
+    def update_index(self, n_workers = 1, progress_step = PROGRESS_STEP):
+        """ Update all the shards, see GroumIndexBase.update_index.
+
+        The shards of the new apps are built (their groums are counted as
+        read) and the shards of the removed apps are dropped.
+        """
+        app_keys = self.get_app_keys()
+        existing = set(app_keys)
+        self.shards.remove_if(lambda app_key : not app_key in existing)
+
+        (read, removed, touched) = (0, 0, 0)
+        for app_key in app_keys:
+            res = self._update_shard(app_key, None, n_workers, progress_step)
+            read += res[0]
+            removed += res[1]
+            touched += res[2]
+        self._write_app_manifest()
+        return (read, removed, touched)
+
+    def update_files(self, groum_files, n_workers = 1,
+                     progress_step = PROGRESS_STEP):
+        """ Update the shards of the apps of the groum_files """
+        app2files = {}
+        for groum_file in groum_files:
+            groum_file = os.path.abspath(groum_file)
+            groum_rel_path = _get_rel_path(self.graph_path, groum_file)
+            parts = groum_rel_path.split(os.sep)
+            if len(parts) > 3:
+                app_key = GroumIndexBase.get_app_key(*parts[:3])
+                app2files.setdefault(app_key, []).append(groum_file)
+
+        (read, removed, touched) = (0, 0, 0)
+        for app_key, app_files in app2files.items():
+            if self._get_app_path(app_key) is None:
+                # the directory of the app was removed
+                self.shards.remove(app_key)
+                continue
+            res = self._update_shard(app_key, app_files,
+                                     n_workers, progress_step)
+            read += res[0]
+            removed += res[1]
+            touched += res[2]
+        self._write_app_manifest()
+        return (read, removed, touched)
+
+    def _update_shard(self, app_key, groum_files, n_workers, progress_step):
+        """ Update the shard of the app with the groum_files (all the
+        files of the app if groum_files is None). A new shard is built.
+        """
+        app_path = self._get_app_path(app_key)
+        if not os.path.exists(os.path.join(app_path, "graph_index.json")):
+            shard = self.get_shard(app_key)
+            if not shard is None:
+                return (len(shard.manifest), 0, 0)
+        else:
+            shard = self.get_shard(app_key)
+            if not shard is None:
+                if groum_files is None:
+                    res = shard.update_index(n_workers, progress_step)
+                else:
+                    res = shard.update_files(groum_files, n_workers,
+                                             progress_step)
+                self._set_shard_apps(app_key, shard)
+                return res
+        return (0, 0, 0)
+
+
+class SQLiteGroumIndex(GroumIndexBase):
+    """
+    Groum index stored in a SQLite database.
+
+    The apps, the groums and the manifest are not kept in memory: the
+    queries (get_groums, get_groum_path, ...) are point lookups on the
+    indexes of the database.
+
+    The database is graph_index.db in graph_path (or db_file), and it is
+    created (using n_workers processes) if it does not exist.
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS apps (" \
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, " \
+        "app_key TEXT UNIQUE NOT NULL, " \
+        "data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS groums (" \
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, " \
+        "groum_key TEXT UNIQUE NOT NULL, " \
+        "app_key TEXT NOT NULL, " \
+        "path TEXT NOT NULL, " \
+        "data TEXT NOT NULL, " \
+        "methods TEXT NOT NULL, " \
+        "digest TEXT)",
+        "CREATE INDEX IF NOT EXISTS groums_app_key ON groums (app_key)",
+        "CREATE TABLE IF NOT EXISTS groum_methods (" \
+        "method TEXT NOT NULL, " \
+        "groum_key TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS groum_methods_method " \
+        "ON groum_methods (method)",
+        "CREATE INDEX IF NOT EXISTS groum_methods_groum_key " \
+        "ON groum_methods (groum_key)",
+        "CREATE TABLE IF NOT EXISTS manifest (" \
+        "path TEXT PRIMARY KEY, " \
+        "size INTEGER, " \
+        "mtime REAL, " \
+        "hash TEXT, " \
+        "groum_key TEXT)"
+    ]
+
+    # number of rows read at once by the iterators
+    ITER_BATCH = 1000
+
+    def __init__(self, graph_path, db_file = None, n_workers = 1):
+        super(SQLiteGroumIndex, self).__init__(graph_path)
+
+        if db_file is None:
+            db_file = os.path.join(self.graph_path, "graph_index.db")
+        self.db_file = db_file
+
+        exists = os.path.exists(self.db_file)
+        # the connection is shared by the threads of the service
+        self._lock = threading.RLock()
+        self.connection = sqlite3.connect(self.db_file,
+                                          check_same_thread = False)
+        with self._lock:
+            tables = [row[0] for row in
+                      self.connection.execute("SELECT name FROM " \
+                                              "sqlite_master WHERE " \
+                                              "type = 'table'")]
+            for statement in SQLiteGroumIndex.SCHEMA:
+                self.connection.execute(statement)
+            # databases created before storing the digests
+            columns = [row[1] for row in
+                       self.connection.execute("PRAGMA table_info(groums)")]
+            if not "digest" in columns:
+                self.connection.execute("ALTER TABLE groums " \
+                                        "ADD COLUMN digest TEXT")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS " \
+                                    "groums_digest ON groums (digest)")
+            self.connection.commit()
+
+        if not exists:
+            self.build_index(n_workers)
+        elif not "groum_methods" in tables:
+            # databases created before storing the groums of the methods
+            self.build_method_index()
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    def _query(self, statement, args = ()):
+        with self._lock:
+            return self.connection.execute(statement, args).fetchall()
+
+    def _execute(self, statement, args = ()):
+        with self._lock:
+            self.connection.execute(statement, args)
+
+    def get_apps(self):
+        return [json.loads(row[0]) for row in
+                self._query("SELECT data FROM apps ORDER BY id")]
+
+    def get_groums(self, app_id):
+        return [json.loads(row[0]) for row in
+                self._query("SELECT data FROM groums WHERE app_key = ? " \
+                            "ORDER BY id", (app_id,))]
+
+    def get_all_groums(self):
+        return [json.loads(row[0]) for row in
+                self._query("SELECT data FROM groums ORDER BY id")]
+
+    def iter_apps(self, cursor = None):
+        return self._iter_rows("SELECT id, data FROM apps " \
+                               "WHERE id > ? ORDER BY id LIMIT ?",
+                               (), _get_cursor_position(cursor))
+
+    def iter_groums(self, app_id, cursor = None):
+        return self._iter_rows("SELECT id, data FROM groums " \
+                               "WHERE app_key = ? AND id > ? " \
+                               "ORDER BY id LIMIT ?",
+                               (app_id,), _get_cursor_position(cursor))
+
+    def iter_all_groums(self):
+        rows = self._iter_rows("SELECT id, data FROM groums " \
+                               "WHERE id > ? ORDER BY id LIMIT ?",
+                               (), 0)
+        for (cursor, groum) in rows:
+            yield groum
+
+    def _iter_rows(self, statement, args, last_id):
+        """ Iterates over the rows (id, data) returned by statement.
+
+        The rows are read in batches of ITER_BATCH rows after last_id
+        (the cursor is the id of the row), so the database is not locked
+        while iterating.
+        """
+        while True:
+            rows = self._query(statement,
+                               args + (last_id, self.ITER_BATCH))
+            for (row_id, data) in rows:
+                last_id = row_id
+                yield (str(row_id), json.loads(data))
+            if len(rows) < self.ITER_BATCH:
+                break
+
+    def _get_groum_rel_path(self, groum_id):
+        rows = self._query("SELECT path FROM groums WHERE groum_key = ?",
+                           (groum_id,))
+        return rows[0][0] if len(rows) > 0 else None
+
+    def get_groum_methods(self, groum_id):
+        rows = self._query("SELECT methods FROM groums WHERE groum_key = ?",
+                           (groum_id,))
+        return json.loads(rows[0][0]) if len(rows) > 0 else []
+
+    def build_method_index(self):
+        """ Build the groum_methods table again from the methods of the
+        groums (the table is always kept up to date when adding and
+        removing groums).
+        """
+        with self._lock:
+            self._execute("DELETE FROM groum_methods")
+            for (groum_key, methods) in self._query("SELECT groum_key, " \
+                                                    "methods FROM groums"):
+                self._insert_groum_methods(groum_key, json.loads(methods))
+            self.connection.commit()
+
+    def _insert_groum_methods(self, groum_key, methods):
+        with self._lock:
+            self.connection.executemany("INSERT INTO groum_methods " \
+                                        "(method, groum_key) VALUES (?, ?)",
+                                        [(method, groum_key)
+                                         for method in methods])
+
+    def get_groum_digest(self, groum_id):
+        rows = self._query("SELECT digest FROM groums WHERE groum_key = ?",
+                           (groum_id,))
+        return rows[0][0] if len(rows) > 0 else None
+
+    def get_groums_with_digest(self, digest):
+        return [row[0] for row in
+                self._query("SELECT groum_key FROM groums WHERE digest = ? " \
+                            "ORDER BY groum_key", (digest,))]
+
+    def _get_method_groums(self, method_name):
+        rows = self._query("SELECT groum_key FROM groum_methods " \
+                           "WHERE method = ?", (method_name,))
+        return set([row[0] for row in rows])
+
+    def _add_groum_record(self, apps_set, groum_record):
+        (repo, groum_data, groum_rel_path, method_list, digest) = groum_record
+        app_key = repo["app_key"]
+        groum_key = groum_data["groum_key"]
+
+        with self._lock:
+            if not self._get_groum_rel_path(groum_key) is None:
+                self._remove_groum(apps_set, groum_key)
+
+            self._execute("INSERT OR IGNORE INTO apps (app_key, data) " \
+                          "VALUES (?, ?)", (app_key, json.dumps(repo)))
+            methods = sorted(set(method_list))
+            self._execute("INSERT INTO groums " \
+                          "(groum_key, app_key, path, data, methods, " \
+                          "digest) VALUES (?, ?, ?, ?, ?, ?)",
+                          (groum_key, app_key, groum_rel_path,
+                           json.dumps(groum_data), json.dumps(methods),
+                           digest))
+            self._insert_groum_methods(groum_key, methods)
+
+    def _remove_groum(self, apps_set, groum_key):
+        app_key = "/".join(groum_key.split("/")[:3])
+        with self._lock:
+            self._execute("DELETE FROM groums WHERE groum_key = ?",
+                          (groum_key,))
+            self._execute("DELETE FROM groum_methods WHERE groum_key = ?",
+                          (groum_key,))
+            rows = self._query("SELECT 1 FROM groums WHERE app_key = ? " \
+                               "LIMIT 1", (app_key,))
+            if len(rows) == 0:
+                self._execute("DELETE FROM apps WHERE app_key = ?",
+                              (app_key,))
+
+    def _get_manifest_entry(self, groum_rel_path):
+        rows = self._query("SELECT size, mtime, hash, groum_key " \
+                           "FROM manifest WHERE path = ?", (groum_rel_path,))
+        return list(rows[0]) if len(rows) > 0 else None
+
+    def _set_manifest_entry(self, groum_rel_path, entry):
+        self._execute("INSERT OR REPLACE INTO manifest " \
+                      "(path, size, mtime, hash, groum_key) " \
+                      "VALUES (?, ?, ?, ?, ?)",
+                      tuple([groum_rel_path] + list(entry)))
+
+    def _pop_manifest_entry(self, groum_rel_path):
+        with self._lock:
+            entry = self._get_manifest_entry(groum_rel_path)
+            self._execute("DELETE FROM manifest WHERE path = ?",
+                          (groum_rel_path,))
+        return entry
+
+    def _get_manifest_paths(self):
+        return [row[0] for row in self._query("SELECT path FROM manifest")]
+
+    def _get_n_groums(self):
+        return self._query("SELECT COUNT(*) FROM groums")[0][0]
+
+    def _commit(self, commit):
+        """ Commit the changes only if commit is True (rollback
+        otherwise).
+
+        The changes are visible to the other threads (they use the same
+        connection) before the commit.
+        """
+        with self._lock:
+            if commit:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+
+    def build_index(self, n_workers = 1,
+                    progress_step = PROGRESS_STEP):
+        committed = False
+        try:
+            super(SQLiteGroumIndex, self).build_index(n_workers,
+                                                      progress_step)
+            self._commit(True)
+            committed = True
+        finally:
+            if not committed:
+                self._commit(False)
+
+    def update_index(self, n_workers = 1,
+                     progress_step = PROGRESS_STEP):
+        committed = False
+        try:
+            res = super(SQLiteGroumIndex, self).update_index(n_workers,
+                                                             progress_step)
+            self._commit(True)
+            committed = True
+        finally:
+            if not committed:
+                self._commit(False)
+        return res
+
+    def update_files(self, groum_files, n_workers = 1,
+                     progress_step = PROGRESS_STEP):
+        committed = False
+        try:
+            res = super(SQLiteGroumIndex, self).update_files(groum_files,
+                                                             n_workers,
+                                                             progress_step)
+            self._commit(True)
+            committed = True
+        finally:
+            if not committed:
+                self._commit(False)
+        return res
@@ -2,11 +2,25 @@
 Implement the index/search for clusters
 """
 
+import copy
 import logging
 import itertools
+import json
 import os
-from io import StringIO
+import re
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from io import StringIO, BytesIO
 from fixrgraph.solr.patterns_utils import parse_clusters, parse_cluster_info
+try:
+   import numpy
+except ImportError:
+   numpy = None
+
+from fixrsearch.index_snapshot import ClusterIndexSnapshot, get_snapshot_file
+from fixrsearch.cache import LRUCache
+from fixrsearch.symbols import get_method_symbols
 
 class IndexNode(object):
    """
@@ -17,101 +31,116 @@ class IndexNode(object):
    http://osebje.famnit.upr.si/~savnik/papers/cdares13.pdf
 
    We implement the getAllSuperSets operation
+
+   The children of a node are sorted by key and child_keys keeps their
+   keys in an array, so that they can be searched with bisect.
+   The trie is visited with explicit stacks (no recursion).
+
+   The trie has a node for each prefix of the clusters, so the nodes are
+   kept small: they have no __dict__ and the nodes created by insert
+   share the same empty (immutable) children and clusters until
+   something is added to them.
    """
+   __slots__ = ("key", "children", "child_keys", "clusters")
+
    def __init__(self, key):
       self.key = key
       self.children = []
+      self.child_keys = array('i')
       self.clusters = []
 
+   @staticmethod
+   def _new_leaf(key):
+      node = IndexNode.__new__(IndexNode)
+      node.key = key
+      node.children = _NO_CHILDREN
+      node.child_keys = _NO_CHILDREN
+      node.clusters = _NO_CHILDREN
+      return node
+
    def is_root(self):
       return self.key < 0
 
    @staticmethod
    def _find_index(children, key):
-      # def _find_index_rec(children, key, low, high):
-      #    if low > high:
-      #       return (low,high)
-      #    else:
-      #       idx = (low + high) / 2
-      #       if children[idx].key == key:
-      #          return (idx,idx)
-      #       elif key < children[idx].key:
-      #          return _find_index_rec(children, key, low, idx-1)
-      #       else:
-      #          return _find_index_rec(children, key, low+1, high)
-
-      # return _find_index_rec(children, key,
-      #                        0, len(children) - 1)
-
-      found = False
+      """
+      Binary search of key in the sorted list of children.
+
+      Returns (idx,idx) if children[idx] has the key, otherwise
+      (low,low-1) where low is the position where to insert the key.
+      """
       low = 0
       high = len(children) - 1
-      res = None
-      while (not found):
-         if low > high:
-            res = (low,high)
-            found = True
-            break
+      while low <= high:
+         idx = (low + high) // 2
+         if children[idx].key == key:
+            return (idx,idx)
+         elif key < children[idx].key:
+            high = idx - 1
          else:
-            idx = (low + high) / 2
-            if children[idx].key == key:
-               res = (idx,idx)
-               found = True
-            elif key < children[idx].key:
-               high = idx-1
-            else:
-               low = low + 1
-      return res
+            low = idx + 1
+      return (low,high)
 
-   def _insert_rec(self, int_list, value, l, h):
-      if (l > h):
-         self.clusters.append(value)
+   def insert(self, int_list, value):
+      """
+      Insert value in the trie, int_list must be sorted.
+      """
+      node = self
+      for elem in int_list:
+         position = bisect_left(node.child_keys, elem)
+         if (position < len(node.child_keys) and
+             node.child_keys[position] == elem):
+            node = node.children[position]
+         else:
+            if node.children is _NO_CHILDREN:
+               node.children = []
+               node.child_keys = array('i')
+            child = IndexNode._new_leaf(elem)
+            node.children.insert(position, child)
+            node.child_keys.insert(position, elem)
+            node = child
+      if node.clusters is _NO_CHILDREN:
+         node.clusters = [value]
       else:
-         first_elem = int_list[l]
-         (i1,i2) = IndexNode._find_index(self.children, first_elem)
+         node.clusters.append(value)
 
-         if i1 == i2:
-            # found the element, recur
-            index_elem = self.children[i1]
-            index_elem._insert_rec(int_list, value, l + 1, h)
+   def remove(self, int_list, value):
+      """
+      Remove value from the trie, int_list must be the sorted list
+      used to insert value.
+
+      Returns True if value was found (the empty nodes are not removed).
+      """
+      node = self
+      for elem in int_list:
+         position = bisect_left(node.child_keys, elem)
+         if (position < len(node.child_keys) and
+             node.child_keys[position] == elem):
+            node = node.children[position]
          else:
-            # insert the first_elem in the list at
-            # position i1 + 1
-            index_elem = IndexNode(first_elem)
-            self.children.insert(i1 + 1, index_elem)
-            index_elem._insert_rec(int_list, value, l + 1, h)
+            return False
+      for i in range(len(node.clusters)):
+         if node.clusters[i] is value:
+            del node.clusters[i]
+            return True
+      return False
 
-   def insert(self, int_list, value):
-      self._insert_rec(int_list, value, 0, len(int_list) - 1)
-
-   def _get_all_supersets_rec(self, int_list,
-                              supersets,
-                              l, h, found):
-      if (l > h and found):
-         supersets.extend(self.clusters)
-         for c in self.children:
-            c._get_all_supersets_rec(int_list,
-                                     supersets,
-                                     l,h, found)
-      else:
-         match_current = ((not self.is_root() and self.key == int_list[l]) or
-                          (self.is_root()))
-         current_less_than = ((not self.is_root() and self.key <= int_list[l]) or
-                              (self.is_root()))
-         if (l == h and match_current):
-            # Consumed the word
-            self._get_all_supersets_rec(int_list, supersets, l+1, h, True)
-         elif match_current:
-            # Explore the rest of the word
-            next_elem = int_list[l+1]
-            for child in self.children:
-               if child.key <= next_elem:
-                  child._get_all_supersets_rec(int_list, supersets, l+1, h, False)
-         elif current_less_than:
-            current_elem = int_list[l]
-            for child in self.children:
-               if child.key <= current_elem:
-                  child._get_all_supersets_rec(int_list, supersets, l, h, False)
+   def copy(self):
+      """ Copy of the trie (the clusters are shared) """
+      new_root = IndexNode(self.key)
+      stack = [(self, new_root)]
+      while len(stack) > 0:
+         (node, new_node) = stack.pop()
+         if len(node.clusters) > 0:
+            new_node.clusters = list(node.clusters)
+         if len(node.children) > 0:
+            new_node.children = []
+            new_node.child_keys = array('i', node.child_keys)
+            for child in node.children:
+               new_child = IndexNode._new_leaf(child.key)
+               new_node.children.append(new_child)
+               stack.append((child, new_child))
+      return new_root
 
    def get_all_supersets(self, int_list):
       """
@@ -121,21 +150,44 @@ class IndexNode(object):
       - Returns all the sets contained in the trie starting 
       from the found prefix
 
+      int_list must be sorted.
+      The supersets are returned in the pre-order of the trie visit.
       """
       supersets = []
-      self._get_all_supersets_rec(int_list,
-                                  supersets,
-                                  -1, len(int_list) - 1,
-                                  False)
+      h = len(int_list)
+
+      # (node, number of elements of int_list matched on the path to node)
+      stack = [(self, 0)]
+      while len(stack) > 0:
+         (node, l) = stack.pop()
+         if l == h:
+            # consumed the word, all the sets below node are supersets
+            supersets.extend(node.clusters)
+            for i in range(len(node.children) - 1, -1, -1):
+               stack.append((node.children[i], l))
+         else:
+            # only the children with key <= next_elem can lead to
+            # the next element of the word
+            next_elem = int_list[l]
+            upper = bisect_right(node.child_keys, next_elem)
+            for i in range(upper - 1, -1, -1):
+               child = node.children[i]
+               if child.key == next_elem:
+                  stack.append((child, l + 1))
+               else:
+                  stack.append((child, l))
       return supersets
 
    def _print_(self, stream, ind):
-      stream.write("%sKey: %d\n" % (ind, self.key))
-      c_repr = ",".join([str(c) for c in self.clusters])
-      stream.write("%sCluster: %s\n" % (ind, c_repr))
-      for c in self.children:
-         new_ind = "%s  " % ind
-         c._print_(stream, new_ind)
+      stack = [(self, ind)]
+      while len(stack) > 0:
+         (node, node_ind) = stack.pop()
+         stream.write("%sKey: %d\n" % (node_ind, node.key))
+         c_repr = ",".join([str(c) for c in node.clusters])
+         stream.write("%sCluster: %s\n" % (node_ind, c_repr))
+         new_ind = "%s  " % node_ind
+         for c in reversed(node.children):
+            stack.append((c, new_ind))
 
    def __repr__(self):
       stringio = StringIO()
@@ -155,37 +207,338 @@ class IndexNode(object):
             stack.append(c)
 
    def __eq__(self, other):
-      if type(self) != type(other):
-         return False
-      elif self.key != other.key:
-         return False
-      elif len(self.clusters) != len(other.clusters):
-         return False
-      elif len(self.children) != len(other.children):
-         return False
+      stack = [(self, other)]
+      while len(stack) > 0:
+         (n_self, n_other) = stack.pop()
+         if type(n_self) != type(n_other):
+            return False
+         elif n_self.key != n_other.key:
+            return False
+         elif len(n_self.clusters) != len(n_other.clusters):
+            return False
+         elif len(n_self.children) != len(n_other.children):
+            return False
+         else:
+            for (c_self, c_other) in zip(n_self.clusters, n_other.clusters):
+               if not (c_self == c_other):
+                  return False
+            stack.extend(zip(n_self.children, n_other.children))
+      return True
+
+# empty children/clusters shared by the nodes of the trie
+_NO_CHILDREN = ()
+
+class PostingsIndex(object):
+   """
+   Inverted index from a method id to the list of clusters (postings)
+   containing the method.
+
+   Finds all the clusters that have at least k elements in common with
+   a set of methods by merging the postings of the methods and counting
+   how many times each cluster occurs. The cost of the search is linear
+   in the number of postings visited.
+   """
+   def __init__(self):
+      # method id -> list of positions in self.clusters
+      self.postings = {}
+      # the removed clusters are None
+      self.clusters = []
+
+   def insert(self, int_list, value):
+      position = len(self.clusters)
+      self.clusters.append(value)
+      for method_id in set(int_list):
+         if method_id in self.postings:
+            self.postings[method_id].append(position)
+         else:
+            self.postings[method_id] = [position]
+
+   def remove(self, int_list, value):
+      """
+      Remove value, inserted with the methods in int_list.
+
+      Returns True if value was found.
+      """
+      methods = set(int_list)
+      if len(methods) > 0:
+         # the cluster is in the postings of all its methods
+         candidates = self.postings.get(next(iter(methods)), [])
       else:
-         for (c_self, c_other) in zip(self.clusters, other.clusters):
-            if not (c_self == c_other):
-               return False
-         for (c_self, c_other) in zip(self.children, other.children):
-            if not (c_self == c_other):
-               return False
+         candidates = range(len(self.clusters))
+      position = None
+      for p in candidates:
+         if self.clusters[p] is value:
+            position = p
+            break
+      if position is None:
+         return False
+
+      self.clusters[position] = None
+      for method_id in methods:
+         self.postings[method_id].remove(position)
       return True
 
+   def copy(self):
+      """ Copy of the index (the clusters are shared) """
+      new_index = PostingsIndex()
+      new_index.clusters = list(self.clusters)
+      for (method_id, positions) in self.postings.items():
+         new_index.postings[method_id] = list(positions)
+      return new_index
+
+   def get_overlaps(self, int_list, k):
+      """
+      Find all the clusters that contain at least k of the (distinct)
+      elements in int_list.
+
+      Returns a list of pairs (cluster, number of elements in common).
+      """
+      counts = {}
+      for method_id in int_list:
+         if method_id not in self.postings:
+            continue
+         for position in self.postings[method_id]:
+            counts[position] = counts.get(position, 0) + 1
+
+      if k <= 0:
+         return [(cluster, counts.get(position, 0))
+                 for position, cluster in enumerate(self.clusters)
+                 if not cluster is None]
+
+      return [(self.clusters[position], count)
+              for position, count in counts.items() if count >= k]
+
+   def get_all_with_k(self, int_list, k):
+      return [cluster for (cluster, count) in self.get_overlaps(int_list, k)]
+
+   def get_overlaps_batch(self, int_lists, k):
+      """
+      Same as get_overlaps for each list in int_lists, visiting the
+      postings of each method only once for all the lists.
+
+      Returns a list with the result of get_overlaps for each list.
+      """
+      # method id -> lists (positions in int_lists) containing the method
+      method_to_lists = {}
+      for (list_position, int_list) in enumerate(int_lists):
+         for method_id in set(int_list):
+            if method_id in method_to_lists:
+               method_to_lists[method_id].append(list_position)
+            else:
+               method_to_lists[method_id] = [list_position]
+
+      all_counts = [{} for int_list in int_lists]
+      for (method_id, list_positions) in method_to_lists.items():
+         if method_id not in self.postings:
+            continue
+         for position in self.postings[method_id]:
+            for list_position in list_positions:
+               counts = all_counts[list_position]
+               counts[position] = counts.get(position, 0) + 1
+
+      results = []
+      for counts in all_counts:
+         if k <= 0:
+            results.append([(cluster, counts.get(position, 0))
+                            for position, cluster in enumerate(self.clusters)
+                            if not cluster is None])
+         else:
+            results.append([(self.clusters[position], count)
+                            for position, count in counts.items()
+                            if count >= k])
+      return results
+
+
+class BitsetIndex(object):
+   """
+   Represents the set of methods of each cluster as a row of a matrix of
+   bits (packed in uint64 words): each method of the clusters has a
+   column, and the bit of the column is set iff the cluster contains the
+   method. The columns are assigned to the method ids when the clusters
+   are inserted, so the width of the matrix is the number of methods in
+   the clusters (and not the largest method id).
+
+   The methods in common between a set of methods (the query bit vector)
+   and all the clusters are computed at once with a vectorized and
+   followed by a popcount of each row.
+
+   Requires numpy.
+   """
+   WORD_BITS = 64
+
+   def __init__(self, n_methods):
+      if numpy is None:
+         raise ImportError("The bitset index requires numpy")
+      self.n_words = max(1, (n_methods + BitsetIndex.WORD_BITS - 1) //
+                         BitsetIndex.WORD_BITS)
+      # the removed clusters are None
+      self.clusters = []
+      self.matrix = numpy.zeros((0, self.n_words), dtype=numpy.uint64)
+      # rows inserted and not yet in the matrix
+      self._pending = []
+      # method id -> column
+      self.columns = {}
+
+   def _to_bits(self, int_list):
+      """ Bits of the methods in int_list (the methods without a column
+      are not in any cluster and are ignored)
+      """
+      bits = numpy.zeros(self.n_words, dtype=numpy.uint64)
+      for elem in int_list:
+         column = self.columns.get(elem)
+         if column is None:
+            continue
+         word = column // BitsetIndex.WORD_BITS
+         bit = numpy.uint64(1) << numpy.uint64(column % BitsetIndex.WORD_BITS)
+         bits[word] |= bit
+      return bits
+
+   def insert(self, int_list, value):
+      for elem in int_list:
+         if not elem in self.columns:
+            self.columns[elem] = len(self.columns)
+      # new methods may not fit in the current words
+      self._resize((len(self.columns) + BitsetIndex.WORD_BITS - 1) //
+                   BitsetIndex.WORD_BITS)
+      self.clusters.append(value)
+      self._pending.append(self._to_bits(int_list))
+
+   def _resize(self, n_words):
+      if n_words <= self.n_words:
+         return
+      matrix = self._get_matrix()
+      self.matrix = numpy.zeros((matrix.shape[0], n_words),
+                                dtype=numpy.uint64)
+      self.matrix[:, :self.n_words] = matrix
+      self.n_words = n_words
+
+   def remove(self, int_list, value):
+      """
+      Remove value (the row of the cluster is cleared).
+
+      Returns True if value was found.
+      """
+      for position in range(len(self.clusters)):
+         if self.clusters[position] is value:
+            matrix = self._get_matrix()
+            matrix[position, :] = 0
+            self.clusters[position] = None
+            return True
+      return False
+
+   def copy(self):
+      """ Copy of the index (the clusters are shared) """
+      new_index = BitsetIndex(0)
+      new_index.n_words = self.n_words
+      new_index.clusters = list(self.clusters)
+      new_index.matrix = self._get_matrix().copy()
+      new_index.columns = dict(self.columns)
+      return new_index
+
+   def _get_matrix(self):
+      if len(self._pending) > 0:
+         self.matrix = numpy.vstack([self.matrix] + self._pending)
+         self._pending = []
+      return self.matrix
+
+   def get_scores(self, int_list):
+      """
+      Returns the array with the number of elements of int_list in common
+      with each cluster (in the insertion order of the clusters).
+      """
+      matrix = self._get_matrix()
+      query = self._to_bits(int_list)
+      # only the words set in the query contribute to the score
+      words = query.nonzero()[0]
+      common = matrix[:, words] & query[words]
+      return _popcount_rows(common)
+
+   def get_overlaps(self, int_list, k):
+      """ Same as PostingsIndex.get_overlaps """
+      scores = self.get_scores(int_list)
+      if k <= 0:
+         positions = [p for p in range(len(self.clusters))
+                      if not self.clusters[p] is None]
+      else:
+         positions = numpy.flatnonzero(scores >= k)
+      return [(self.clusters[p], int(scores[p])) for p in positions]
+
+   def get_all_with_k(self, int_list, k):
+      return [cluster for (cluster, count) in self.get_overlaps(int_list, k)]
+
+
+def _popcount_rows(words):
+   """ Number of bits set in each row of the 2d array of uint64 words """
+   if hasattr(numpy, "bitwise_count"):
+      return numpy.bitwise_count(words).sum(axis=1, dtype=numpy.int64)
+   else:
+      # count the bits of each byte of the row
+      as_bytes = numpy.ascontiguousarray(words).view(numpy.uint8)
+      return _BYTE_POPCOUNT[as_bytes].sum(axis=1, dtype=numpy.int64)
+
+if numpy is None:
+   _BYTE_POPCOUNT = None
+else:
+   _BYTE_POPCOUNT = numpy.array([bin(i).count("1") for i in range(256)],
+                                dtype=numpy.uint8)
+
+
 class ClusterIndex(object):
    """ Keep an index of the cluster by method names
+
+   The index_type selects the data structure used to retrieve the
+   clusters:
+   - SETTRIE: enumerates all the subsets of methods of size
+     min_methods_in_common and looks for their supersets in a SetTrie
+   - POSTINGS: counts the methods in common on an inverted index
+   - BITSET: counts the methods in common with all the clusters at once
+     on a bit matrix (requires numpy)
+   All of them return the same set of clusters.
+
+   With use_snapshot the index is read from the binary snapshot of
+   cluster_file (see index_snapshot), that is created if missing or
+   stale. The POSTINGS index is then used directly from the mmap of the
+   snapshot, while the other indexes are built from the snapshot.
+
+   The patterns read with get_patterns/get_pattern are kept in a LRU
+   cache bounded by patterns_cache_entries entries and by
+   patterns_cache_bytes (estimated) bytes, None disables a bound.
    """
+   SETTRIE = "settrie"
+   POSTINGS = "postings"
+   BITSET = "bitset"
 
-   def __init__(self, cluster_file):
+   def __init__(self, cluster_file, index_type = POSTINGS,
+                use_snapshot = False,
+                patterns_cache_entries = 1000,
+                patterns_cache_bytes = None):
+      if index_type not in [ClusterIndex.SETTRIE, ClusterIndex.POSTINGS,
+                            ClusterIndex.BITSET]:
+         raise ValueError("Unknown index type %s" % index_type)
+      if index_type == ClusterIndex.BITSET and numpy is None:
+         raise ImportError("The bitset index requires numpy")
+      self.index_type = index_type
       self.index_node = IndexNode(-1)
+      self.postings = PostingsIndex()
+      self.bitset = None
       self.m2i = {}
       self.i2m = {}
+      # the method ids are the ones of the table of the process, shared
+      # with the other indexes
+      self.symbols = get_method_symbols()
 
       self.cluster_file = cluster_file
       self.methods_set = None
-      self._create_index()
+      self.snapshot = None
+      self._create_index(use_snapshot)
+      # cluster id -> cluster, built when the index is updated
+      self.id2cluster = None
 
-      self.pattern_map = {}
+      # cache of the patterns read from the cluster info files
+      self.pattern_map = LRUCache(patterns_cache_entries,
+                                  patterns_cache_bytes)
+      # cluster id -> PatternOffsets
+      self.pattern_offsets = {}
 
    def _build_int_mappings(self,cluster_infos):
       methods_set = set()
@@ -195,13 +548,16 @@ class ClusterIndex(object):
             if m not in methods_set:
                methods_set.add(m)
       # assign a mapping
-      count = -1
       for m in methods_set:
-         count += 1
-         self.m2i[m] = count
-         self.i2m[count] = m
+         method_id = self.symbols.intern(m)
+         self.m2i[m] = method_id
+         self.i2m[method_id] = self.symbols.get_name(method_id)
       self.methods_set = methods_set
 
+      # share the copy of the names kept in the table
+      for ci in cluster_infos:
+         ci.methods_list = [self.i2m[self.m2i[m]] for m in ci.methods_list]
+
    def _convert_list(self, src_list, src2dst):
       dst_list = []
       for src_elem in src_list:
@@ -218,21 +574,93 @@ class ClusterIndex(object):
       dst_list = self._convert_list(int_list, self.i2m)
       return dst_list
 
-   def _create_index(self):
+   def _parse_clusters(self):
       with open(self.cluster_file, "r") as cluster_stream:
          cluster_infos = parse_clusters(cluster_stream)
          cluster_stream.close()
+      return cluster_infos
+
+   def _open_snapshot(self):
+      """ Open the snapshot of the cluster file, creating it if needed.
+
+      Returns the list of clusters if it had to parse them.
+      """
+      cluster_infos = None
+      snapshot_file = get_snapshot_file(self.cluster_file)
+      self.snapshot = ClusterIndexSnapshot.open(snapshot_file,
+                                                self.cluster_file,
+                                                self.symbols)
+      if self.snapshot is None:
+         logging.info("Creating the snapshot %s..." % snapshot_file)
+         cluster_infos = self._parse_clusters()
+         try:
+            ClusterIndexSnapshot.write(snapshot_file, self.cluster_file,
+                                       cluster_infos)
+            self.snapshot = ClusterIndexSnapshot.open(snapshot_file,
+                                                      self.cluster_file,
+                                                      self.symbols)
+         except EnvironmentError as e:
+            logging.warning("Cannot write the snapshot %s (%s)" %
+                            (snapshot_file, str(e)))
+      return cluster_infos
 
-      self._build_int_mappings(cluster_infos)
+   def _create_index(self, use_snapshot = False):
+      cluster_infos = None
+      if use_snapshot:
+         cluster_infos = self._open_snapshot()
+
+      if not self.snapshot is None:
+         self.m2i = self.snapshot.m2i
+         self.i2m = self.snapshot.i2m
+         if self.index_type == ClusterIndex.POSTINGS:
+            self.postings = self.snapshot
+            return
+         cluster_infos = self.snapshot.get_clusters()
+      else:
+         if cluster_infos is None:
+            cluster_infos = self._parse_clusters()
+         self._build_int_mappings(cluster_infos)
+
+      self._insert_clusters(cluster_infos)
+
+   def _insert_clusters(self, cluster_infos):
+      if self.index_type == ClusterIndex.BITSET:
+         # the columns are the methods of the clusters
+         self.bitset = BitsetIndex(len(self.m2i))
 
       for c in cluster_infos:
          int_list = self._m2i_list(c.methods_list)
-         self.index_node.insert(int_list, c)
+         if self.index_type == ClusterIndex.SETTRIE:
+            self.index_node.insert(int_list, c)
+         elif self.index_type == ClusterIndex.BITSET:
+            self.bitset.insert(int_list, c)
+         else:
+            self.postings.insert(int_list, c)
 
    def get_clusters(self, methods_list, min_methods_in_common):
+      overlaps = self.get_clusters_overlaps(methods_list,
+                                            min_methods_in_common)
+      return set([cluster for (cluster, count) in overlaps])
+
+   def get_clusters_overlaps(self, methods_list, min_methods_in_common):
+      """
+      Find the clusters with at least min_methods_in_common methods in
+      methods_list.
+
+      Returns a list of pairs (cluster, number of methods in common), the
+      number of methods in common can be used to rank the clusters.
+      """
       # Remove methods that are not in the index
-      methods_set = set(methods_list)
-      methods_set.intersection_update(self.methods_set)
+      methods_set = set([m for m in methods_list if m in self.m2i])
+
+      if self.index_type == ClusterIndex.POSTINGS:
+         int_method_list = self._m2i_list(methods_set)
+         return self.postings.get_overlaps(int_method_list,
+                                           min_methods_in_common)
+      elif self.index_type == ClusterIndex.BITSET:
+         int_method_list = self._m2i_list(methods_set)
+         return self.bitset.get_overlaps(int_method_list,
+                                         min_methods_in_common)
 
       # enumerate all the min_methods_in_common size
       # subset of methods_set
@@ -242,26 +670,389 @@ class ClusterIndex(object):
          int_method_list = self._m2i_list(s)
          new_clusters = self.index_node.get_all_supersets(int_method_list)
          clusters.update(new_clusters)
-      return clusters
+      return [(c, len(methods_set.intersection(c.methods_list)))
+              for c in clusters]
 
-   def get_patterns(self, cluster_info):
+   def get_clusters_batch(self, methods_lists, min_methods_in_common):
+      """
+      Same as get_clusters for each list of methods in methods_lists.
+
+      Returns a list with the set of clusters of each list of methods.
+      """
+      overlaps_lists = self.get_clusters_overlaps_batch(methods_lists,
+                                                        min_methods_in_common)
+      return [set([cluster for (cluster, count) in overlaps])
+              for overlaps in overlaps_lists]
+
+   def get_clusters_overlaps_batch(self, methods_lists,
+                                   min_methods_in_common):
+      """
+      Same as get_clusters_overlaps for each list of methods in
+      methods_lists.
+
+      The lists with the same set of methods are searched once and, with
+      the POSTINGS index, the postings of a method are visited once for
+      all the lists.
+
+      Returns a list with the result of get_clusters_overlaps for each
+      list of methods (the lists with the same set of methods share the
+      same result).
+      """
+      # set of methods -> position in unique_sets
+      set_to_position = {}
+      unique_sets = []
+      positions = []
+      for methods_list in methods_lists:
+         methods_set = frozenset([m for m in methods_list if m in self.m2i])
+         if not methods_set in set_to_position:
+            set_to_position[methods_set] = len(unique_sets)
+            unique_sets.append(methods_set)
+         positions.append(set_to_position[methods_set])
+
+      if self.index_type == ClusterIndex.POSTINGS:
+         int_lists = [self._m2i_list(methods_set)
+                      for methods_set in unique_sets]
+         unique_results = self.postings.get_overlaps_batch(
+            int_lists, min_methods_in_common)
+      else:
+         unique_results = [self.get_clusters_overlaps(methods_set,
+                                                      min_methods_in_common)
+                           for methods_set in unique_sets]
+
+      return [unique_results[position] for position in positions]
+
+   def _get_all_clusters(self):
+      if not self.snapshot is None:
+         return self.snapshot.get_clusters()
+      elif self.index_type == ClusterIndex.SETTRIE:
+         return self.index_node.get_all_supersets([])
+      elif self.index_type == ClusterIndex.BITSET:
+         return [c for c in self.bitset.clusters if not c is None]
+      else:
+         return [c for c in self.postings.clusters if not c is None]
+
+   def _prepare_update(self):
+      """ Make the index updatable: builds the map from the cluster ids
+      and moves the index from the (read-only) snapshot to memory.
+      """
+      if self.id2cluster is None:
+         self.id2cluster = {}
+         for c in self._get_all_clusters():
+            self.id2cluster[c.id] = c
+
+      if not self.snapshot is None:
+         # use the method ids of the process instead of the ones of the
+         # snapshot
+         cluster_infos = self.snapshot.get_clusters()
+         self.snapshot = None
+         self.m2i = {}
+         self.i2m = {}
+         self._build_int_mappings(cluster_infos)
+
+         self.index_node = IndexNode(-1)
+         self.postings = PostingsIndex()
+         self._insert_clusters(cluster_infos)
+
+   def copy(self):
+      """
+      Copy of the index that can be updated without changing this index
+      (e.g., while this index is used by other searches).
 
-      if cluster_info.id in self.pattern_map:
-         return self.pattern_map[cluster_info.id]
+      The clusters and the snapshot are shared, the new index has a copy
+      of the cache of the patterns and of their offsets.
+      """
+      new_index = copy.copy(self)
+      if self.snapshot is None:
+         new_index.m2i = dict(self.m2i)
+         new_index.i2m = dict(self.i2m)
+         new_index.methods_set = set(self.methods_set)
+         new_index.postings = self.postings.copy()
+      new_index.index_node = self.index_node.copy()
+      if not self.bitset is None:
+         new_index.bitset = self.bitset.copy()
+      if not self.id2cluster is None:
+         new_index.id2cluster = dict(self.id2cluster)
+      new_index.pattern_map = self.pattern_map.copy()
+      new_index.pattern_offsets = dict(self.pattern_offsets)
+      return new_index
+
+   def add_cluster(self, cluster_info):
+      """ Add (or replace) the cluster to the index """
+      self._prepare_update()
+      if cluster_info.id in self.id2cluster:
+         self.remove_cluster(cluster_info.id)
+
+      for m in cluster_info.methods_list:
+         if not m in self.m2i:
+            method_id = self.symbols.intern(m)
+            self.m2i[m] = method_id
+            self.i2m[method_id] = self.symbols.get_name(method_id)
+            self.methods_set.add(m)
+
+      int_list = self._m2i_list(cluster_info.methods_list)
+      if self.index_type == ClusterIndex.SETTRIE:
+         self.index_node.insert(int_list, cluster_info)
+      elif self.index_type == ClusterIndex.BITSET:
+         self.bitset.insert(int_list, cluster_info)
+      else:
+         self.postings.insert(int_list, cluster_info)
+      self.id2cluster[cluster_info.id] = cluster_info
+      self._remove_patterns(cluster_info.id)
+
+   def remove_cluster(self, cluster_id):
+      """ Remove the cluster from the index.
+
+      The methods of the cluster are kept in the method ids.
+      Returns True if the cluster was in the index.
+      """
+      self._prepare_update()
+      if not cluster_id in self.id2cluster:
+         return False
+      cluster_info = self.id2cluster.pop(cluster_id)
+
+      int_list = self._m2i_list(cluster_info.methods_list)
+      if self.index_type == ClusterIndex.SETTRIE:
+         self.index_node.remove(int_list, cluster_info)
+      elif self.index_type == ClusterIndex.BITSET:
+         self.bitset.remove(int_list, cluster_info)
+      else:
+         self.postings.remove(int_list, cluster_info)
+      self._remove_patterns(cluster_id)
+      return True
 
+   def _remove_patterns(self, cluster_id):
+      self.pattern_offsets.pop(cluster_id, None)
+      self.pattern_map.remove_if(
+         lambda key: (key == cluster_id or
+                      (isinstance(key, tuple) and key[0] == cluster_id)))
+
+   def update_clusters(self, cluster_infos):
+      """
+      Update the index to contain the clusters in cluster_infos, adding
+      and removing only the clusters that changed.
+
+      Returns the pair of lists (added cluster ids, removed cluster ids),
+      a changed cluster is in both lists.
+      """
+      self._prepare_update()
+
+      new_ids = set()
+      added = []
+      removed = []
+      for c in cluster_infos:
+         new_ids.add(c.id)
+         if c.id in self.id2cluster:
+            old_cluster = self.id2cluster[c.id]
+            if sorted(old_cluster.methods_list) == sorted(c.methods_list):
+               continue
+            removed.append(c.id)
+         added.append(c.id)
+         self.add_cluster(c)
+
+      for cluster_id in list(self.id2cluster.keys()):
+         if not cluster_id in new_ids:
+            self.remove_cluster(cluster_id)
+            removed.append(cluster_id)
+
+      return (added, removed)
+
+   def update_from_file(self):
+      """ Apply to the index the changes made to the cluster file """
+      return self.update_clusters(self._parse_clusters())
+
+   def _get_all_clusters_path(self):
       cluster_base_path = os.path.dirname(self.cluster_file)
-      current_path = os.path.join(cluster_base_path,
-                                  "all_clusters",
-                                  "cluster_%d" % cluster_info.id)
+      return os.path.join(cluster_base_path, "all_clusters")
+
+   def _get_cluster_info_file(self, cluster_id):
+      current_path = os.path.join(self._get_all_clusters_path(),
+                                  "cluster_%d" % cluster_id)
       cluster_info_file = os.path.join(current_path,
-                                       "cluster_%d_info.txt" % cluster_info.id)
+                                       "cluster_%d_info.txt" % cluster_id)
+      return cluster_info_file
+
+   def get_patterns(self, cluster_info):
+      pattern_list = self.pattern_map.get(cluster_info.id)
+      if not pattern_list is None:
+         return pattern_list
+
+      cluster_info_file = self._get_cluster_info_file(cluster_info.id)
 
       if os.path.isfile(cluster_info_file):
          with open(cluster_info_file, 'r') as f:
             pattern_list = parse_cluster_info(f)
             f.close()
-         self.pattern_map[cluster_info.id] = pattern_list
+         # the size of the file estimates the memory used by the patterns
+         self.pattern_map.put(cluster_info.id, pattern_list,
+                              os.path.getsize(cluster_info_file))
       else:
          logging.info("Cluster not computed %s" % cluster_info_file)
          pattern_list = []
       return pattern_list
+
+   def _get_pattern_offsets(self, cluster_id):
+      """ Get the offsets of the patterns of the cluster (None if the
+      cluster was not computed).
+      """
+      if cluster_id in self.pattern_offsets:
+         return self.pattern_offsets[cluster_id]
+
+      cluster_info_file = self._get_cluster_info_file(cluster_id)
+      if not os.path.isfile(cluster_info_file):
+         logging.info("Cluster not computed %s" % cluster_info_file)
+         return None
+
+      offsets = PatternOffsets.load(cluster_info_file)
+      if offsets is None:
+         offsets = PatternOffsets.build(cluster_info_file)
+         try:
+            offsets.write()
+         except EnvironmentError as e:
+            logging.warning("Cannot write the offsets of %s (%s)" %
+                            (cluster_info_file, str(e)))
+      self.pattern_offsets[cluster_id] = offsets
+      return offsets
+
+   def build_pattern_offsets(self):
+      """ Build (and store) the offsets of the patterns of all the
+      computed clusters, so that get_pattern does not scan the info files.
+      """
+      all_clusters_path = self._get_all_clusters_path()
+      if not os.path.isdir(all_clusters_path):
+         return
+      for cluster_dir in os.listdir(all_clusters_path):
+         if not cluster_dir.startswith("cluster_"):
+            continue
+         try:
+            cluster_id = int(cluster_dir[len("cluster_"):])
+         except ValueError:
+            continue
+         self._get_pattern_offsets(cluster_id)
+
+   def get_pattern(self, cluster_info, pattern_type, pattern_id):
+      """ Get a single pattern of the cluster, reading only the part of
+      the cluster info file that contains it.
+
+      - pattern_type: one of "popular", "anomalous", "isolated"
+      - pattern_id: number of the pattern in the cluster
+
+      Returns None if the pattern does not exist.
+      """
+      key = (cluster_info.id, pattern_type, pattern_id)
+      pattern = self.pattern_map.get(key)
+      if not pattern is None:
+         return pattern
+
+      offsets = self._get_pattern_offsets(cluster_info.id)
+      if offsets is None:
+         return None
+      data = offsets.read(pattern_type, pattern_id)
+      if data is None:
+         return None
+
+      pattern_list = parse_cluster_info(_text_stream(data))
+      if len(pattern_list) == 0:
+         return None
+      pattern = pattern_list[0]
+      self.pattern_map.put(key, pattern, len(data))
+      return pattern
+
+
+def _text_stream(data):
+   """ Stream of text lines from the bytes read from a file """
+   if sys.version_info[0] < 3:
+      return BytesIO(data)
+   else:
+      return StringIO(data.decode("utf-8"))
+
+
+class PatternOffsets(object):
+   """
+   Offsets of the patterns in a cluster info file (cluster_N_info.txt),
+   used to read a pattern without parsing the whole file.
+
+   The offsets are stored in the json file cluster_N_info.txt.offsets
+   and they are valid while the info file does not change (same size and
+   modification time).
+   """
+   SECTION_HEADER = re.compile(r"^(Popular|Anomalous|Isolated) Bins:")
+   PATTERN_HEADER = re.compile(r"^(Popular|Anomalous|Isolated) Bin # (\d+)")
+
+   def __init__(self, info_file, mtime, size, patterns):
+      self.info_file = info_file
+      self.mtime = mtime
+      self.size = size
+      # "type/id" -> [section header, start offset, end offset]
+      self.patterns = patterns
+
+   @staticmethod
+   def get_offsets_file(info_file):
+      return "%s.offsets" % info_file
+
+   @staticmethod
+   def get_key(pattern_type, pattern_id):
+      return "%s/%d" % (pattern_type.lower(), int(pattern_id))
+
+   @staticmethod
+   def build(info_file):
+      stat = os.stat(info_file)
+      patterns = {}
+      section = ""
+      current = None
+      offset = 0
+      with open(info_file, "rb") as f:
+         for line in f:
+            text_line = line.decode("utf-8", "replace")
+            section_match = PatternOffsets.SECTION_HEADER.match(text_line)
+            pattern_match = PatternOffsets.PATTERN_HEADER.match(text_line)
+            if (not section_match is None) or (not pattern_match is None):
+               if not current is None:
+                  current[2] = offset
+                  current = None
+            if not section_match is None:
+               section = text_line
+            elif not pattern_match is None:
+               key = PatternOffsets.get_key(pattern_match.group(1),
+                                            pattern_match.group(2))
+               current = [section, offset, None]
+               patterns[key] = current
+            offset += len(line)
+      if not current is None:
+         current[2] = offset
+
+      return PatternOffsets(info_file, stat.st_mtime, stat.st_size, patterns)
+
+   @staticmethod
+   def load(info_file):
+      """ Load the offsets of info_file, None if missing or stale """
+      offsets_file = PatternOffsets.get_offsets_file(info_file)
+      if not os.path.isfile(offsets_file):
+         return None
+      try:
+         with open(offsets_file, "r") as f:
+            data = json.load(f)
+      except (ValueError, EnvironmentError):
+         return None
+
+      stat = os.stat(info_file)
+      if data.get("mtime") != stat.st_mtime or data.get("size") != stat.st_size:
+         return None
+      return PatternOffsets(info_file, data["mtime"], data["size"],
+                            data["patterns"])
+
+   def write(self):
+      with open(PatternOffsets.get_offsets_file(self.info_file), "w") as f:
+         json.dump({"mtime" : self.mtime,
+                    "size" : self.size,
+                    "patterns" : self.patterns}, f)
+
+   def read(self, pattern_type, pattern_id):
+      """ Read the data of the pattern (with the header of its section) """
+      key = PatternOffsets.get_key(pattern_type, pattern_id)
+      if not key in self.patterns:
+         return None
+      (section, start, end) = self.patterns[key]
+      with open(self.info_file, "rb") as f:
+         f.seek(start)
+         data = f.read(end - start)
+      return section.encode("utf-8") + data
@@ -0,0 +1,422 @@
+"""
+Binary snapshot of the cluster index.
+
+The snapshot is written next to the clusters file and is opened with mmap,
+so that starting the search does not parse the clusters file and does not
+rebuild the index. The file is mapped read-only: processes forked by the
+service (or started on the same snapshot) share the same pages.
+
+The snapshot is valid for the clusters file it was created from: it
+stores the modification time, the size and the sha1 of the clusters file.
+
+The method names of the snapshot are the serialized form of a symbol
+table (see symbols.py): opened with the table of the process, the names
+are added to the table and the ids of the snapshot are mapped to the ids
+of the table, so the snapshot uses the same method ids of the other
+indexes of the process.
+
+Format (little endian):
+- header (see HEADER_FORMAT)
+- method names offsets: n_methods + 1 uint32
+- method names: the utf-8 names, sorted (the position is the method id)
+- postings offsets: n_methods + 1 uint32
+- postings: n_postings uint32, the sorted cluster positions of each method
+- cluster ids: n_clusters int32
+- cluster methods offsets: n_clusters + 1 uint32
+- cluster methods: n_cluster_methods uint32, the method ids of each
+  cluster in the order of the clusters file
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from fixrsearch.symbols import get_method_symbols
+
+MAGIC = b"FXCI"
+VERSION = 1
+
+# magic, version, mtime, size and sha1 of the clusters file,
+# n_methods, n_clusters, n_postings, n_cluster_methods, size of the names
+HEADER_FORMAT = "<4sIdQ20sIIIIQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# position and format of the mtime of the clusters file in the header
+MTIME_OFFSET = struct.calcsize("<4sI")
+MTIME_FORMAT = "<d"
+
+UINT_SIZE = 4
+
+
+def get_snapshot_file(cluster_file):
+  return "%s.snapshot" % cluster_file
+
+
+def _to_bytes(name):
+  if isinstance(name, bytes):
+    return name
+  return name.encode("utf-8")
+
+if sys.version_info[0] < 3:
+  def _from_bytes(name):
+    return name
+else:
+  def _from_bytes(name):
+    return name.decode("utf-8")
+
+
+def _file_digest(file_name):
+  digest = hashlib.sha1()
+  with open(file_name, "rb") as f:
+    while True:
+      data = f.read(1 << 20)
+      if not data:
+        break
+      digest.update(data)
+  return digest.digest()
+
+
+def _pack_uints(values):
+  return struct.pack("<%dI" % len(values), *values)
+
+
+class SnapshotClusterInfo(object):
+  """ Cluster read from the snapshot (same fields used from the
+  ClusterInfo of the clusters file)
+  """
+  def __init__(self, cluster_id, methods_list):
+    self.id = cluster_id
+    self.methods_list = methods_list
+
+
+class SnapshotMethodIds(object):
+  """ Map from method names to method ids (read-only dict view) """
+  def __init__(self, snapshot):
+    self._snapshot = snapshot
+
+  def __len__(self):
+    return self._snapshot.n_methods
+
+  def __iter__(self):
+    for local_id in range(self._snapshot.n_methods):
+      yield _from_bytes(self._snapshot.get_method_name(local_id))
+
+  def __contains__(self, method_name):
+    return self._snapshot.find_method(method_name) >= 0
+
+  def __getitem__(self, method_name):
+    local_id = self._snapshot.find_method(method_name)
+    if local_id < 0:
+      raise KeyError(method_name)
+    return self._snapshot.to_method_id(local_id)
+
+
+class SnapshotMethodNames(object):
+  """ Map from method ids to method names (read-only dict view) """
+  def __init__(self, snapshot):
+    self._snapshot = snapshot
+
+  def __len__(self):
+    return self._snapshot.n_methods
+
+  def __iter__(self):
+    for local_id in range(self._snapshot.n_methods):
+      yield self._snapshot.to_method_id(local_id)
+
+  def __contains__(self, method_id):
+    return self._snapshot.to_local_id(method_id) >= 0
+
+  def __getitem__(self, method_id):
+    local_id = self._snapshot.to_local_id(method_id)
+    if local_id < 0:
+      raise KeyError(method_id)
+    return _from_bytes(self._snapshot.get_method_name(local_id))
+
+
+class ClusterIndexSnapshot(object):
+  """ Read-only index of the clusters backed by the mmap of a snapshot
+
+  Exposes the same structures of the in-memory ClusterIndex: m2i, i2m
+  and the postings (get_all_with_k). The clusters are created lazily.
+
+  The method ids are the ones of symbols (a SymbolTable), or the
+  positions of the names in the snapshot if symbols is None.
+  """
+
+  def __init__(self, snapshot_map, symbols = None):
+    self._map = snapshot_map
+
+    (magic, version, self.mtime, self.size, self.digest,
+     self.n_methods, self.n_clusters, self.n_postings,
+     self.n_cluster_methods, names_size) = struct.unpack_from(HEADER_FORMAT,
+                                                              snapshot_map, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError("Not a cluster index snapshot (version %d)" % VERSION)
+
+    offset = HEADER_SIZE
+    self._names_offsets = offset
+    offset += (self.n_methods + 1) * UINT_SIZE
+    self._names = offset
+    offset += names_size
+    self._postings_offsets = offset
+    offset += (self.n_methods + 1) * UINT_SIZE
+    self._postings = offset
+    offset += self.n_postings * UINT_SIZE
+    self._cluster_ids = offset
+    offset += self.n_clusters * UINT_SIZE
+    self._cluster_methods_offsets = offset
+    offset += (self.n_clusters + 1) * UINT_SIZE
+    self._cluster_methods = offset
+    offset += self.n_cluster_methods * UINT_SIZE
+
+    if offset != len(snapshot_map):
+      raise ValueError("Truncated cluster index snapshot")
+
+    self.m2i = SnapshotMethodIds(self)
+    self.i2m = SnapshotMethodNames(self)
+    self._clusters = {}
+
+    # id in the snapshot -> method id, and back (None if the ids are the
+    # same, e.g. when the snapshot fills an empty table)
+    self._remap = None
+    self._local_ids = None
+    if not symbols is None:
+      self._set_symbols(symbols)
+
+  def _set_symbols(self, symbols):
+    """ Use the method ids of symbols, adding the names to the table """
+    remap = symbols.get_remap([_from_bytes(self.get_method_name(i))
+                               for i in range(self.n_methods)])
+    if any(remap[i] != i for i in range(self.n_methods)):
+      self._remap = remap
+      self._local_ids = dict((method_id, local_id)
+                             for (local_id, method_id) in enumerate(remap))
+
+  def to_method_id(self, local_id):
+    """ Method id of the id of a name in the snapshot """
+    if self._remap is None:
+      return local_id
+    return self._remap[local_id]
+
+  def to_local_id(self, method_id):
+    """ Id in the snapshot of a method id, -1 if not in the snapshot """
+    if self._local_ids is None:
+      if 0 <= method_id < self.n_methods:
+        return method_id
+      return -1
+    return self._local_ids.get(method_id, -1)
+
+  def _get_uint(self, base, index):
+    return struct.unpack_from("<I", self._map, base + index * UINT_SIZE)[0]
+
+  def _get_uints(self, base, start, end):
+    return struct.unpack_from("<%dI" % (end - start), self._map,
+                              base + start * UINT_SIZE)
+
+  def get_method_name(self, method_id):
+    (start, end) = self._get_uints(self._names_offsets,
+                                   method_id, method_id + 2)
+    return self._map[self._names + start:self._names + end]
+
+  def find_method(self, method_name):
+    """ Binary search of the method name, returns -1 if not found """
+    key = _to_bytes(method_name)
+    low = 0
+    high = self.n_methods - 1
+    while low <= high:
+      idx = (low + high) // 2
+      current = self.get_method_name(idx)
+      if current == key:
+        return idx
+      elif key < current:
+        high = idx - 1
+      else:
+        low = idx + 1
+    return -1
+
+  def get_cluster(self, position):
+    if position in self._clusters:
+      return self._clusters[position]
+
+    cluster_id = struct.unpack_from("<i", self._map,
+                                    self._cluster_ids +
+                                    position * UINT_SIZE)[0]
+    (start, end) = self._get_uints(self._cluster_methods_offsets,
+                                   position, position + 2)
+    method_ids = self._get_uints(self._cluster_methods, start, end)
+    # share the names of the methods in the process
+    symbols = get_method_symbols()
+    methods_list = [symbols.canonical(_from_bytes(self.get_method_name(m)))
+                    for m in method_ids]
+
+    cluster = SnapshotClusterInfo(cluster_id, methods_list)
+    self._clusters[position] = cluster
+    return cluster
+
+  def get_clusters(self):
+    return [self.get_cluster(p) for p in range(self.n_clusters)]
+
+  def get_postings(self, method_id):
+    local_id = self.to_local_id(method_id)
+    if local_id < 0:
+      return ()
+    (start, end) = self._get_uints(self._postings_offsets,
+                                   local_id, local_id + 2)
+    return self._get_uints(self._postings, start, end)
+
+  def get_overlaps(self, int_list, k):
+    """ Same as PostingsIndex.get_overlaps """
+    counts = {}
+    for method_id in int_list:
+      for position in self.get_postings(method_id):
+        counts[position] = counts.get(position, 0) + 1
+
+    if k <= 0:
+      return [(self.get_cluster(position), counts.get(position, 0))
+              for position in range(self.n_clusters)]
+
+    return [(self.get_cluster(position), count)
+            for position, count in counts.items() if count >= k]
+
+  def get_all_with_k(self, int_list, k):
+    return [cluster for (cluster, count) in self.get_overlaps(int_list, k)]
+
+  def get_overlaps_batch(self, int_lists, k):
+    """ Same as PostingsIndex.get_overlaps_batch """
+    method_to_lists = {}
+    for (list_position, int_list) in enumerate(int_lists):
+      for method_id in set(int_list):
+        method_to_lists.setdefault(method_id, []).append(list_position)
+
+    all_counts = [{} for int_list in int_lists]
+    for (method_id, list_positions) in method_to_lists.items():
+      for position in self.get_postings(method_id):
+        for list_position in list_positions:
+          counts = all_counts[list_position]
+          counts[position] = counts.get(position, 0) + 1
+
+    results = []
+    for counts in all_counts:
+      if k <= 0:
+        results.append([(self.get_cluster(position), counts.get(position, 0))
+                        for position in range(self.n_clusters)])
+      else:
+        results.append([(self.get_cluster(position), count)
+                        for position, count in counts.items() if count >= k])
+    return results
+
+  @staticmethod
+  def open(snapshot_file, cluster_file, symbols = None):
+    """ Open the snapshot of cluster_file, using the method ids of
+    symbols (see ClusterIndexSnapshot).
+
+    Returns None if the snapshot does not exist or it is not valid for
+    the current cluster_file.
+    """
+    if not os.path.isfile(snapshot_file):
+      return None
+
+    try:
+      with open(snapshot_file, "rb") as f:
+        snapshot_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      snapshot = ClusterIndexSnapshot(snapshot_map)
+    except (ValueError, EnvironmentError, struct.error) as e:
+      logging.info("Cannot read the snapshot %s (%s)" % (snapshot_file,
+                                                         str(e)))
+      return None
+
+    stat = os.stat(cluster_file)
+    if stat.st_size != snapshot.size:
+      logging.info("Snapshot %s is stale" % snapshot_file)
+      return None
+    if stat.st_mtime != snapshot.mtime:
+      if _file_digest(cluster_file) != snapshot.digest:
+        # the file was modified (touching it only changes the mtime)
+        logging.info("Snapshot %s is stale" % snapshot_file)
+        return None
+      # the file was only touched: store the new mtime, so the file is
+      # not hashed again at the next start
+      ClusterIndexSnapshot._update_mtime(snapshot_file, stat.st_mtime)
+      snapshot.mtime = stat.st_mtime
+
+    if not symbols is None:
+      snapshot._set_symbols(symbols)
+    return snapshot
+
+  @staticmethod
+  def _update_mtime(snapshot_file, mtime):
+    try:
+      with open(snapshot_file, "r+b") as f:
+        f.seek(MTIME_OFFSET)
+        f.write(struct.pack(MTIME_FORMAT, mtime))
+    except EnvironmentError as e:
+      logging.info("Cannot update the snapshot %s (%s)" % (snapshot_file,
+                                                          str(e)))
+
+  @staticmethod
+  def write(snapshot_file, cluster_file, cluster_infos):
+    """ Write the snapshot for the clusters in cluster_infos, parsed
+    from cluster_file.
+
+    The snapshot is first written in a temporary file and then renamed,
+    so a process never reads a partial snapshot.
+    """
+    stat = os.stat(cluster_file)
+    digest = _file_digest(cluster_file)
+
+    names = set()
+    for ci in cluster_infos:
+      for m in ci.methods_list:
+        names.add(_to_bytes(m))
+    names = sorted(names)
+    m2i = {}
+    for name in names:
+      m2i[name] = len(m2i)
+
+    names_offsets = [0]
+    for name in names:
+      names_offsets.append(names_offsets[-1] + len(name))
+
+    postings = [[] for name in names]
+    cluster_ids = []
+    cluster_methods_offsets = [0]
+    cluster_methods = []
+    for (position, ci) in enumerate(cluster_infos):
+      method_ids = [m2i[_to_bytes(m)] for m in ci.methods_list]
+      for method_id in set(method_ids):
+        postings[method_id].append(position)
+      cluster_ids.append(int(ci.id))
+      cluster_methods.extend(method_ids)
+      cluster_methods_offsets.append(len(cluster_methods))
+
+    postings_offsets = [0]
+    all_postings = []
+    for method_postings in postings:
+      all_postings.extend(method_postings)
+      postings_offsets.append(len(all_postings))
+
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION,
+                         stat.st_mtime, stat.st_size, digest,
+                         len(names), len(cluster_infos), len(all_postings),
+                         len(cluster_methods), names_offsets[-1])
+
+    snapshot_dir = os.path.dirname(os.path.abspath(snapshot_file))
+    (fd, tmp_file) = tempfile.mkstemp(prefix=".snapshot", dir=snapshot_dir)
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.write(header)
+        f.write(_pack_uints(names_offsets))
+        f.write(b"".join(names))
+        f.write(_pack_uints(postings_offsets))
+        f.write(_pack_uints(all_postings))
+        f.write(struct.pack("<%di" % len(cluster_ids), *cluster_ids))
+        f.write(_pack_uints(cluster_methods_offsets))
+        f.write(_pack_uints(cluster_methods))
+      os.rename(tmp_file, snapshot_file)
+    except:
+      if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+      raise
@@ -2,6 +2,7 @@
 Implement the logic that process a pull request
 """
 
+import collections
 import logging
 import StringIO
 
@@ -22,27 +23,133 @@ from src_service_client import (
   DiffEntry, SourceDiff
 )
 
+# number of digests whose search results are kept by the service (see
+# PrProcessor)
+DIGEST_RESULTS_ENTRIES = 1000
+
 class PrProcessor:
-  def __init__(self, groum_index, search, src_client):
+  def __init__(self, groum_index, search, src_client, index_lock = None,
+               digest_results = None):
     """ Here the groum index is the index where to find the
     current repository's graphs (not the graphs used for the search).
+
+    If index_lock is not None, the groum index is read holding the lock
+    (e.g., the lock of the GraphWatcher updating the index).
+
+    digest_results is None or a cache (e.g., a LRUCache shared by the
+    processors of the service) from the digest of a groum to its search
+    results: the groums with a digest in the cache are not searched
+    again (e.g., the methods not changed by a new commit of the pull
+    request).
     """
     self.groum_index = groum_index
+    self.index_lock = index_lock
+    self.digest_results = digest_results
     self.search = search
     self.src_client = src_client
+    # pairs (groum key, cluster id) not searched in the last processing
+    # (the budget of the search was over)
+    self.unsearched = []
 
   def process_graphs_from_commit(self,
                                  commit_ref_search = None,
                                  pull_request_ref = None,
-                                 src_on_disk = None):
+                                 src_on_disk = None,
+                                 budget = None):
     """ Process all the graphs produced in the pull request creating the
     anomalies.
 
+    budget is the SearchBudget of all the searches (None for no budget),
+    the clusters not searched are stored in self.unsearched.
+
     Side effect on the internal database
 
     Return the list of anomalies created for all the graphs.
     """
     anomalies = []
+    self.unsearched = []
+    if self.index_lock is None:
+      (tot_groums, groums_to_search) = self._get_groums_to_search(
+        commit_ref_search)
+    else:
+      with self.index_lock:
+        (tot_groums, groums_to_search) = self._get_groums_to_search(
+          commit_ref_search)
+
+    # The groums with the same content are searched once and the results
+    # are used for all of them (and kept in digest_results for the
+    # groums with the same digest processed later)
+    units = collections.OrderedDict()
+    for (groum_record, groum_file, digest) in groums_to_search:
+      groum_key = groum_record["groum_key"]
+      unit_key = groum_key if digest is None else (digest,)
+      units.setdefault(unit_key, []).append((groum_record, groum_file))
+    units = list(units.items())
+    logging.info("Found %d distinct groums to search." % (len(units)))
+
+    # The results of the digests already searched
+    units_results = []
+    for (unit_key, unit) in units:
+      results = None
+      if isinstance(unit_key, tuple) and not self.digest_results is None:
+        results = self.digest_results.get(unit_key[0])
+      units_results.append(results)
+    to_search = [unit[0][1] for ((unit_key, unit), results)
+                 in zip(units, units_results) if results is None]
+    logging.info("Found the results of %d groums searched before." %
+                 (len(units) - len(to_search)))
+
+    # Find the clusters of all the groums to search at once
+    units_clusters = iter(self.search.get_clusters_batch(to_search))
+
+    groum_count = 0
+    for ((unit_key, unit), results) in zip(units, units_results):
+      if results is None:
+        # Search for anomalies
+        logging.info("Searching groum %d/%d" % (groum_count + 1,
+                                                tot_groums))
+        n_unsearched = 0 if budget is None else len(budget.unsearched)
+        results = self.search.search_from_groum(unit[0][1], True,
+                                                clusters = next(units_clusters),
+                                                budget = budget)
+        complete = True
+        if not budget is None:
+          for (groum_path, cluster_id) in budget.unsearched[n_unsearched:]:
+            complete = False
+            for (groum_record, groum_file) in unit:
+              self.unsearched.append((groum_record["groum_key"], cluster_id))
+        # the results are the same for all the groums with the digest
+        if (complete and isinstance(unit_key, tuple) and
+            not self.digest_results is None):
+          self.digest_results.put(unit_key[0], results)
+
+      for (groum_record, groum_file) in unit:
+        groum_count = groum_count + 1
+        logging.info("Processing groum %d/%d" % (groum_count, tot_groums))
+        anomalies += self._get_anomalies(groum_record, results,
+                                         pull_request_ref, src_on_disk)
+
+    # sort the anomalies
+    sorted_anomalies = sorted(anomalies, key = lambda pair : pair[0],
+                              reverse=False)
+    anomaly_out = []
+    anomaly_id = 0
+    for (score, anomaly) in sorted_anomalies:
+        anomaly_id += 1
+        anomaly.numeric_id = anomaly_id
+        anomaly_out.append(anomaly)
+
+    logging.info("Found %s anomalies." % (len(anomaly_out)))
+
+    return anomaly_out
+
+  def _get_groums_to_search(self, commit_ref_search):
+    """ Read the groums of the commit (all the groums if
+    commit_ref_search is None) from the groum index.
+
+    Returns the pair (number of groums, list of the triples (groum
+    record, groum file, digest) of the groums with a file).
+    """
     if commit_ref_search is None:
       groum_records = self.groum_index.get_all_groums()
     else:
@@ -52,13 +159,11 @@ class PrProcessor:
                                            commit_ref_search.commit_hash)
       groum_records = self.groum_index.get_groums(app_key)
 
-    groum_count = 0
     tot_groums = len(groum_records)
     logging.info("Found %d groums to process." % (tot_groums))
-    for groum_record in groum_records:
-      groum_count = groum_count + 1
-      logging.info("Processing groum %d/%d" % (groum_count, tot_groums))
 
+    groums_to_search = []
+    for groum_record in groum_records:
       groum_key = groum_record["groum_key"]
       groum_file = self.groum_index.get_groum_path(groum_key)
 
@@ -67,69 +172,62 @@ class PrProcessor:
                     "Skipping the groum... " % (groum_key, groum_file)
         logging.debug(error_msg)
         continue
+      digest = self.groum_index.get_groum_digest(groum_key)
+      groums_to_search.append((groum_record, groum_file, digest))
+    return (tot_groums, groums_to_search)
 
-      groum_record_repo = groum_record["repo"]
-      commit_ref = CommitRef(RepoRef(groum_record_repo["repo_name"],
-                                     groum_record_repo["user_name"]),
-                             groum_record_repo["commit_hash"])
-
-      method_ref = MethodRef(commit_ref,
-                             groum_record["class_name"],
-                             groum_record["package_name"],
-                             groum_record["method_name"],
-                             groum_record["method_line_number"],
-                             groum_record["source_class_name"])
-
-      # Search for anomalies
-      logging.info("Searching groum %d/%d" % (groum_count, tot_groums))
-      results = self.search.search_from_groum(groum_file, True)
-      for cluster_res in results:
-        assert "cluster_info" in cluster_res
-        cluster_info = cluster_res["cluster_info"]
-        assert "id" in cluster_info and "methods_list" in cluster_info
-
-        method_list = ClusterRef.build_methods_str(cluster_info["methods_list"])
-        cluster_ref = ClusterRef(cluster_info["id"], method_list)
-
-        for search_res in cluster_res["search_results"]:
-          # TODO: Test, skip for now
-          if (search_res["type"] != "ANOMALOUS_SUBSUMED" and
-              search_res["type"] != "CORRECT_SUBSUMED"):
-            continue
-
-          # 0. Get the popular bin
-          bin_res = search_res["popular"]
-          bin_res_field = ["type", "acdfg_mappings", "frequency",
-                           "cardinality", "id"]
-          for i in bin_res_field: assert i in bin_res
-          assert bin_res["type"] == "popular"
-
-          anomaly = PrProcessor._process_search_res(self.src_client,
-                                                    method_ref,
-                                                    cluster_ref,
-                                                    bin_res,
-                                                    pull_request_ref,
-                                                    src_on_disk = src_on_disk)
-
-          # insert the frequency to sort the anomalies
-          anomalies.append((bin_res["frequency"], anomaly))
-
-
-    # sort the anomalies
-    sorted_anomalies = sorted(anomalies, key = lambda pair : pair[0],
-                              reverse=False)
-    anomaly_out = []
-    anomaly_id = 0
-    for (score, anomaly) in sorted_anomalies:
-        anomaly_id += 1
-        anomaly.numeric_id = anomaly_id
-        anomaly_out.append(anomaly)
-
-    logging.info("Found %s anomalies." % (len(anomaly_out)))
+  def _get_anomalies(self, groum_record, results,
+                     pull_request_ref, src_on_disk):
+    """ Create the anomalies of the groum from the search results.
 
-    return anomaly_out
+    Returns the list of pairs (frequency, anomaly).
+    """
+    groum_record_repo = groum_record["repo"]
+    commit_ref = CommitRef(RepoRef(groum_record_repo["repo_name"],
+                                   groum_record_repo["user_name"]),
+                           groum_record_repo["commit_hash"])
+
+    method_ref = MethodRef(commit_ref,
+                           groum_record["class_name"],
+                           groum_record["package_name"],
+                           groum_record["method_name"],
+                           groum_record["method_line_number"],
+                           groum_record["source_class_name"])
 
-  def process_graphs_from_pr(self, pull_request_ref):
+    anomalies = []
+    for cluster_res in results:
+      assert "cluster_info" in cluster_res
+      cluster_info = cluster_res["cluster_info"]
+      assert "id" in cluster_info and "methods_list" in cluster_info
+
+      method_list = ClusterRef.build_methods_str(cluster_info["methods_list"])
+      cluster_ref = ClusterRef(cluster_info["id"], method_list)
+
+      for search_res in cluster_res["search_results"]:
+        # TODO: Test, skip for now
+        if (search_res["type"] != "ANOMALOUS_SUBSUMED" and
+            search_res["type"] != "CORRECT_SUBSUMED"):
+          continue
+
+        # 0. Get the popular bin
+        bin_res = search_res["popular"]
+        bin_res_field = ["type", "acdfg_mappings", "frequency",
+                         "cardinality", "id"]
+        for i in bin_res_field: assert i in bin_res
+        assert bin_res["type"] == "popular"
+
+        anomaly = PrProcessor._process_search_res(self.src_client,
+                                                  method_ref,
+                                                  cluster_ref,
+                                                  bin_res,
+                                                  pull_request_ref,
+                                                  src_on_disk = src_on_disk)
+
+        # insert the frequency to sort the anomalies
+        anomalies.append((bin_res["frequency"], anomaly))
+    return anomalies
+
+  def process_graphs_from_pr(self, pull_request_ref, budget = None):
     """ Process all the graphs produced in the pull request creating the
     anomalies.
 
@@ -138,7 +236,8 @@ class PrProcessor:
     Return the list of anomalies created for all the graphs.
     """
     return self.process_graphs_from_commit(pull_request_ref.commit_ref,
-                                           pull_request_ref)
+                                           pull_request_ref,
+                                           budget = budget)
 
   @staticmethod
   def _process_search_res(src_client,
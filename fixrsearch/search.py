@@ -8,12 +8,14 @@ import optparse
 import logging
 import json
 import tempfile
-from threading import Timer
-from subprocess import Popen, PIPE
+import time
+from threading import Lock
+from multiprocessing.pool import ThreadPool
 import re
 import tempfile
 
 from fixrsearch.index import ClusterIndex
+from fixrsearch.search_backend import ProcessSearchBackend, SEARCH_TIMEOUT
 from fixrsearch.groum_index import GroumIndex
 from fixrgraph.annotator.protobuf.proto_acdfg_pb2 import Acdfg
 
@@ -73,30 +75,38 @@ class DuplicateMap():
     total = 0
     new = 0
     for cluster_res in results:
-      assert "cluster_info" in cluster_res
-      cluster_id = cluster_res["cluster_info"]["id"]
-
-      added = {}
-      added["cluster_info"] = cluster_res["cluster_info"]
-
-      added["search_results"] = []
+      added = self.remove_cluster_duplicates(cluster_res, visited_id)
       new_results.append(added)
-      for elem in cluster_res["search_results"]:
-        total += 1
-        bin_res = elem["popular"]
-        bin_id = int(bin_res["id"])
-        pattern_id = (cluster_id, bin_id)
-
-        if not pattern_id in visited_id:
-          visited = self.find_set(pattern_id)
-          visited_id.update(visited)
-          added["search_results"].append(elem)
-          new += 1
+      total += len(cluster_res["search_results"])
+      new += len(added["search_results"])
 
     logging.info("Filtering from %d to %d" % (total,new))
 
     return new_results
 
+  def remove_cluster_duplicates(self, cluster_res, visited_id):
+    """ Remove from the results of a cluster the patterns in visited_id
+    (the patterns already seen), adding the new patterns to visited_id.
+    """
+    assert "cluster_info" in cluster_res
+    cluster_id = cluster_res["cluster_info"]["id"]
+
+    added = {}
+    added["cluster_info"] = cluster_res["cluster_info"]
+
+    added["search_results"] = []
+    for elem in cluster_res["search_results"]:
+      bin_res = elem["popular"]
+      bin_id = int(bin_res["id"])
+      pattern_id = (cluster_id, bin_id)
+
+      if not pattern_id in visited_id:
+        visited = self.find_set(pattern_id)
+        visited_id.update(visited)
+        added["search_results"].append(elem)
+
+    return added
+
 
 class PatternFilters:
 
@@ -146,12 +156,124 @@ class PatternFilters:
             pattern_id in self.blacklist[cluster_id])
 
 
+class ClusterRanker:
+  """
+  Scores the clusters found for a groum to decide which ones to search
+  first (and which ones to skip).
+
+  The score of a cluster is in [0,1] and combines:
+  - the overlap ratio: fraction of the methods of the cluster that are
+    also in the groum
+  - the size of the cluster (number of methods), relative to the largest
+    candidate cluster: bigger clusters describe more specific patterns
+  - the hit rate of the cluster: fraction of the past searches in the
+    cluster that found some result (a cluster never searched has 0.5)
+
+  The ranker keeps the hit rate of the searches, so the same ranker
+  should be shared by all the searches (e.g., in the service).
+  """
+  OVERLAP_WEIGHT = 0.6
+  SIZE_WEIGHT = 0.2
+  HIT_RATE_WEIGHT = 0.2
+
+  def __init__(self):
+    self.lock = Lock()
+    # cluster id -> (number of searches, number of searches with results)
+    self.history = {}
+
+  def record(self, cluster_id, found):
+    with self.lock:
+      (searches, hits) = self.history.get(cluster_id, (0, 0))
+      self.history[cluster_id] = (searches + 1, hits + 1 if found else hits)
+
+  def get_hit_rate(self, cluster_id):
+    with self.lock:
+      entry = self.history.get(cluster_id, (0, 0))
+    return ClusterRanker._get_hit_rate(entry)
+
+  @staticmethod
+  def _get_hit_rate(entry):
+    (searches, hits) = entry
+    # Laplace smoothing
+    return (hits + 1.0) / (searches + 2.0)
+
+  def rank(self, clusters_overlaps):
+    """
+    Sort the clusters by decreasing score.
+
+    clusters_overlaps is a list of pairs (cluster, number of methods in
+    common with the groum).
+
+    Returns a list of pairs (cluster, score).
+    """
+    sizes = [len(set(c.methods_list)) for (c, overlap) in clusters_overlaps]
+    max_size = float(max(sizes)) if len(sizes) > 0 else 1.0
+    # all the scores use the same history
+    with self.lock:
+      history = dict([(c.id, self.history.get(c.id, (0, 0)))
+                      for (c, overlap) in clusters_overlaps])
+
+    ranked = []
+    for ((cluster_info, overlap), size) in zip(clusters_overlaps, sizes):
+      overlap_ratio = float(overlap) / size if size > 0 else 0.0
+      size_score = size / max_size if max_size > 0 else 0.0
+      score = (ClusterRanker.OVERLAP_WEIGHT * overlap_ratio +
+               ClusterRanker.SIZE_WEIGHT * size_score +
+               ClusterRanker.HIT_RATE_WEIGHT *
+               ClusterRanker._get_hit_rate(history[cluster_info.id]))
+      ranked.append((cluster_info, score))
+
+    return sorted(ranked, key=lambda pair: (-pair[1], pair[0].id))
+
+
+class SearchBudget():
+  """
+  Time budget of a request (e.g., the search of a groum or of all the
+  groums of a pull request).
+
+  The searches started when the budget is over are not run, and the
+  running searches are stopped at the deadline. The clusters not
+  searched (or stopped) are kept in unsearched as pairs (groum path,
+  cluster id): the results of the request are partial if some cluster
+  was not searched.
+  """
+
+  def __init__(self, seconds):
+    self.seconds = seconds
+    self.deadline = time.time() + seconds
+    self.lock = Lock()
+    self.unsearched = []
+
+  def get_remaining(self):
+    return max(0.0, self.deadline - time.time())
+
+  def is_over(self):
+    return self.get_remaining() <= 0
+
+  def get_timeout(self, timeout):
+    """ Timeout of a search started now """
+    return min(timeout, self.get_remaining())
+
+  def add_unsearched(self, groum_path, cluster_id):
+    with self.lock:
+      self.unsearched.append((groum_path, cluster_id))
+
+  def is_partial(self):
+    return len(self.unsearched) > 0
+
+
 class Search():
   def __init__(self, cluster_path, search_lattice_path,
                index = None, groum_index = None,
                timeout=10, min_methods_in_common = 1,
                avoid_duplicates = True,
-               use_blacklist = True):
+               use_blacklist = True,
+               index_type = ClusterIndex.POSTINGS,
+               ranker = None,
+               max_clusters = None,
+               min_score = None,
+               max_workers = 1,
+               backend = None):
     """
     Constructs the search object:
 
@@ -164,6 +286,17 @@ class Search():
     - avoid_duplicates: avoids the duplicate patterns (need to build the
       duplicate clusters
     - use_blacklist: use the list of blacklisted cluster/patterns
+    - index_type: data structure used by the cluster index (used only
+      when index is None, see ClusterIndex)
+    - ranker: ClusterRanker used to sort the clusters (a new one if None)
+    - max_clusters: maximum number of clusters searched for a groum (the
+      ones with the highest score), None for no limit
+    - min_score: do not search the clusters with a score lower than
+      min_score, None for no limit
+    - max_workers: number of clusters of a groum searched at the same
+      time (each search runs its own searchlattice process)
+    - backend: SearchBackend running searchlattice (a new
+      ProcessSearchBackend if None)
     """
     self.cluster_path = cluster_path
     self.search_lattice_path = search_lattice_path
@@ -172,11 +305,19 @@ class Search():
     self.min_methods_in_common = min_methods_in_common
     self.avoid_duplicates = avoid_duplicates
     self.use_blacklist = use_blacklist
+    self.ranker = ClusterRanker() if ranker is None else ranker
+    self.max_clusters = max_clusters
+    self.min_score = min_score
+    self.max_workers = max_workers
+    if backend is None:
+      self.backend = ProcessSearchBackend(search_lattice_path)
+    else:
+      self.backend = backend
 
     # 1. Build the index
     if (index is None):
       cluster_file = get_cluster_file(cluster_path)
-      self.index = ClusterIndex(cluster_file)
+      self.index = ClusterIndex(cluster_file, index_type)
     else:
       self.index = index
 
@@ -190,8 +331,8 @@ class Search():
     else:
       self.blacklist = PatternFilters()
 
-  def _get_clusters(self, groum_path):
-    # 1. Get the method list from the GROUM
+  def _get_method_list(self, groum_path):
+    """ Get the method list from the GROUM """
     acdfg = Acdfg()
     with open(groum_path,'rb') as fgroum:
       acdfg.ParseFromString(fgroum.read())
@@ -212,25 +353,58 @@ class Search():
                            "XOR"}:
           method_list.append(std_str)
       fgroum.close()
+    return method_list
+
+  def _get_clusters(self, groum_path):
+    # 1. Get the method list from the GROUM
+    method_list = self._get_method_list(groum_path)
 
     # 2. Search the clusters
-    clusters = self.index.get_clusters(method_list, self.min_methods_in_common)
+    clusters_overlaps = self.index.get_clusters_overlaps(
+      method_list, self.min_methods_in_common)
+
+    # 3. Rank the clusters
+    return self._rank_clusters(method_list, clusters_overlaps)
+
+  def get_clusters_batch(self, groum_paths):
+    """
+    Find the (ranked) clusters to search for each groum in groum_paths,
+    looking up the clusters of all the groums at once.
 
+    Returns a list with the clusters of each groum, to be passed to
+    search_from_groum.
+    """
+    method_lists = [self._get_method_list(groum_path)
+                    for groum_path in groum_paths]
+    overlaps_lists = self.index.get_clusters_overlaps_batch(
+      method_lists, self.min_methods_in_common)
+    return [self._rank_clusters(method_list, clusters_overlaps)
+            for (method_list, clusters_overlaps)
+            in zip(method_lists, overlaps_lists)]
+
+  def _rank_clusters(self, method_list, clusters_overlaps):
     new_clusters = []
-    for cluster_info in clusters:
+    for (cluster_info, score) in self.ranker.rank(clusters_overlaps):
+      if (not self.min_score is None) and score < self.min_score:
+        logging.debug("Skipping cluster %s (score %f)" % (cluster_info.id,
+                                                          score))
+        continue
       new_clusters.append(cluster_info)
 
     logging.debug("Keys: %s" %
                   ",".join([str(method_name) for method_name in method_list]))
 
     logging.debug("Found clusters: %s" %
-                  ",".join([str(cluster_info.id) for cluster_info in clusters]))
+                  ",".join([str(cluster_info.id)
+                            for cluster_info in new_clusters]))
 
     return new_clusters
 
   def search_from_groum(self, groum_path,
                         filter_for_bugs = False,
-                        filter_cluster = None):
+                        filter_cluster = None,
+                        clusters = None,
+                        budget = None):
     """
     Searching patterns that are similar to the groum in groum_path.
 
@@ -238,40 +412,26 @@ class Search():
     - filter_for_bugs: If true only return anomalous_subsumed or correct_subsumed patterns.
     That'is, it returns the pattern that entirely contains the groum.
     - filter_cluster: id of clusters to NOT consider in the search
+    - clusters: clusters of the groum (see get_clusters_batch), found
+    from the groum if None
+    - budget: SearchBudget of the request (None for no budget). The
+    clusters are searched from the best ranked one: the ones not
+    searched when the budget is over are added to the budget.
     """
     logging.info("Search for groum %s" % groum_path)
 
-    # 1. Search the clusters
-    clusters = self._get_clusters(groum_path)
+    # 1. Select the clusters to search
+    to_search = self._select_clusters(groum_path, filter_cluster, clusters)
 
     # 2. Search the clusters
     results = []
-    for cluster_info in clusters:
-      logging.debug("Searching in cluster %d (%s)..." % (cluster_info.id,
-                                                         ",".join(cluster_info.methods_list)))
-
-      if ((not filter_cluster is None) and
-          (not cluster_info.id in filter_cluster)):
-        logging.debug("Filtered out cluster %s", cluster_info.id)
-        continue
-
-      if  (self.blacklist.has_all_cluster(int(cluster_info.id))):
-        logging.debug("Skipping blacklisted cluster %s....", cluster_info.id)
-        continue
-
-      results_cluster = self.search_cluster(groum_path, cluster_info,
-                                            filter_for_bugs)
-      if results_cluster is None:
-        logging.debug("Found 0 in cluster %d..." % cluster_info.id)
-      else:
-        logging.debug("Found %d in cluster %d..." % (len(results_cluster),
-                                                     cluster_info.id))
-        cluster_info_map = {}
-        cluster_info_map["id"] = cluster_info.id
-        cluster_info_map["methods_list"] = [n for n in
-                                            cluster_info.methods_list]
-        results_cluster["cluster_info"] = cluster_info_map
-
+    for (cluster_info, searched, results_cluster) in \
+        self._iter_search_clusters(groum_path, to_search, filter_for_bugs,
+                                   budget, True):
+      results_cluster = self._get_cluster_results(groum_path, cluster_info,
+                                                  searched, results_cluster,
+                                                  budget)
+      if not results_cluster is None:
         results.append(results_cluster)
 
     # 3. sort results by popularity
@@ -293,11 +453,163 @@ class Search():
 
     return results
 
+  def iter_search_from_groum(self, groum_path,
+                             filter_for_bugs = False,
+                             filter_cluster = None,
+                             clusters = None,
+                             budget = None):
+    """
+    Same as search_from_groum, but yields the results of each cluster as
+    soon as its search ends (so the results are not sorted by
+    popularity).
+
+    The duplicate patterns are removed incrementally: a pattern is
+    removed if it duplicates a pattern already yielded.
+    """
+    logging.info("Search for groum %s" % groum_path)
+
+    to_search = self._select_clusters(groum_path, filter_cluster, clusters)
+
+    visited_id = {}
+    for (cluster_info, searched, results_cluster) in \
+        self._iter_search_clusters(groum_path, to_search, filter_for_bugs,
+                                   budget, False):
+      results_cluster = self._get_cluster_results(groum_path, cluster_info,
+                                                  searched, results_cluster,
+                                                  budget)
+      if results_cluster is None:
+        continue
+      if not self.duplicate_map is None:
+        results_cluster = self.duplicate_map.remove_cluster_duplicates(
+          results_cluster, visited_id)
+      yield results_cluster
+
+  def _select_clusters(self, groum_path, filter_cluster, clusters):
+    """ Select the clusters to search for the groum """
+    # Search the clusters (sorted by score)
+    if clusters is None:
+      clusters = self._get_clusters(groum_path)
+
+    to_search = []
+    for cluster_info in clusters:
+      if ((not self.max_clusters is None) and
+          len(to_search) >= self.max_clusters):
+        logging.debug("Searched the first %d clusters, skipping the " \
+                      "others" % self.max_clusters)
+        break
+
+      logging.debug("Searching in cluster %d (%s)..." % (cluster_info.id,
+                                                         ",".join(cluster_info.methods_list)))
+
+      if ((not filter_cluster is None) and
+          (not cluster_info.id in filter_cluster)):
+        logging.debug("Filtered out cluster %s", cluster_info.id)
+        continue
+
+      if  (self.blacklist.has_all_cluster(int(cluster_info.id))):
+        logging.debug("Skipping blacklisted cluster %s....", cluster_info.id)
+        continue
+
+      to_search.append(cluster_info)
+    return to_search
+
+  def _get_cluster_results(self, groum_path, cluster_info, searched,
+                           results_cluster, budget):
+    """ Record the search of a cluster and add the cluster info to its
+    results.
+
+    Returns None if the cluster was not searched or it has no results.
+    """
+    if not searched:
+      logging.debug("Cluster %d not searched (budget over)" %
+                    cluster_info.id)
+      budget.add_unsearched(groum_path, cluster_info.id)
+      return None
+
+    self.ranker.record(cluster_info.id, not results_cluster is None)
+    if results_cluster is None:
+      logging.debug("Found 0 in cluster %d..." % cluster_info.id)
+      return None
+
+    logging.debug("Found %d in cluster %d..." % (len(results_cluster),
+                                                 cluster_info.id))
+    cluster_info_map = {}
+    cluster_info_map["id"] = cluster_info.id
+    cluster_info_map["methods_list"] = [n for n in
+                                        cluster_info.methods_list]
+    results_cluster["cluster_info"] = cluster_info_map
+    return results_cluster
+
+  def _iter_search_clusters(self, groum_path, clusters, filter_for_bugs,
+                            budget = None, ordered = True):
+    """
+    Search the groum in all the clusters, using up to max_workers
+    threads. The searches start in the order of clusters.
+
+    Yields the triples (cluster, searched, results) of each cluster,
+    where searched is False if the budget was over before the start of
+    the search or if the search was stopped at its timeout (only with a
+    budget). The triples are in the order of clusters if ordered is True,
+    in the order of the end of the searches otherwise.
+    """
+    def search_job(cluster_info):
+      if budget is None:
+        result = self._search_cluster_isolated(groum_path, cluster_info,
+                                               filter_for_bugs,
+                                               self.timeout)
+        # without a budget, a search stopped at the timeout has no results
+        if result is SEARCH_TIMEOUT:
+          result = None
+        return (cluster_info, True, result)
+      if budget.is_over():
+        return (cluster_info, False, None)
+      result = self._search_cluster_isolated(groum_path, cluster_info,
+                                             filter_for_bugs,
+                                             budget.get_timeout(self.timeout))
+      if result is SEARCH_TIMEOUT:
+        return (cluster_info, False, None)
+      return (cluster_info, True, result)
+
+    n_workers = min(self.max_workers, len(clusters))
+    if n_workers <= 1:
+      for cluster_info in clusters:
+        yield search_job(cluster_info)
+      return
+
+    pool = ThreadPool(n_workers)
+    try:
+      if ordered:
+        jobs = pool.imap(search_job, clusters, 1)
+      else:
+        jobs = pool.imap_unordered(search_job, clusters, 1)
+      for job_result in jobs:
+        yield job_result
+    finally:
+      # the searches not started are dropped if the caller stops early
+      pool.terminate()
+      pool.join()
+
+  def _search_cluster_isolated(self, groum_path, cluster_info,
+                               filter_for_bugs, timeout):
+    """ Search a cluster: an error only skips the cluster (returns
+    SEARCH_TIMEOUT if the search was stopped at the timeout)
+    """
+    try:
+      return self.search_cluster(groum_path, cluster_info, filter_for_bugs,
+                                 timeout)
+    except Exception as e:
+      logging.error("Error searching cluster %s (%s)" % (cluster_info.id,
+                                                         str(e)))
+      return None
 
   def search_cluster(self, groum_path, cluster_info,
-                     filter_for_bugs = False):
+                     filter_for_bugs = False,
+                     timeout = None):
     """
-    Search for similarities and anomalies inside a single lattice
+    Search for similarities and anomalies inside a single lattice,
+    stopping the search after timeout seconds (self.timeout if None).
+
+    Returns SEARCH_TIMEOUT if the search was stopped at the timeout.
     """
     current_path = os.path.join(self.cluster_path,
                                 "all_clusters",
@@ -309,7 +621,8 @@ class Search():
       logging.debug("Searching lattice %s..." % lattice_path)
       result = self.call_iso(groum_path, lattice_path,
                              int(cluster_info.id),
-                             filter_for_bugs)
+                             filter_for_bugs,
+                             timeout)
     else:
       logging.debug("Lattice file %s not found" % lattice_path)
       result = None
@@ -319,54 +632,17 @@ class Search():
 
   def call_iso(self, groum_path, lattice_path,
                cluster_id,
-               filter_for_bugs = False):
+               filter_for_bugs = False,
+               timeout = None):
     """
     Search the element in the lattice that are similar to the groum
     """
-    search_file, search_path = tempfile.mkstemp(suffix=".bin",
-                                                prefix="search_res",
-                                                text=True)
-    os.close(search_file)
-
-    args = [self.search_lattice_path,
-            "-q", groum_path,
-            "-l", lattice_path,
-            "-o", search_path]
-    logging.debug("Command line %s" % " ".join(args))
-
-    # Kill the process after the timout expired
-    def kill_function(p, cmd):
-      logging.info("Execution timed out executing %s" % (cmd))
-      p.kill()
-
-    proc = Popen(args, cwd=None, stdout=PIPE,  stderr=PIPE)
-    timer = Timer(self.timeout, kill_function, [proc, "".join(args)])
-    try:
-      timer.start()
-      (stdout, stderr) = proc.communicate() # execute the process
-    except Exception as e:
-      logging.error(e.message)
-    finally:
-      timer.cancel() # Cancel the timer, no matter what
-
-    result = None
-    return_code = proc.returncode
-    if (return_code != 0):
-      err_msg = "Error code is %s\nCommand line is: " \
-                "%s\n%s" % (str(return_code), str(" ".join(args)),"\n")
-      logging.error("Error executing %s\n%s" % (" ".join(args), err_msg))
-
-      # result = TODO_ERROR
-
-    else:
-      logging.info("Search finished...")
-
-      result = self.formatOutput(search_path, cluster_id, filter_for_bugs)
-
-    if os.path.isfile(search_path):
-      os.remove(search_path)
-
-    return result
+    if timeout is None:
+      timeout = self.timeout
+    search_results = self.backend.search(groum_path, lattice_path, timeout)
+    if search_results is None or search_results is SEARCH_TIMEOUT:
+      return search_results
+    return self.format_results(search_results, cluster_id, filter_for_bugs)
 
 
   def get_res_type(self, proto_search_type):
@@ -405,14 +681,22 @@ class Search():
     """
     Read the results from the search and produce the json output
     """
+    with open(search_path,'rb') as fsearch:
+      search_results = fsearch.read()
+      fsearch.close()
+    return self.format_results(search_results, cluster_id, filter_for_bugs)
+
+  def format_results(self, search_results, cluster_id,
+                     filter_for_bugs=False):
+    """
+    Produce the json output from the serialized SearchResults
+    """
     logging.debug("Formatting output...")
 
     results = {}
 
     proto_results = SearchResults()
-    with open(search_path,'rb') as fsearch:
-      proto_results.ParseFromString(fsearch.read())
-      fsearch.close()
+    proto_results.ParseFromString(search_results)
 
     # Read the method names
     proto_lattice = proto_results.lattice
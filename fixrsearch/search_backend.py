@@ -0,0 +1,487 @@
+"""
+Backends running the search of a groum in the lattice of a cluster.
+
+A backend returns the serialized SearchResults produced by searchlattice
+(None if the search failed, SEARCH_TIMEOUT if the search was stopped at
+its timeout):
+- ProcessSearchBackend runs a new searchlattice process for each search
+  (see the OUTPUT_* modes for how the results are read)
+- PooledSearchBackend keeps resident worker processes and sends them the
+  searches on their stdin/stdout
+- RecordingSearchBackend records the results of another backend, to be
+  replayed by the stand-in worker (see search_worker.py)
+- CachedSearchBackend keeps the results of another backend in a
+  persistent cache on disk
+
+Protocol of the workers: the messages are frames, a 4 bytes (big endian)
+length followed by the data. A search is the frame with the path of the
+groum followed by the frame with the path of the lattice. The worker
+replies with a frame starting with the status (STATUS_OK followed by the
+serialized SearchResults, STATUS_ERROR followed by the error message).
+"""
+
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+from subprocess import Popen, PIPE
+from threading import Timer, Lock, Event
+
+from fixrsearch.cache import DiskCache
+
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+STATUS_OK = b"\x00"
+STATUS_ERROR = b"\x01"
+
+# result of a search stopped at its timeout (unlike a failed search, the
+# search could succeed with more time)
+SEARCH_TIMEOUT = object()
+
+# default size of the cache of the results (in MB)
+RESULT_CACHE_MB = 1024
+
+# output modes of ProcessSearchBackend:
+# - OUTPUT_MEMORY: searchlattice writes the results in a memory file (a
+#   memfd, reused by the next searches, or a file in TMPFS_DIR), falling back
+#   to OUTPUT_FILE when neither is available
+# - OUTPUT_STDOUT: searchlattice writes the results on its stdout (it must
+#   not print anything else there)
+# - OUTPUT_FILE: searchlattice writes the results in a temporary file
+OUTPUT_MEMORY = "memory"
+OUTPUT_STDOUT = "stdout"
+OUTPUT_FILE = "file"
+OUTPUT_MODES = [OUTPUT_MEMORY, OUTPUT_STDOUT, OUTPUT_FILE]
+
+TMPFS_DIR = "/dev/shm"
+
+FRAME_HEADER = ">I"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+
+
+def write_frame(stream, data):
+  stream.write(struct.pack(FRAME_HEADER, len(data)))
+  stream.write(data)
+  stream.flush()
+
+
+def read_frame(stream):
+  """ Read a frame, raise EOFError if the stream ends before the end
+  of the frame.
+  """
+  (length,) = struct.unpack(FRAME_HEADER,
+                            _read_exactly(stream, FRAME_HEADER_SIZE))
+  return _read_exactly(stream, length)
+
+
+def _read_exactly(stream, size):
+  chunks = []
+  while size > 0:
+    data = stream.read(size)
+    if not data:
+      raise EOFError("Truncated frame")
+    chunks.append(data)
+    size -= len(data)
+  return b"".join(chunks)
+
+
+def _to_bytes(path):
+  if isinstance(path, bytes):
+    return path
+  return path.encode("utf-8")
+
+
+def _file_digest(file_name):
+  digest = hashlib.sha1()
+  with open(file_name, "rb") as f:
+    while True:
+      data = f.read(1 << 20)
+      if not data:
+        break
+      digest.update(data)
+  return digest.hexdigest()
+
+
+def _can_use_memfd():
+  return (hasattr(os, "memfd_create") and
+          os.path.isdir(os.path.join("/proc", str(os.getpid()), "fd")))
+
+
+def _can_use_tmpfs():
+  return os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK)
+
+
+def _read_fd(fd):
+  """ Read the whole file fd from the start """
+  size = os.fstat(fd).st_size
+  os.lseek(fd, 0, os.SEEK_SET)
+  chunks = []
+  while size > 0:
+    data = os.read(fd, size)
+    if not data:
+      break
+    chunks.append(data)
+    size -= len(data)
+  if len(chunks) == 1:
+    return chunks[0]
+  return b"".join(chunks)
+
+
+def get_replay_file(replay_dir, groum_path, lattice_path):
+  """ File with the recorded results of the search of the groum in the
+  lattice
+  """
+  return os.path.join(replay_dir, "%s__%s" % (os.path.basename(groum_path),
+                                              os.path.basename(lattice_path)))
+
+
+class SearchBackend(object):
+  """ Runs the search of a groum in a lattice """
+
+  def search(self, groum_path, lattice_path, timeout):
+    """ Search the groum in the lattice, stopping the search after
+    timeout seconds.
+
+    Returns the serialized SearchResults, None if the search failed or
+    SEARCH_TIMEOUT if the search was stopped at the timeout.
+    """
+    raise NotImplementedError()
+
+  def get_version(self):
+    """ String identifying the search executed by the backend (the
+    cached results of a different version are not used)
+    """
+    raise NotImplementedError()
+
+  def close(self):
+    pass
+
+
+class ProcessSearchBackend(SearchBackend):
+  """ Runs a searchlattice process for each search, reading the results
+  as specified by output_mode (one of OUTPUT_MODES)
+  """
+
+  def __init__(self, search_lattice_path, output_mode = OUTPUT_MEMORY):
+    if not output_mode in OUTPUT_MODES:
+      raise ValueError("Unknown output mode %s" % output_mode)
+    self.search_lattice_path = search_lattice_path
+    self._version = None
+
+    self.output_mode = output_mode
+    self._output_dir = None
+    self._use_memfd = False
+    if output_mode == OUTPUT_MEMORY:
+      if _can_use_memfd():
+        self._use_memfd = True
+      elif _can_use_tmpfs():
+        self._output_dir = TMPFS_DIR
+      else:
+        logging.info("No memory file system, searchlattice writes " \
+                     "the results in a temporary file")
+        self.output_mode = OUTPUT_FILE
+    # the memfds not used by a search
+    self._free_memfds = []
+    self._memfds_lock = Lock()
+
+  def get_version(self):
+    if self._version is None:
+      self._version = _file_digest(self.search_lattice_path)
+    return self._version
+
+  def _get_memfd(self):
+    """ Get a memfd not used by other searches (there are as many memfds
+    as concurrent searches)
+    """
+    with self._memfds_lock:
+      if len(self._free_memfds) > 0:
+        return self._free_memfds.pop()
+    return os.memfd_create("search_res")
+
+  def _release_memfd(self, fd):
+    os.ftruncate(fd, 0)
+    with self._memfds_lock:
+      self._free_memfds.append(fd)
+
+  def close(self):
+    with self._memfds_lock:
+      for fd in self._free_memfds:
+        os.close(fd)
+      self._free_memfds = []
+
+  def search(self, groum_path, lattice_path, timeout):
+    memfd = None
+    search_path = None
+    if self.output_mode == OUTPUT_STDOUT:
+      output_path = "/dev/stdout"
+    elif self._use_memfd:
+      memfd = self._get_memfd()
+      # the process opens the memfd of this process
+      output_path = "/proc/%d/fd/%d" % (os.getpid(), memfd)
+    else:
+      search_file, search_path = tempfile.mkstemp(suffix=".bin",
+                                                  prefix="search_res",
+                                                  dir=self._output_dir)
+      os.close(search_file)
+      output_path = search_path
+
+    args = [self.search_lattice_path,
+            "-q", groum_path,
+            "-l", lattice_path,
+            "-o", output_path]
+    logging.debug("Command line %s" % " ".join(args))
+
+    # Kill the process after the timout expired
+    timed_out = Event()
+    def kill_function(p, cmd):
+      logging.info("Execution timed out executing %s" % (cmd))
+      timed_out.set()
+      p.kill()
+
+    stdout = None
+    proc = Popen(args, cwd=None, stdout=PIPE,  stderr=PIPE)
+    timer = Timer(timeout, kill_function, [proc, "".join(args)])
+    try:
+      timer.start()
+      (stdout, stderr) = proc.communicate() # execute the process
+    except Exception as e:
+      logging.error(str(e))
+    finally:
+      timer.cancel() # Cancel the timer, no matter what
+
+    result = None
+    try:
+      return_code = proc.returncode
+      if return_code != 0 and timed_out.is_set():
+        result = SEARCH_TIMEOUT
+      elif (return_code != 0):
+        err_msg = "Error code is %s\nCommand line is: " \
+                  "%s\n%s" % (str(return_code), str(" ".join(args)),"\n")
+        logging.error("Error executing %s\n%s" % (" ".join(args), err_msg))
+      else:
+        logging.info("Search finished...")
+        if self.output_mode == OUTPUT_STDOUT:
+          result = stdout
+        elif not memfd is None:
+          result = _read_fd(memfd)
+        else:
+          with open(search_path, "rb") as fsearch:
+            result = fsearch.read()
+    finally:
+      if not memfd is None:
+        self._release_memfd(memfd)
+      if not search_path is None and os.path.isfile(search_path):
+        os.remove(search_path)
+
+    return result
+
+
+class PooledSearchBackend(SearchBackend):
+  """ Keeps n_workers resident worker processes (started with
+  worker_args) and sends them the searches.
+
+  A worker is started when needed, and it is restarted after a timeout
+  or an error in the protocol (a worker killed by the timeout is never
+  reused, even if it replied).
+  """
+
+  def __init__(self, worker_args, n_workers = 1):
+    self.worker_args = list(worker_args)
+    self.n_workers = n_workers
+
+    # the idle workers (None for a worker not started)
+    self._idle = queue.Queue()
+    for i in range(n_workers):
+      self._idle.put(None)
+    self._version = None
+
+  def get_version(self):
+    """ Digest of the command line of the workers and of the files in
+    it (e.g., the executable)
+    """
+    if self._version is None:
+      digest = hashlib.sha1()
+      for arg in self.worker_args:
+        digest.update(_to_bytes(arg))
+        if os.path.isfile(arg):
+          digest.update(_to_bytes(_file_digest(arg)))
+      self._version = digest.hexdigest()
+    return self._version
+
+  def _start_worker(self):
+    logging.debug("Starting search worker %s" % " ".join(self.worker_args))
+    return Popen(self.worker_args, stdin=PIPE, stdout=PIPE)
+
+  @staticmethod
+  def _stop_worker(worker):
+    if worker is None:
+      return
+    try:
+      if worker.poll() is None:
+        worker.kill()
+      worker.wait()
+    except EnvironmentError:
+      pass
+
+  def search(self, groum_path, lattice_path, timeout):
+    # the timer may fire while it is cancelled: timer_lock decides if
+    # the search finished or timed out
+    timer_lock = Lock()
+    finished = Event()
+    timed_out = Event()
+
+    worker = self._idle.get()
+    try:
+      if worker is None or not worker.poll() is None:
+        worker = self._start_worker()
+
+      # Kill the worker after the timout expired
+      def kill_function(p):
+        with timer_lock:
+          if finished.is_set():
+            return
+          timed_out.set()
+          logging.info("Search of %s in %s timed out" % (groum_path,
+                                                         lattice_path))
+          p.kill()
+
+      timer = Timer(timeout, kill_function, [worker])
+      try:
+        timer.start()
+        write_frame(worker.stdin, _to_bytes(groum_path))
+        write_frame(worker.stdin, _to_bytes(lattice_path))
+        reply = read_frame(worker.stdout)
+      finally:
+        with timer_lock:
+          finished.set()
+          timer.cancel()
+        if timed_out.is_set():
+          PooledSearchBackend._stop_worker(worker)
+          worker = None
+    except (EnvironmentError, EOFError, struct.error) as e:
+      PooledSearchBackend._stop_worker(worker)
+      worker = None
+      if timed_out.is_set():
+        return SEARCH_TIMEOUT
+      logging.error("Error in the search worker (%s)" % str(e))
+      return None
+    finally:
+      self._idle.put(worker)
+
+    if reply[:1] != STATUS_OK:
+      logging.error("Error searching %s in %s: %s" %
+                    (groum_path, lattice_path, reply[1:]))
+      return None
+    logging.info("Search finished...")
+    return reply[1:]
+
+  def close(self):
+    """ Stop the workers (waiting for the running searches) """
+    for i in range(self.n_workers):
+      worker = self._idle.get()
+      if not worker is None:
+        try:
+          # the worker exits at the end of its input
+          worker.stdin.close()
+        except EnvironmentError:
+          pass
+        PooledSearchBackend._stop_worker(worker)
+
+
+class RecordingSearchBackend(SearchBackend):
+  """ Records the results of backend in replay_dir """
+
+  def __init__(self, backend, replay_dir):
+    self.backend = backend
+    self.replay_dir = replay_dir
+    self._lock = Lock()
+
+  def search(self, groum_path, lattice_path, timeout):
+    result = self.backend.search(groum_path, lattice_path, timeout)
+    if not result is None and not result is SEARCH_TIMEOUT:
+      replay_file = get_replay_file(self.replay_dir, groum_path,
+                                    lattice_path)
+      with self._lock:
+        with open(replay_file, "wb") as f:
+          f.write(result)
+    return result
+
+  def get_version(self):
+    return self.backend.get_version()
+
+  def close(self):
+    self.backend.close()
+
+
+class CachedSearchBackend(SearchBackend):
+  """ Caches the results of backend in cache_dir (at most max_bytes of
+  results, evicting the least recently used).
+
+  The results are the same for the same groum content, lattice content
+  and version of the backend: the key of the cache is the digest of the
+  groum file, of the lattice file and of the version.
+  """
+
+  def __init__(self, backend, cache_dir, max_bytes = None):
+    self.backend = backend
+    self.cache = DiskCache(cache_dir, max_bytes)
+    self._lock = Lock()
+    # lattice path -> ((size, modification time), digest)
+    self._lattice_digests = {}
+
+  def _get_lattice_digest(self, lattice_path):
+    """ The lattices are large and change rarely: their digest is
+    computed again only when the size or the modification time change
+    """
+    stat = os.stat(lattice_path)
+    file_stat = (stat.st_size, stat.st_mtime)
+    with self._lock:
+      if lattice_path in self._lattice_digests:
+        (old_stat, digest) = self._lattice_digests[lattice_path]
+        if old_stat == file_stat:
+          return digest
+
+    digest = _file_digest(lattice_path)
+    with self._lock:
+      self._lattice_digests[lattice_path] = (file_stat, digest)
+    return digest
+
+  def get_key(self, groum_path, lattice_path):
+    key = hashlib.sha1()
+    key.update(_to_bytes(_file_digest(groum_path)))
+    key.update(_to_bytes(self._get_lattice_digest(lattice_path)))
+    key.update(_to_bytes(self.backend.get_version()))
+    return key.hexdigest()
+
+  def search(self, groum_path, lattice_path, timeout):
+    try:
+      key = self.get_key(groum_path, lattice_path)
+    except EnvironmentError as e:
+      logging.error("Cannot compute the key of the search (%s)" % str(e))
+      return self.backend.search(groum_path, lattice_path, timeout)
+
+    result = self.cache.get(key)
+    if not result is None:
+      logging.debug("Cached search of %s in %s" % (groum_path, lattice_path))
+      return result
+
+    result = self.backend.search(groum_path, lattice_path, timeout)
+    if not result is None and not result is SEARCH_TIMEOUT:
+      try:
+        self.cache.put(key, result)
+      except EnvironmentError as e:
+        logging.error("Cannot cache the search (%s)" % str(e))
+    return result
+
+  def get_version(self):
+    return self.backend.get_version()
+
+  def get_stats(self):
+    return self.cache.get_stats()
+
+  def close(self):
+    self.backend.close()
@@ -20,7 +20,8 @@ import json
 import tempfile
 import shutil
 
-from fixrsearch.search import Search
+from fixrsearch.search import Search, get_cluster_file
+from fixrsearch.index import ClusterIndex
 from fixrsearch.groum_index import GroumIndexBase, GroumIndex
 from fixrsearch.anomaly import AnomalyEncoder
 
@@ -176,8 +177,10 @@ def main():
    source_code_path) = args_res
 
   # Creates the search object
+  cluster_index = ClusterIndex(get_cluster_file(clusters_path),
+                               use_snapshot = True)
   search = Search(clusters_path, search_lattice_path,
-                  None, GroumIndex(graphs_path), timeout)
+                  cluster_index, GroumIndex(graphs_path), timeout)
   src_client = SrcClientMock()
   src_client = SrcClientService("localhost", "8080")
 
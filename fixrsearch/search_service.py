@@ -5,10 +5,19 @@ The endpoints are:
 - search: search for the similar patterns to a groum
 - get_apps: get all the apps (repos) existing in the dataset
 - get_groums: get all the groums in the dataset
+  (get_apps and get_groums accept the limit, cursor and stream options
+  to paginate and stream the listing)
 - process_graphs_pull_request: process a pull request and finds the similar pattern
+  (search and process_graphs_pull_request accept a time budget in seconds,
+  the reply tells if the results are partial and the clusters not searched;
+  search accepts the stream option to get the results of each cluster as
+  soon as they are found)
 - inspect_anomaly: provides the suggested fix for the anomaly
 - explain_anomaly: provides the pattern violated by the anomaly
 - view_examples: provides the examples of patterns explaining the anomaly
+- update_clusters: loads the changes of the clusters file in the index
+- get_index_stats: counters of the watcher of the graph directory and of
+  the cache of the search results
 
 TODO:
 - add a service that receives an apk + metadata and extract the graph,
@@ -25,18 +34,39 @@ import os
 import sys
 import shutil
 import copy
+import itertools
+import shlex
+import threading
 import fixrgraph.wireprotocol.search_service_wire_protocol as wp
 import tempfile
 
 from search import (
     Search,
+    SearchBudget,
+    ClusterRanker,
     get_cluster_file
 )
 from index import ClusterIndex
-from groum_index import GroumIndex, GroumIndexBase
+from groum_index import (
+    GroumIndex,
+    GroumIndexBase,
+    SQLiteGroumIndex,
+    ShardedGroumIndex,
+    SHARDS_IN_MEMORY
+)
+from graph_watcher import GraphWatcher
+from cache import LRUCache
+from search_backend import (
+    ProcessSearchBackend,
+    PooledSearchBackend,
+    CachedSearchBackend,
+    RESULT_CACHE_MB,
+    OUTPUT_MODES,
+    OUTPUT_MEMORY
+)
 from db import SQLiteConfig, Db
 from src_service_client import SrcClient, SrcClientMock, SrcClientService
-from process_pr import PrProcessor
+from process_pr import PrProcessor, DIGEST_RESULTS_ENTRIES
 from utils import PullRequestRef, RepoRef, CommitRef
 
 CLUSTER_PATH = "cluster_path"
@@ -46,7 +76,17 @@ GROUM_INDEX = "groum_index"
 DB_NAME = "service_db"
 DB_CONFIG="db_config"
 SRC_CLIENT ="src_client"
+CLUSTER_RANKER = "cluster_ranker"
+CLUSTER_INDEX_LOCK = "cluster_index_lock"
+GRAPH_WATCHER = "graph_watcher"
+GROUM_INDEX_LOCK = "groum_index_lock"
+DIGEST_RESULTS = "digest_results"
+SEARCH_WORKERS = "search_workers"
+SEARCH_BACKEND = "search_backend"
+RESULT_CACHE = "result_cache"
 TIMEOUT = 10
+# number of items serialized in each chunk of the streamed listings
+STREAM_CHUNK = 100
 
 def process_muse_data():
     """
@@ -95,11 +135,7 @@ def process_muse_data():
         commit_hash = directory_data[2]
         # Create a pull request proessor
         pr_processor = PrProcessor(groum_index,
-                                   Search(current_app.config[CLUSTER_PATH],
-                                          current_app.config[ISO_PATH],
-                                          current_app.config[CLUSTER_INDEX],
-                                          current_app.config[GROUM_INDEX],
-                                          current_app.config[TIMEOUT]),
+                                   get_search(current_app),
                                    current_app.config[SRC_CLIENT])
         # Process the graphs from the app
         commit_ref = CommitRef(RepoRef(repo_name, user_name), commit_hash)
@@ -153,6 +189,53 @@ def get_new_db(config, create=False):
         db.connect()
     return db
 
+def get_search(app, max_clusters = None, min_score = None):
+    """ Creates the search object sharing the indexes of the app """
+    return Search(app.config[CLUSTER_PATH],
+                  app.config[ISO_PATH],
+                  app.config[CLUSTER_INDEX],
+                  app.config[GROUM_INDEX],
+                  app.config[TIMEOUT],
+                  ranker = app.config[CLUSTER_RANKER],
+                  max_clusters = max_clusters,
+                  min_score = min_score,
+                  max_workers = app.config[SEARCH_WORKERS],
+                  backend = app.config[SEARCH_BACKEND])
+
+def get_search_options(content):
+    """ Read the options that bound the search of a groum.
+
+    Raise ValueError if the options are malformed.
+    """
+    max_clusters = None
+    min_score = None
+    try:
+        if "max_clusters" in content and not content["max_clusters"] is None:
+            max_clusters = int(content["max_clusters"])
+            if max_clusters < 0:
+                raise ValueError("max_clusters must be positive")
+        if "min_score" in content and not content["min_score"] is None:
+            min_score = float(content["min_score"])
+    except TypeError as e:
+        raise ValueError(str(e))
+    return (max_clusters, min_score)
+
+def get_search_budget(content):
+    """ Read the time budget of the request (budget, in seconds).
+
+    Returns None if the request has no budget, raise ValueError if the
+    budget is malformed.
+    """
+    if content is None or content.get("budget") is None:
+        return None
+    try:
+        budget = float(content["budget"])
+    except TypeError as e:
+        raise ValueError(str(e))
+    if budget <= 0:
+        raise ValueError("budget must be positive")
+    return SearchBudget(budget)
+
 def get_malformed_request(error = None):
     if error is None:
        error = "Malformed request"
@@ -167,12 +250,123 @@ def get_malformed_request(error = None):
                     status=400,
                     mimetype='application/json')
 
+def get_page_options(content):
+    """ Read the options of the listings (get_apps and get_groums):
+    - limit: maximum number of items in the reply
+    - cursor: continue the listing after the last item of a previous reply
+    - stream: reply with NDJSON (one item per line)
+
+    Raise ValueError if the options are malformed.
+    """
+    limit = None
+    cursor = None
+    stream = False
+    try:
+        if "limit" in content and not content["limit"] is None:
+            limit = int(content["limit"])
+            if limit <= 0:
+                raise ValueError("limit must be positive")
+        if "cursor" in content and not content["cursor"] is None:
+            cursor = str(content["cursor"])
+        stream = get_stream_option(content)
+    except TypeError as e:
+        raise ValueError(str(e))
+    return (limit, cursor, stream)
+
+def get_stream_option(content):
+    """ True if the request asks to stream the reply """
+    if "stream" in content:
+        return str(content["stream"]).lower() in ["true", "1"]
+    return False
+
+def get_listing_response(items, name, limit, cursor, stream):
+    """ Reply with the items of a listing.
+
+    items iterates over the pairs (cursor, item) of the listing, starting
+    after cursor.
+
+    The reply is streamed in chunks and it is:
+    - the JSON list of the items, if limit and cursor are None
+    - the JSON object {name : list of items, "next_cursor" : cursor},
+      otherwise; next_cursor is None at the end of the listing
+    - NDJSON, if stream is True; the next cursor is in the X-Next-Cursor
+      header
+    """
+    next_cursor = None
+    if not limit is None:
+        page = list(itertools.islice(items, limit + 1))
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = page[-1][0]
+        items = page
+
+    if stream:
+        response = Response(_stream_ndjson(items),
+                            status=200,
+                            mimetype='application/x-ndjson')
+        if not next_cursor is None:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return response
+    elif limit is None and cursor is None:
+        return Response(_stream_json_list(items),
+                        status=200,
+                        mimetype='application/json')
+    else:
+        return Response(_stream_json_page(items, name, next_cursor),
+                        status=200,
+                        mimetype='application/json')
+
+def _iter_locked(items, lock):
+    """ Iterates over items holding lock while reading each item (the
+    lock is not held while the item is sent)
+    """
+    while True:
+        with lock:
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+def _get_chunks(items):
+    """ Group the items of a listing in chunks of STREAM_CHUNK items """
+    chunk = []
+    for (cursor, item) in items:
+        chunk.append(item)
+        if len(chunk) == STREAM_CHUNK:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def _stream_json_list(items):
+    yield "["
+    separator = ""
+    for chunk in _get_chunks(items):
+        yield separator + ",".join([json.dumps(item) for item in chunk])
+        separator = ","
+    yield "]"
+
+def _stream_json_page(items, name, next_cursor):
+    yield "{%s:" % json.dumps(name)
+    for text in _stream_json_list(items):
+        yield text
+    yield ",\"next_cursor\":%s}" % json.dumps(next_cursor)
+
+def _stream_ndjson(items):
+    for chunk in _get_chunks(items):
+        yield "".join([json.dumps(item) + "\n" for item in chunk])
+
 def get_apps():
-    groum_index = current_app.config[GROUM_INDEX]
-    apps = groum_index.get_apps()
-    return Response(json.dumps(apps),
-                    status=200,
-                    mimetype='application/json')
+    try:
+        (limit, cursor, stream) = get_page_options(request.args)
+        groum_index = current_app.config[GROUM_INDEX]
+        apps = _iter_locked(groum_index.iter_apps(cursor),
+                            current_app.config[GROUM_INDEX_LOCK])
+    except ValueError as e:
+        return get_malformed_request(str(e))
+
+    return get_listing_response(apps, "apps", limit, cursor, stream)
 
 def get_groums():
     content = request.get_json(force=True)
@@ -180,28 +374,45 @@ def get_groums():
         app_key_str = content["app_key"]
         splitted = app_key_str.split("/")
         if (len(splitted) != 3):
-            return get_malformed_request("Malformed key %s" % app_key)
+            return get_malformed_request("Malformed key %s" % app_key_str)
         app_key = GroumIndexBase.get_app_key(splitted[0],
                                              splitted[1],
                                              splitted[2])
 
-        groum_index = current_app.config[GROUM_INDEX]
-        groums = groum_index.get_groums(app_key)
+        try:
+            (limit, cursor, stream) = get_page_options(content)
+            groum_index = current_app.config[GROUM_INDEX]
+            groums = _iter_locked(groum_index.iter_groums(app_key, cursor),
+                                  current_app.config[GROUM_INDEX_LOCK])
+        except ValueError as e:
+            return get_malformed_request(str(e))
 
-        return Response(json.dumps(groums),
-                        status=200,
-                        mimetype='application/json')
+        return get_listing_response(groums, "groums", limit, cursor, stream)
     else:
         return get_malformed_request("no app key provided")
 
 
+def _stream_search(results, budget):
+    """ Stream the results of each cluster (NDJSON, one line for each
+    cluster). With a budget, the last line tells if the results are
+    partial and the clusters not searched.
+    """
+    for results_cluster in results:
+        yield json.dumps(results_cluster) + "\n"
+    if not budget is None:
+        yield json.dumps({"partial" : budget.is_partial(),
+                          "unsearched_clusters" : [
+                              cluster_id for (groum_path, cluster_id)
+                              in budget.unsearched]}) + "\n"
+
 def search_pattern():
     content = request.get_json(force=True)
 
     if (not content is None) and ("groum_key" in content):
         groum_id = content["groum_key"]
         groum_index = current_app.config[GROUM_INDEX]
-        groum_file = groum_index.get_groum_path(groum_id)
+        with current_app.config[GROUM_INDEX_LOCK]:
+            groum_file = groum_index.get_groum_path(groum_id)
 
         if groum_file is None:
             error_msg = "Cannot find groum for %s" % groum_id
@@ -213,16 +424,30 @@ def search_pattern():
                             mimetype='application/json')
 
         else:
-            search = Search(current_app.config[CLUSTER_PATH],
-                            current_app.config[ISO_PATH],
-                            current_app.config[CLUSTER_INDEX],
-                            current_app.config[GROUM_INDEX],
-                            current_app.config[TIMEOUT])
+            try:
+                (max_clusters, min_score) = get_search_options(content)
+                budget = get_search_budget(content)
+            except ValueError as e:
+                return get_malformed_request(str(e))
+
+            search = get_search(current_app, max_clusters, min_score)
 
-            results = search.search_from_groum(groum_file)
+            if get_stream_option(content):
+                results = search.iter_search_from_groum(groum_file,
+                                                        budget = budget)
+                return Response(_stream_search(results, budget),
+                                status=200,
+                                mimetype='application/x-ndjson')
+
+            results = search.search_from_groum(groum_file, budget = budget)
 
             reply_json = {"status" : 0,
                           "results" : results}
+            if not budget is None:
+                reply_json["partial"] = budget.is_partial()
+                reply_json["unsearched_clusters"] = [
+                    cluster_id for (groum_path, cluster_id)
+                    in budget.unsearched]
 
             return Response(json.dumps(reply_json),
                             status=200,
@@ -232,6 +457,70 @@ def search_pattern():
 
 
 
+def update_clusters():
+    """
+    Load the clusters changed in the clusters file.
+
+    The whole clusters file is read, and only the clusters that changed
+    are added to or removed from a copy of the cluster index, which then
+    replaces the index used by the service: the searches in progress
+    keep using the old index and are not blocked by the update.
+
+    The copy and the update are done without holding the lock, which is
+    held only to replace the index. If another update replaced the index
+    in the meantime, the file is applied again to the new index.
+    """
+    while True:
+        old_index = current_app.config[CLUSTER_INDEX]
+        new_index = old_index.copy()
+        try:
+            (added, removed) = new_index.update_from_file()
+        except EnvironmentError as e:
+            error_msg = "Cannot read the clusters (%s)" % str(e)
+            logging.error(error_msg)
+            reply_json = {"status" : 1,
+                          "error" : error_msg}
+            return Response(json.dumps(reply_json),
+                            status=500,
+                            mimetype='application/json')
+
+        with current_app.config[CLUSTER_INDEX_LOCK]:
+            if current_app.config[CLUSTER_INDEX] is old_index:
+                current_app.config[CLUSTER_INDEX] = new_index
+                # the results of the groums may change with the clusters
+                current_app.config[DIGEST_RESULTS].clear()
+                break
+
+    logging.info("Updated the cluster index (%d added, %d removed)" %
+                 (len(added), len(removed)))
+    reply_json = {"status" : 0,
+                  "added" : added,
+                  "removed" : removed}
+    return Response(json.dumps(reply_json),
+                    status=200,
+                    mimetype='application/json')
+
+
+def get_index_stats():
+    watcher = current_app.config[GRAPH_WATCHER]
+    result_cache = current_app.config[RESULT_CACHE]
+    if watcher is None and result_cache is None:
+        reply_json = {"status" : 1,
+                      "error" : "The graph directory is not watched " \
+                      "and the search results are not cached"}
+        return Response(json.dumps(reply_json),
+                        status=404,
+                        mimetype='application/json')
+
+    reply_json = {"status" : 0}
+    if not watcher is None:
+        reply_json["watcher"] = watcher.get_stats()
+    if not result_cache is None:
+        reply_json["result_cache"] = result_cache.get_stats()
+    return Response(json.dumps(reply_json),
+                    status=200,
+                    mimetype='application/json')
+
 def process_graphs_in_pull_request():
     """
     Process a pull request and finds the anomalies
@@ -246,6 +535,11 @@ def process_graphs_in_pull_request():
         if f not in content:
             return get_malformed_request("%s not in the request" % f)
 
+    try:
+        budget = get_search_budget(content)
+    except ValueError as e:
+        return get_malformed_request(str(e))
+
     user_name = content["user"]
     repo_name = content["repo"]
     pull_request_id = content["pullRequestId"]
@@ -268,19 +562,17 @@ def process_graphs_in_pull_request():
     try:
         db = get_new_db(current_app.config[DB_CONFIG])
         pr_processor = PrProcessor(current_app.config[GROUM_INDEX],
-                                   Search(current_app.config[CLUSTER_PATH],
-                                          current_app.config[ISO_PATH],
-                                          current_app.config[CLUSTER_INDEX],
-                                          current_app.config[GROUM_INDEX],
-                                          current_app.config[TIMEOUT]),
-                                   current_app.config[SRC_CLIENT])
+                                   get_search(current_app),
+                                   current_app.config[SRC_CLIENT],
+                                   current_app.config[GROUM_INDEX_LOCK],
+                                   current_app.config[DIGEST_RESULTS])
 
         logging.info("Searching for anomalies...")
         pr_ref = PullRequestRef(RepoRef(repo_name, user_name), pull_request_id,
                                 CommitRef(RepoRef(repo_name, user_name),
                                           commit_hash))
 
-        anomalies = pr_processor.process_graphs_from_pr(pr_ref)
+        anomalies = pr_processor.process_graphs_from_pr(pr_ref, budget)
 
         # produce the json output for the anomalies
 
@@ -315,6 +607,16 @@ def process_graphs_in_pull_request():
 
         logging.info("Generating the response for %d anomalies..." % (len(anomalies)))
 
+        if not budget is None:
+            # the anomalies found within the budget
+            json_data = {"anomalies" : json_data,
+                         "partial" : budget.is_partial(),
+                         "unsearched_clusters" : [
+                             {"groum_key" : groum_key,
+                              "cluster_id" : cluster_id}
+                             for (groum_key, cluster_id)
+                             in pr_processor.unsearched]}
+
         response = Response(json.dumps(json_data),
                             status=200,
                             mimetype='application/json')
@@ -346,12 +648,10 @@ def _lookup_anomaly(current_app, content):
 
     db = get_new_db(current_app.config[DB_CONFIG])
     pr_processor = PrProcessor(current_app.config[GROUM_INDEX],
-                               Search(current_app.config[CLUSTER_PATH],
-                                      current_app.config[ISO_PATH],
-                                      current_app.config[CLUSTER_INDEX],
-                                      current_app.config[GROUM_INDEX],
-                                      current_app.config[TIMEOUT]),
-                               current_app.config[SRC_CLIENT])
+                               get_search(current_app),
+                               current_app.config[SRC_CLIENT],
+                               current_app.config[GROUM_INDEX_LOCK],
+                               current_app.config[DIGEST_RESULTS])
 
 
     # Find the pr in the database --- need to get the commit of the pull
@@ -442,6 +742,37 @@ def flaskrun(default_host="127.0.0.1", default_port="5000"):
     p.add_option('-c', '--cluster_path', help="Base path to the cluster directory")
     p.add_option('-i', '--iso_path', help="Path to the isomorphism computation")
 
+    p.add_option('-w', '--index_workers', type="int", default=1,
+                 help="Number of processes used to build the graph index")
+    p.add_option('-s', '--sqlite_index', action="store_true", default=False,
+                 help="Store the graph index in a SQLite database")
+    p.add_option('-r', '--sharded_index', action="store_true", default=False,
+                 help="Keep a graph index for each app " \
+                 "(user/repo/commit directory)")
+    p.add_option('-m', '--max_shards', type="int", default=SHARDS_IN_MEMORY,
+                 help="Number of app indexes kept in memory")
+    p.add_option('-j', '--search_workers', type="int", default=1,
+                 help="Number of clusters searched at the same time " \
+                 "for a graph")
+    p.add_option('-W', '--watch_interval', type="float", default=None,
+                 help="Seconds between two checks of the graph path for " \
+                 "new or removed graphs (not checked by default)")
+    p.add_option('-k', '--search_worker', default=None,
+                 help="Command line of a resident search worker: the " \
+                 "searches are sent to a pool of search_workers workers " \
+                 "instead of running the iso executable for each search")
+    p.add_option('-o', '--search_output', type='choice',
+                 choices=OUTPUT_MODES, default=OUTPUT_MEMORY,
+                 help="Where the iso executable writes the results: in a " \
+                 "memory file (memory), on its standard output (stdout) " \
+                 "or in a temporary file (file)")
+    p.add_option('-R', '--result_cache', default=None,
+                 help="Directory of the cache of the search results " \
+                 "(not cached by default)")
+    p.add_option('-M', '--result_cache_mb', type="float",
+                 default=RESULT_CACHE_MB,
+                 help="Size of the cache of the search results (MB)")
+
     p.add_option('-z', '--srcclientaddress', help="")
     p.add_option('-l', '--srcclientport', help="")
 
@@ -479,6 +810,8 @@ def flaskrun(default_host="127.0.0.1", default_port="5000"):
     if (not opts.iso_path): usage("Iso executable not provided!")
     if (not os.path.isfile(opts.iso_path)):
         usage("Iso executable %s does not exist!" % opts.iso_path)
+    if opts.sqlite_index and opts.sharded_index:
+        usage("Choose either the SQLite or the sharded graph index!")
 
     if (opts.debug):
         logging.basicConfig(level=logging.DEBUG)
@@ -488,7 +821,17 @@ def flaskrun(default_host="127.0.0.1", default_port="5000"):
     app = create_app(opts.graph_path, opts.cluster_path,
                      opts.iso_path,
                      DB_NAME,
-                     srchost,srcport)
+                     srchost,srcport,
+                     opts.index_workers,
+                     opts.sqlite_index,
+                     opts.sharded_index,
+                     opts.max_shards,
+                     opts.watch_interval,
+                     opts.search_workers,
+                     opts.search_worker,
+                     opts.result_cache,
+                     opts.result_cache_mb,
+                     opts.search_output)
 
     app.run(
         debug=opts.debug,
@@ -501,7 +844,17 @@ def flaskrun(default_host="127.0.0.1", default_port="5000"):
 def create_app(graph_path, cluster_path, iso_path,
                db_path = DB_NAME,
                src_client_address = None,
-               src_client_port = None):
+               src_client_port = None,
+               index_workers = 1,
+               sqlite_index = False,
+               sharded_index = False,
+               max_shards = SHARDS_IN_MEMORY,
+               watch_interval = None,
+               search_workers = 1,
+               search_worker = None,
+               result_cache = None,
+               result_cache_mb = RESULT_CACHE_MB,
+               search_output = OUTPUT_MEMORY):
     app = Flask(__name__)
     app.config[TIMEOUT] = 360
     app.config[CLUSTER_PATH] = cluster_path
@@ -510,10 +863,52 @@ def create_app(graph_path, cluster_path, iso_path,
     cluster_file = get_cluster_file(cluster_path)
 
     logging.info("Creating cluster index...")
-    app.config[CLUSTER_INDEX] = ClusterIndex(cluster_file)
+    app.config[CLUSTER_INDEX] = ClusterIndex(cluster_file, use_snapshot = True)
+    app.config[CLUSTER_INDEX_LOCK] = threading.Lock()
+    app.config[CLUSTER_RANKER] = ClusterRanker()
+    app.config[SEARCH_WORKERS] = search_workers
+    if search_worker is None:
+        app.config[SEARCH_BACKEND] = ProcessSearchBackend(iso_path,
+                                                          search_output)
+    else:
+        logging.info("Using the search worker %s..." % search_worker)
+        app.config[SEARCH_BACKEND] = PooledSearchBackend(
+            shlex.split(search_worker), search_workers)
+    app.config[RESULT_CACHE] = None
+    if not result_cache is None:
+        logging.info("Loading the cache of the results %s..." % result_cache)
+        cached_backend = CachedSearchBackend(app.config[SEARCH_BACKEND],
+                                             result_cache,
+                                             int(result_cache_mb * (1 << 20)))
+        app.config[SEARCH_BACKEND] = cached_backend
+        app.config[RESULT_CACHE] = cached_backend
 
     logging.info("Creating graph index...")
-    app.config[GROUM_INDEX] = GroumIndex(graph_path)
+    if sqlite_index:
+        app.config[GROUM_INDEX] = SQLiteGroumIndex(graph_path,
+                                                   n_workers = index_workers)
+    elif sharded_index:
+        app.config[GROUM_INDEX] = ShardedGroumIndex(graph_path, max_shards,
+                                                    index_workers)
+    else:
+        app.config[GROUM_INDEX] = GroumIndex(graph_path, index_workers)
+
+    # the watcher updates the graph index holding the lock, the requests
+    # read the index holding it
+    app.config[GROUM_INDEX_LOCK] = threading.RLock()
+    # search results of the groums processed in the pull requests, by
+    # digest of the groum
+    app.config[DIGEST_RESULTS] = LRUCache(max_entries = DIGEST_RESULTS_ENTRIES)
+
+    # update the graph index with the graphs added to graph_path
+    app.config[GRAPH_WATCHER] = None
+    if not watch_interval is None and watch_interval > 0:
+        logging.info("Watching %s..." % graph_path)
+        watcher = GraphWatcher(app.config[GROUM_INDEX], watch_interval,
+                               index_workers,
+                               app.config[GROUM_INDEX_LOCK])
+        watcher.start()
+        app.config[GRAPH_WATCHER] = watcher
 
     # create the db object
     config = SQLiteConfig(db_path)
@@ -537,6 +932,8 @@ def create_app(graph_path, cluster_path, iso_path,
     app.route('/inspect_anomaly', methods=['POST'])(inspect_anomaly)
     app.route('/explain_anomaly', methods=['POST'])(explain_anomaly)
     app.route('/process_muse_data', methods=['POST'])(process_muse_data)
+    app.route('/update_clusters', methods=['POST'])(update_clusters)
+    app.route('/get_index_stats', methods=['GET'])(get_index_stats)
 
 
     return app
@@ -0,0 +1,64 @@
+"""
+Stand-in for a searchlattice worker (see search_backend.py).
+
+The worker replays the search results recorded in a directory (see
+RecordingSearchBackend), so that the search can be tested without the
+searchlattice executable.
+
+Usage:
+python -m fixrsearch.search_worker <replay_dir> [-d delay]
+"""
+
+import optparse
+import os
+import sys
+import time
+
+from fixrsearch.search_backend import (
+  read_frame,
+  write_frame,
+  get_replay_file,
+  STATUS_OK,
+  STATUS_ERROR
+)
+
+
+def serve(replay_dir, input_stream, output_stream, delay = 0):
+  """ Reply to the searches until the end of input_stream """
+  while True:
+    try:
+      groum_path = read_frame(input_stream).decode("utf-8")
+      lattice_path = read_frame(input_stream).decode("utf-8")
+    except EOFError:
+      return
+
+    if delay > 0:
+      time.sleep(delay)
+
+    replay_file = get_replay_file(replay_dir, groum_path, lattice_path)
+    if os.path.isfile(replay_file):
+      with open(replay_file, "rb") as f:
+        write_frame(output_stream, STATUS_OK + f.read())
+    else:
+      error = "No results recorded for %s in %s" % (groum_path,
+                                                    lattice_path)
+      write_frame(output_stream, STATUS_ERROR + error.encode("utf-8"))
+
+
+def main():
+  p = optparse.OptionParser(usage="%prog <replay_dir> [options]")
+  p.add_option('-d', '--delay', type="float", default=0,
+               help="Seconds to wait before replying to a search")
+  opts, args = p.parse_args()
+  if len(args) != 1 or not os.path.isdir(args[0]):
+    p.print_help()
+    sys.exit(1)
+
+  # binary streams
+  input_stream = getattr(sys.stdin, "buffer", sys.stdin)
+  output_stream = getattr(sys.stdout, "buffer", sys.stdout)
+  serve(args[0], input_stream, output_stream, opts.delay)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,87 @@
+"""
+Table of the method names used by the indexes.
+
+The same method names appear in the clusters, in the groums of the
+groum index and in the acdfgs used to generate the code. The table keeps
+a single copy of each name and assigns to it a dense integer id, so that
+the indexes can store the ids instead of the strings.
+
+The table is shared by the whole process (see get_method_symbols). The
+ids are valid only inside the process: an index that stores method ids
+on disk also stores the names of its ids (get_names) and maps them back
+to the ids of the process when it is loaded (get_remap).
+"""
+
+import threading
+from array import array
+
+
+class SymbolTable(object):
+  """ Map between names and dense integer ids """
+
+  def __init__(self, names = None):
+    self._lock = threading.Lock()
+    # name -> id
+    self._ids = {}
+    # id -> name
+    self._names = []
+
+    if not names is None:
+      for name in names:
+        self.intern(name)
+
+  def __len__(self):
+    return len(self._names)
+
+  def __contains__(self, name):
+    return name in self._ids
+
+  def intern(self, name):
+    """ Get the id of name, adding it to the table if needed """
+    symbol_id = self._ids.get(name)
+    if symbol_id is None:
+      with self._lock:
+        symbol_id = self._ids.get(name)
+        if symbol_id is None:
+          symbol_id = len(self._names)
+          self._names.append(name)
+          self._ids[name] = symbol_id
+    return symbol_id
+
+  def get_id(self, name, default = None):
+    """ Get the id of name, without adding it to the table """
+    return self._ids.get(name, default)
+
+  def get_name(self, symbol_id):
+    return self._names[symbol_id]
+
+  def canonical(self, name):
+    """ Returns the copy of name kept in the table """
+    return self._names[self.intern(name)]
+
+  def get_names(self, symbol_ids = None):
+    """ Serializable form of the table: the list of names, where the
+    position of a name is its id.
+
+    If symbol_ids is not None, returns only the names of the ids in
+    symbol_ids (in that order).
+    """
+    if symbol_ids is None:
+      return list(self._names)
+    return [self._names[symbol_id] for symbol_id in symbol_ids]
+
+  def get_remap(self, names):
+    """ Maps the ids of a serialized table (the list of names returned
+    by get_names) to the ids of this table.
+
+    Returns the array remap such that remap[serialized id] is the id of
+    the same name in this table.
+    """
+    return array('i', [self.intern(name) for name in names])
+
+
+_METHOD_SYMBOLS = SymbolTable()
+
+def get_method_symbols():
+  """ Table of the method names of the process """
+  return _METHOD_SYMBOLS
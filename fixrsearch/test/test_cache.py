@@ -0,0 +1,84 @@
+""" Test the LRU cache
+
+"""
+
+import os
+import shutil
+import tempfile
+
+try:
+  import unittest2 as unittest
+except ImportError:
+  import unittest
+
+from fixrsearch.cache import LRUCache, DiskCache
+
+class TestCache(unittest.TestCase):
+
+  def test_entries(self):
+    cache = LRUCache(max_entries = 2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    self.assertTrue(cache.get(1) == "a")
+    cache.put(3, "c")
+
+    # 2 is the least recently used
+    self.assertTrue(len(cache) == 2)
+    self.assertTrue(cache.get(2) is None)
+    self.assertTrue(cache.get(1) == "a")
+    self.assertTrue(cache.get(3) == "c")
+
+    stats = cache.get_stats()
+    self.assertTrue(stats["hits"] == 3)
+    self.assertTrue(stats["misses"] == 1)
+    self.assertTrue(stats["evictions"] == 1)
+
+  def test_bytes(self):
+    cache = LRUCache(max_bytes = 10)
+    cache.put(1, "a", 4)
+    cache.put(2, "b", 4)
+    self.assertTrue(cache.current_bytes == 8)
+    cache.put(3, "c", 4)
+    self.assertTrue(not 1 in cache)
+    self.assertTrue(cache.current_bytes == 8)
+
+    # replacing an entry updates the size
+    cache.put(2, "b", 1)
+    self.assertTrue(cache.current_bytes == 5)
+
+    # an entry larger than the cache is not kept
+    cache.put(4, "d", 20)
+    self.assertTrue(len(cache) == 0)
+    self.assertTrue(cache.current_bytes == 0)
+
+    cache.put(5, "e", 1)
+    cache.remove(5)
+    self.assertTrue(len(cache) == 0)
+
+  def test_disk(self):
+    cache_dir = tempfile.mkdtemp()
+    try:
+      cache = DiskCache(cache_dir, max_bytes = 10)
+      cache.put("a", b"1234")
+      cache.put("b", b"5678")
+      self.assertTrue(cache.get("a") == b"1234")
+      cache.put("c", b"901")
+
+      # b is the least recently used
+      self.assertTrue(cache.get("b") is None)
+      self.assertTrue(sorted(os.listdir(cache_dir)) == ["a", "c"])
+      stats = cache.get_stats()
+      self.assertTrue(stats["hits"] == 1)
+      self.assertTrue(stats["misses"] == 1)
+      self.assertTrue(stats["evictions"] == 1)
+
+      # the cache is loaded from the directory
+      os.utime(os.path.join(cache_dir, "a"), (0, 0))
+      cache = DiskCache(cache_dir, max_bytes = 10)
+      self.assertTrue(len(cache) == 2)
+      self.assertTrue(cache.get("c") == b"901")
+      cache.put("d", b"12345")
+      self.assertTrue(not "a" in cache)
+      self.assertTrue(sorted(os.listdir(cache_dir)) == ["c", "d"])
+    finally:
+      shutil.rmtree(cache_dir)
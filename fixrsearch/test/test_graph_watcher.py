@@ -0,0 +1,128 @@
+""" Test the watcher of the graph directory
+
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+try:
+  import unittest2 as unittest
+except ImportError:
+  import unittest
+
+import fixrsearch
+from fixrsearch.groum_index import GroumIndex
+from fixrsearch.graph_watcher import GraphWatcher
+
+class TestGraphWatcher(unittest.TestCase):
+  def setUp(self):
+    test_path = os.path.dirname(fixrsearch.test.__file__)
+    self.test_graph_path = os.path.join(test_path, "data", "graphs")
+    self.tmp_dir = tempfile.mkdtemp()
+    self.graph_path = os.path.join(self.tmp_dir, "graphs")
+
+    # an app of the test graphs
+    self.app_dir = os.path.join("nadafigment", "samples",
+                                "5aaee46bb69a1e20ed8a7c97c1a8323dba76cf17")
+    self.app_files = sorted(os.listdir(os.path.join(self.test_graph_path,
+                                                    self.app_dir)))
+    os.makedirs(os.path.join(self.graph_path, self.app_dir))
+    self._copy(self.app_files[0])
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _copy(self, name, app_dir = None):
+    if app_dir is None:
+      app_dir = self.app_dir
+    dst_dir = os.path.join(self.graph_path, app_dir)
+    if not os.path.isdir(dst_dir):
+      os.makedirs(dst_dir)
+    shutil.copy(os.path.join(self.test_graph_path, self.app_dir, name),
+                os.path.join(dst_dir, name))
+    self._touch_dirs(dst_dir)
+
+  def _touch_dirs(self, dir_path):
+    # the modification time may have a coarse resolution
+    while True:
+      stat = os.stat(dir_path)
+      os.utime(dir_path, (stat.st_atime, stat.st_mtime + 1))
+      if dir_path == self.graph_path:
+        break
+      dir_path = os.path.dirname(dir_path)
+
+  def test_watch(self):
+    index = GroumIndex(self.graph_path)
+    self.assertTrue(index._get_n_groums() == 1)
+
+    watcher = GraphWatcher(index)
+    self.assertTrue(watcher.poll() == (0, 0, 0))
+
+    # new graphs
+    self._copy(self.app_files[1])
+    self._copy(self.app_files[2], os.path.join("u", "r", "c"))
+    self.assertTrue(watcher.poll() == (2, 0, 0))
+    self.assertTrue(index._get_n_groums() == 3)
+
+    # removed graphs
+    os.remove(os.path.join(self.graph_path, self.app_dir, self.app_files[1]))
+    self._touch_dirs(os.path.join(self.graph_path, self.app_dir))
+    shutil.rmtree(os.path.join(self.graph_path, "u"))
+    self._touch_dirs(self.graph_path)
+    self.assertTrue(watcher.poll() == (0, 2, 0))
+    self.assertTrue(index._get_n_groums() == 1)
+
+    # the index file is up to date
+    self.assertEqual(GroumIndex(self.graph_path).groumid2path,
+                     index.groumid2path)
+
+    stats = watcher.get_stats()
+    self.assertTrue(stats["polls"] == 3)
+    self.assertTrue(stats["files_indexed"] == 2)
+    self.assertTrue(stats["files_removed"] == 2)
+    self.assertTrue(stats["files_per_second"] > 0)
+    self.assertTrue(stats["last_lag"] >= 0)
+
+    # the files changed before creating the watcher are indexed
+    self._copy(self.app_files[1])
+    watcher = GraphWatcher(index)
+    self.assertTrue(index._get_n_groums() == 2)
+    self.assertTrue(watcher.poll() == (0, 0, 0))
+    self.assertTrue(index._get_n_groums() == 2)
+
+  def test_baseline(self):
+    index = GroumIndex(self.graph_path)
+    self.assertTrue(index._get_n_groums() == 1)
+
+    # a graph added after the update of the index done by the watcher
+    test = self
+    class TestWatcher(GraphWatcher):
+      def _update_index(self):
+        res = GraphWatcher._update_index(self)
+        test._copy(test.app_files[1])
+        return res
+
+    watcher = TestWatcher(index)
+    self.assertTrue(watcher.poll() == (1, 0, 0))
+    self.assertTrue(index._get_n_groums() == 2)
+
+  def test_same_mtime(self):
+    index = GroumIndex(self.graph_path)
+    watcher = GraphWatcher(index)
+    self.assertTrue(watcher.poll() == (0, 0, 0))
+
+    # a graph added without changing the modification time of the
+    # directory, in the tick of the last listing
+    app_path = os.path.join(self.graph_path, self.app_dir)
+    stat = os.stat(app_path)
+    now = time.time()
+    os.utime(app_path, (stat.st_atime, now))
+    watcher.poll()
+    shutil.copy(os.path.join(self.test_graph_path, self.app_dir,
+                             self.app_files[1]),
+                os.path.join(app_path, self.app_files[1]))
+    os.utime(app_path, (stat.st_atime, now))
+    self.assertTrue(watcher.poll() == (1, 0, 0))
+    self.assertTrue(index._get_n_groums() == 2)
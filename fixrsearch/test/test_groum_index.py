@@ -2,9 +2,11 @@
 
 """
 
+import itertools
 import os
 import logging
 import shutil
+import tempfile
 
 try:
     import unittest2 as unittest
@@ -12,7 +14,11 @@ except ImportError:
     import unittest
 
 import fixrsearch
-from fixrsearch.groum_index import GroumIndex, GroumIndexBase
+import fixrsearch.groum_index
+from fixrsearch.groum_index import GroumIndex, GroumIndexBase, SQLiteGroumIndex
+from fixrsearch.groum_index import ShardedGroumIndex
+from fixrsearch.groum_index import read_groum_record
+from fixrgraph.annotator.protobuf.proto_acdfg_pb2 import Acdfg
 
 class TestGroumIndex(unittest.TestCase):
   def __init__(self, *args, **kwargs):
@@ -34,6 +40,14 @@ class TestGroumIndex(unittest.TestCase):
     if (os.path.exists(index_file)):
       os.remove(index_file)
 
+  def _remove_shards(self):
+    """ Remove the files written by ShardedGroumIndex """
+    for root, dirs, files in os.walk(self.graph_path):
+      if root != self.graph_path and "graph_index.json" in files:
+        os.remove(os.path.join(root, "graph_index.json"))
+    apps_file = os.path.join(self.graph_path, "graph_apps.json")
+    if os.path.exists(apps_file):
+      os.remove(apps_file)
 
   def test_index_basic(self):
     index = GroumIndex(self.graph_path)
@@ -74,3 +88,317 @@ class TestGroumIndex(unittest.TestCase):
       os.removedirs(dst_dir)
 
 
+
+  def test_groum_methods(self):
+    # build and write the index
+    index = GroumIndex(self.graph_path)
+    self.assertTrue(len(index.groumid2methods) > 0)
+
+    # load the index
+    loaded_index = GroumIndex(self.graph_path)
+    for groum_id in index.groumid2path:
+      methods = index.get_groum_methods(groum_id)
+      self.assertTrue(len(methods) > 0)
+      self.assertEqual(sorted(methods),
+                       sorted(loaded_index.get_groum_methods(groum_id)))
+
+  def test_parallel_build(self):
+    index = GroumIndexBase(self.graph_path)
+    index.build_index()
+
+    parallel_index = GroumIndexBase(self.graph_path)
+    parallel_index.build_index(n_workers = 2, progress_step = 1)
+
+    self.assertEqual(index.apps, parallel_index.apps)
+    self.assertEqual(index.appid2groums, parallel_index.appid2groums)
+    self.assertEqual(index.groumid2path, parallel_index.groumid2path)
+    self.assertEqual(index.groumid2methods, parallel_index.groumid2methods)
+
+  def test_header_scan(self):
+    groum_files = GroumIndexBase(self.graph_path)._get_groum_files()
+    self.assertTrue(len(groum_files) > 0)
+
+    scan_header = fixrsearch.groum_index.SCAN_HEADER
+    try:
+      fixrsearch.groum_index.SCAN_HEADER = False
+      records = [read_groum_record(self.graph_path, f) for f in groum_files]
+      fixrsearch.groum_index.SCAN_HEADER = True
+      scanned = [read_groum_record(self.graph_path, f) for f in groum_files]
+    finally:
+      fixrsearch.groum_index.SCAN_HEADER = scan_header
+    self.assertEqual(records, scanned)
+
+    # malformed data is left to the parser of the whole message
+    self.assertTrue(fixrsearch.groum_index._scan_header(b"\x0a\x05ab") is None)
+    self.assertEqual(fixrsearch.groum_index._scan_header(b""), b"")
+
+  def test_incremental_update(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      graph_path = os.path.join(tmp_dir, "graphs")
+      shutil.copytree(self.graph_path, graph_path)
+      index = GroumIndex(graph_path)
+      index_file = index.index_file_name
+      n_groums = len(index.groumid2path)
+
+      # nothing changed, the index is not written
+      os.remove(index_file)
+      self.assertTrue(index.update_index() == (0, 0, 0))
+      self.assertFalse(os.path.exists(index_file))
+
+      # new groum
+      app_key = GroumIndexBase.get_app_key("GoogleChrome",
+                                           "chromium-webview-samples",
+                                           "b18afa96ab6215eed526c19156bf0fe6f5386ad1")
+      groum_name = "fullscreenvideosample.android.chrome.google.com.fullscreenvideosample.MainActivity_onNavigationDrawerItemSelected.acdfg.bin"
+      dst_dir = os.path.join(graph_path, "GoogleChrome",
+                             "chromium-webview-samples",
+                             "b18afa96ab6215eed526c19156bf0fe6f5386ad1")
+      os.makedirs(dst_dir)
+      dst_groum_path = os.path.join(dst_dir, groum_name)
+      shutil.copyfile(os.path.join(self.data_path, "other_graphs",
+                                   groum_name),
+                      dst_groum_path)
+      self.assertTrue(index.update_index() == (1, 0, 0))
+      self.assertTrue(len(index.get_groums(app_key)) == 1)
+      self.assertTrue(len(index.groumid2path) == n_groums + 1)
+      self.assertTrue(os.path.exists(index_file))
+
+      # the loaded index has the same manifest
+      loaded_index = GroumIndex(graph_path)
+      self.assertTrue(loaded_index.update_index() == (0, 0, 0))
+
+      # same content
+      stat = os.stat(dst_groum_path)
+      os.utime(dst_groum_path, (stat.st_atime, stat.st_mtime + 10))
+      self.assertTrue(index.update_index() == (0, 0, 1))
+
+      # removed groum
+      os.remove(dst_groum_path)
+      self.assertTrue(index.update_index() == (0, 1, 0))
+      self.assertTrue(len(index.get_groums(app_key)) == 0)
+      self.assertFalse(app_key in [app["app_key"] for app in index.apps])
+      self.assertTrue(len(index.groumid2path) == n_groums)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_sqlite_index(self):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      db_file = os.path.join(tmp_dir, "graph_index.db")
+      index = GroumIndex(self.graph_path)
+      sqlite_index = SQLiteGroumIndex(self.graph_path, db_file)
+
+      self.assertEqual(index.get_apps(), sqlite_index.get_apps())
+      for app in index.get_apps():
+        self.assertEqual(index.get_groums(app["app_key"]),
+                         sqlite_index.get_groums(app["app_key"]))
+      self.assertTrue(sqlite_index.get_groums("a/b/c") == [])
+      self.assertEqual(len(index.get_all_groums()),
+                       len(sqlite_index.get_all_groums()))
+      for groum_id in index.groumid2path:
+        self.assertEqual(index.get_groum_path(groum_id),
+                         sqlite_index.get_groum_path(groum_id))
+        self.assertEqual(sorted(index.get_groum_methods(groum_id)),
+                         sorted(sqlite_index.get_groum_methods(groum_id)))
+      self.assertTrue(sqlite_index.get_groum_path("a/b/c/d/1") is None)
+      for groum_id in list(index.groumid2path.keys())[:5]:
+        methods = index.get_groum_methods(groum_id)
+        self.assertEqual(index.get_groums_with_all_methods(methods),
+                         sqlite_index.get_groums_with_all_methods(methods))
+      sqlite_index.close()
+
+      # open the existing database
+      sqlite_index = SQLiteGroumIndex(self.graph_path, db_file)
+      self.assertTrue(sqlite_index.update_index() == (0, 0, 0))
+      self.assertEqual(index.get_apps(), sqlite_index.get_apps())
+      sqlite_index.close()
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_iterators(self):
+    def get_pages(iter_items, page_size):
+      """ Read all the items, page_size items at a time """
+      items = []
+      cursor = None
+      while True:
+        page = list(itertools.islice(iter_items(cursor), page_size))
+        items += [item for (next_cursor, item) in page]
+        if len(page) < page_size:
+          return items
+        cursor = page[-1][0]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      index = GroumIndex(self.graph_path)
+      sqlite_index = SQLiteGroumIndex(self.graph_path,
+                                      os.path.join(tmp_dir, "graph_index.db"))
+      sqlite_index.ITER_BATCH = 2
+
+      for i in [index, sqlite_index]:
+        self.assertEqual(get_pages(i.iter_apps, 3), i.get_apps())
+        for app in i.get_apps():
+          iter_groums = lambda cursor : i.iter_groums(app["app_key"], cursor)
+          self.assertEqual(get_pages(iter_groums, 2),
+                           i.get_groums(app["app_key"]))
+        self.assertEqual(list(i.iter_groums("a/b/c")), [])
+        self.assertEqual(len(list(i.iter_all_groums())),
+                         len(index.groumid2path))
+        self.assertEqual(list(i.iter_all_groums()), i.get_all_groums())
+        self.assertRaises(ValueError, i.iter_apps, "a")
+      sqlite_index.close()
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def test_method_index(self):
+    index = GroumIndex(self.graph_path)
+    self.assertTrue(index.method2groums is None)
+    groum_key = sorted(index.groumid2path.keys())[0]
+    methods = index.get_groum_methods(groum_key)
+    self.assertTrue(len(methods) > 1)
+
+    # the index file was written without the method index
+    method_index = GroumIndex(self.graph_path, method_index = True)
+    self.assertFalse(method_index.method2groums is None)
+
+    # written and loaded with the method index
+    os.remove(os.path.join(self.graph_path, "graph_index.json"))
+    method_index = GroumIndex(self.graph_path, method_index = True)
+    loaded_index = GroumIndex(self.graph_path, method_index = True)
+    self.assertEqual(method_index.method2groums, loaded_index.method2groums)
+
+    for i in [index, method_index, loaded_index]:
+      any_groums = i.get_groums_with_any_method(methods)
+      all_groums = i.get_groums_with_all_methods(methods)
+      self.assertTrue(groum_key in any_groums)
+      self.assertTrue(groum_key in all_groums)
+      self.assertTrue(set(all_groums).issubset(set(any_groums)))
+      for other_key in all_groums:
+        self.assertTrue(set(methods).issubset(i.get_groum_methods(other_key)))
+      self.assertEqual(i.get_groums_with_any_method(["a.b.C.d"]), [])
+      self.assertEqual(i.get_groums_with_all_methods(methods + ["a.b.C.d"]),
+                       [])
+
+    self.assertEqual(index.get_groums_with_any_method(methods),
+                     method_index.get_groums_with_any_method(methods))
+
+    # remove the groum
+    method_index._remove_groum(method_index._get_apps_set(), groum_key)
+    self.assertFalse(groum_key in method_index.get_groums_with_any_method(methods))
+
+    # the groum_methods table of the SQLite index
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      sqlite_index = SQLiteGroumIndex(self.graph_path,
+                                      os.path.join(tmp_dir, "graph_index.db"))
+      self.assertEqual(index.get_groums_with_any_method(methods),
+                       sqlite_index.get_groums_with_any_method(methods))
+      self.assertEqual(index.get_groums_with_all_methods(methods),
+                       sqlite_index.get_groums_with_all_methods(methods))
+      sqlite_index._remove_groum(set(), groum_key)
+      self.assertFalse(groum_key in
+                       sqlite_index.get_groums_with_any_method(methods))
+      sqlite_index.build_method_index()
+      self.assertFalse(groum_key in
+                       sqlite_index.get_groums_with_any_method(methods))
+      sqlite_index.close()
+    finally:
+      shutil.rmtree(tmp_dir)
+
+    # the index of the methods of the shards
+    try:
+      sharded_index = ShardedGroumIndex(self.graph_path)
+      sharded_index.get_groum_methods(groum_key)
+      sharded_index.build_method_index()
+      for shard in sharded_index.shards.values():
+        self.assertFalse(shard.method2groums is None)
+      self.assertEqual(index.get_groums_with_any_method(methods),
+                       sharded_index.get_groums_with_any_method(methods))
+      for shard in sharded_index.shards.values():
+        self.assertFalse(shard.method2groums is None)
+    finally:
+      self._remove_shards()
+
+  def test_sharded_index(self):
+    try:
+      index = GroumIndex(self.graph_path)
+      sharded_index = ShardedGroumIndex(self.graph_path, max_shards = 2)
+      app_keys = sharded_index.get_app_keys()
+      self.assertEqual(sorted([app["app_key"] for app in index.get_apps()]),
+                       app_keys)
+
+      # only the shard of the app is loaded
+      app_key = app_keys[0]
+      self.assertEqual(index.get_groums(app_key),
+                       sharded_index.get_groums(app_key))
+      self.assertTrue(len(sharded_index.shards) == 1)
+      self.assertTrue(app_key in sharded_index.shards)
+      for groum in index.get_groums(app_key):
+        self.assertEqual(index.get_groum_path(groum["groum_key"]),
+                         sharded_index.get_groum_path(groum["groum_key"]))
+
+      # at most max_shards shards in memory
+      sharded_index.prefetch(app_keys)
+      self.assertEqual(len(index.get_all_groums()),
+                       len(sharded_index.get_all_groums()))
+      self.assertTrue(len(sharded_index.shards) <= 2)
+      self.assertEqual(sorted(index.get_apps(), key=lambda app : app["app_key"]),
+                       sharded_index.get_apps())
+
+      self.assertTrue(sharded_index.get_shard("a/b/c") is None)
+      self.assertTrue(sharded_index.get_shard("../../..") is None)
+      self.assertEqual(sharded_index.get_groums("a/b/c"), [])
+      self.assertTrue(sharded_index.update_index() == (0, 0, 0))
+
+      # the apps are read from the manifest, without loading the shards
+      sharded_index = ShardedGroumIndex(self.graph_path, max_shards = 2)
+      self.assertEqual(sorted(index.get_apps(), key=lambda app : app["app_key"]),
+                       sharded_index.get_apps())
+      self.assertTrue(len(sharded_index.shards) == 0)
+
+      # the cursor is the position of the app
+      apps = sharded_index.get_apps()
+      for position in range(len(apps) + 1):
+        page = list(itertools.islice(sharded_index.iter_apps(str(position)),
+                                     1))
+        self.assertEqual(apps[position:position + 1],
+                         [app for (cursor, app) in page])
+        for (cursor, app) in page:
+          self.assertEqual(str(position + 1), cursor)
+    finally:
+      self._remove_shards()
+
+  def test_digest(self):
+    # the same groum in two commits of the repo
+    app_dir = os.path.join("nadafigment", "samples",
+                           "5aaee46bb69a1e20ed8a7c97c1a8323dba76cf17")
+    groum_name = sorted(os.listdir(os.path.join(self.graph_path, app_dir)))[0]
+    with open(os.path.join(self.graph_path, app_dir, groum_name), "rb") as f:
+      acdfg = Acdfg()
+      acdfg.ParseFromString(f.read())
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      graph_path = os.path.join(tmp_dir, "graphs")
+      for commit in ["c1", "c2"]:
+        acdfg.repo_tag.commit_hash = commit
+        commit_dir = os.path.join(graph_path, "nadafigment", "samples", commit)
+        os.makedirs(commit_dir)
+        with open(os.path.join(commit_dir, groum_name), "wb") as f:
+          f.write(acdfg.SerializeToString())
+
+      for index in [GroumIndex(graph_path),
+                    SQLiteGroumIndex(graph_path)]:
+        groum_keys = sorted([g["groum_key"] for g in index.get_all_groums()])
+        self.assertTrue(len(groum_keys) == 2)
+        digest = index.get_groum_digest(groum_keys[0])
+        self.assertFalse(digest is None)
+        self.assertEqual(digest, index.get_groum_digest(groum_keys[1]))
+        self.assertEqual(index.get_groums_with_digest(digest), groum_keys)
+        self.assertTrue(index.get_groum_digest("a/b/c/d/1") is None)
+
+      # the digest is stored in the index file
+      index = GroumIndex(graph_path)
+      self.assertEqual(index.get_groums_with_digest(digest), groum_keys)
+    finally:
+      shutil.rmtree(tmp_dir)
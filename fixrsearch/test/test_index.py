@@ -3,15 +3,35 @@
 """
 
 import os
+import itertools
 import logging
+import shutil
+import struct
+import tempfile
 try:
     import unittest2 as unittest
 except ImportError:
     import unittest
 
-from fixrsearch.index import IndexNode, ClusterIndex
+from fixrsearch.index import IndexNode, ClusterIndex, PostingsIndex
+from fixrsearch.symbols import get_method_symbols
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from fixrsearch.index_snapshot import (
+    ClusterIndexSnapshot,
+    get_snapshot_file,
+    HEADER_FORMAT,
+    HEADER_SIZE
+)
 import fixrsearch
 
+class ClusterStub(object):
+    def __init__(self, cluster_id, methods_list):
+        self.id = cluster_id
+        self.methods_list = methods_list
+
 class TestIndex(unittest.TestCase):
 
     def test_find_index(self):
@@ -78,6 +98,40 @@ class TestIndex(unittest.TestCase):
                                                         set([3,4,5]),
                                                         set([5])])
 
+    def test_insert_sorted(self):
+        index = IndexNode(-1)
+        for l in [[4], [1], [3], [2], [1,5], [1,3]]:
+            index.insert(l, set(l))
+
+        self.assertTrue([c.key for c in index.children] == [1,2,3,4])
+        self.assertTrue(list(index.child_keys) == [1,2,3,4])
+        self.assertTrue([c.key for c in index.children[0].children] == [3,5])
+
+    def test_compact_nodes(self):
+        index = IndexNode(-1)
+        index.insert([1, 2], "a")
+        leaf = index.children[0].children[0]
+        self.assertFalse(hasattr(leaf, "__dict__"))
+        self.assertTrue(len(leaf.children) == 0)
+
+        # the leaf becomes an inner node
+        index.insert([1, 2, 3], "b")
+        index.insert([1, 2], "c")
+        self.assertTrue(list(leaf.child_keys) == [3])
+        self.assertTrue(leaf.clusters == ["a", "c"])
+        self.assertTrue(index.get_all_supersets([2]) == ["a", "c", "b"])
+        self.assertTrue(index.copy() == index)
+
+    def test_deep_insert(self):
+        index = IndexNode(-1)
+        int_list = list(range(10000))
+        index.insert(int_list, "deep")
+        index.insert([5, 9999], "short")
+
+        self.assertTrue(index.get_all_supersets([9999]) == ["deep", "short"])
+        self.assertTrue(index.get_all_supersets([0, 9998]) == ["deep"])
+        self.assertTrue(index == index)
+
     def test_index(self):
         test_path = os.path.dirname(fixrsearch.test.__file__)
         index = ClusterIndex(os.path.join(test_path,"clusters.txt"))
@@ -109,4 +163,258 @@ class TestIndex(unittest.TestCase):
         res = index.get_clusters(set([]), 0)
         self.assertTrue(len(res) == 2)
 
+    def test_postings_settrie_equivalence(self):
+        test_path = os.path.dirname(fixrsearch.test.__file__)
+        cluster_file = os.path.join(test_path,"clusters.txt")
+        trie_index = ClusterIndex(cluster_file, ClusterIndex.SETTRIE)
+        postings_index = ClusterIndex(cluster_file, ClusterIndex.POSTINGS)
+
+        def get_ids(clusters):
+            return sorted([c.id for c in clusters])
+
+        all_methods = sorted(trie_index.methods_set)
+        queries = [[], ["cavallo"], all_methods, all_methods[:3],
+                   all_methods[1:4] + ["cavallo"], all_methods[::2]]
+        for query in queries:
+            for k in range(0, 5):
+                self.assertEqual(get_ids(trie_index.get_clusters(query, k)),
+                                 get_ids(postings_index.get_clusters(query, k)))
+
+    def test_clusters_batch(self):
+        test_path = os.path.dirname(fixrsearch.test.__file__)
+        cluster_file = os.path.join(test_path,"clusters.txt")
+
+        def get_overlaps(overlaps):
+            return sorted([(c.id, count) for (c, count) in overlaps])
+
+        for index_type in [ClusterIndex.POSTINGS, ClusterIndex.SETTRIE]:
+            index = ClusterIndex(cluster_file, index_type)
+            all_methods = sorted(index.methods_set)
+            queries = [[], ["cavallo"], all_methods, all_methods[:3],
+                       all_methods[1:4] + ["cavallo"], all_methods[::2],
+                       list(reversed(all_methods[:3]))]
+            for k in range(0, 4):
+                batch = index.get_clusters_overlaps_batch(queries, k)
+                self.assertTrue(len(batch) == len(queries))
+                for (query, overlaps) in zip(queries, batch):
+                    self.assertEqual(
+                        get_overlaps(overlaps),
+                        get_overlaps(index.get_clusters_overlaps(query, k)))
+                # the same set of methods is searched once
+                self.assertTrue(batch[3] is batch[6])
+
+                batch = index.get_clusters_batch(queries, k)
+                for (query, clusters) in zip(queries, batch):
+                    self.assertTrue(clusters == index.get_clusters(query, k))
+
+    def test_update(self):
+        test_path = os.path.dirname(fixrsearch.test.__file__)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cluster_file = os.path.join(tmp_dir, "clusters.txt")
+            shutil.copyfile(os.path.join(test_path, "clusters.txt"),
+                            cluster_file)
+            index_types = [ClusterIndex.POSTINGS, ClusterIndex.SETTRIE]
+            if not numpy is None:
+                index_types.append(ClusterIndex.BITSET)
+
+            def get_ids(clusters):
+                return sorted([c.id for c in clusters])
+
+            # names of other indexes of the process
+            for i in range(200):
+                get_method_symbols().intern("test.Other.method_%d" % i)
+
+            for (index_type, use_snapshot) in itertools.product(index_types,
+                                                                [False, True]):
+                index = ClusterIndex(cluster_file, index_type, use_snapshot)
+                all_methods = sorted(index.m2i)
+                if index_type == ClusterIndex.BITSET:
+                    # the bitset has a column for each method of the index
+                    self.assertEqual(index.bitset.n_words,
+                                     (len(index.m2i) + 63) // 64)
+                all_ids = get_ids(index.get_clusters(all_methods, 0))
+                new_methods = ["android.util.Log.d", "cavallo.Cavallo.run"]
+
+                new_index = index.copy()
+                new_cluster = ClusterStub(1000, new_methods)
+                new_index.add_cluster(new_cluster)
+                self.assertTrue(
+                    get_ids(new_index.get_clusters(new_methods, 2)) == [1000])
+                self.assertTrue(
+                    get_ids(new_index.get_clusters(all_methods, 0)) ==
+                    all_ids + [1000])
+                # the copied index does not change
+                self.assertTrue(len(index.get_clusters(new_methods, 2)) == 0)
+                self.assertTrue(
+                    get_ids(index.get_clusters(all_methods, 0)) == all_ids)
+
+                self.assertTrue(new_index.remove_cluster(all_ids[0]))
+                self.assertFalse(new_index.remove_cluster(all_ids[0]))
+                self.assertTrue(
+                    get_ids(new_index.get_clusters(all_methods, 0)) ==
+                    all_ids[1:] + [1000])
+                self.assertTrue(
+                    get_ids(new_index.get_clusters(["cavallo.Cavallo.run"],
+                                                   1)) == [1000])
+
+                # go back to the clusters in the file
+                (added, removed) = new_index.update_from_file()
+                self.assertTrue(added == [all_ids[0]])
+                self.assertTrue(sorted(removed) == [1000])
+                for k in range(0, 4):
+                    self.assertTrue(
+                        get_ids(new_index.get_clusters(all_methods, k)) ==
+                        get_ids(index.get_clusters(all_methods, k)))
+                self.assertTrue(new_index.update_from_file() == ([], []))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_bitset_settrie_equivalence(self):
+        test_path = os.path.dirname(fixrsearch.test.__file__)
+        for cluster_file in [os.path.join(test_path, "clusters.txt"),
+                             os.path.join(test_path, "data", "clusters",
+                                          "clusters.txt")]:
+            trie_index = ClusterIndex(cluster_file, ClusterIndex.SETTRIE)
+            bitset_index = ClusterIndex(cluster_file, ClusterIndex.BITSET)
+
+            all_methods = sorted(trie_index.methods_set)
+            queries = [[], ["cavallo"], all_methods, all_methods[:3],
+                       all_methods[1:4] + ["cavallo"], all_methods[::2]]
+            for query in queries:
+                for k in range(0, 4):
+                    trie_res = trie_index.get_clusters_overlaps(query, k)
+                    bitset_res = bitset_index.get_clusters_overlaps(query, k)
+                    self.assertEqual(
+                        sorted([(c.id, count) for (c, count) in trie_res]),
+                        sorted([(c.id, count) for (c, count) in bitset_res]))
+
+    def test_postings(self):
+        index = PostingsIndex()
+        self.assertTrue(index.get_all_with_k([1], 1) == [])
+
+        index.insert([1,2], "c1")
+        index.insert([3,4,5], "c2")
+        index.insert([5], "c3")
+
+        self.assertTrue(index.get_all_with_k([1], 1) == ["c1"])
+        self.assertTrue(sorted(index.get_all_with_k([5], 1)) == ["c2", "c3"])
+        self.assertTrue(index.get_all_with_k([3,5], 2) == ["c2"])
+        self.assertTrue(index.get_all_with_k([1,5], 2) == [])
+        self.assertTrue(index.get_all_with_k([], 0) == ["c1", "c2", "c3"])
+
+    def test_snapshot(self):
+        test_path = os.path.dirname(fixrsearch.test.__file__)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cluster_file = os.path.join(tmp_dir, "clusters.txt")
+            shutil.copyfile(os.path.join(test_path, "clusters.txt"),
+                            cluster_file)
+            snapshot_file = get_snapshot_file(cluster_file)
+
+            index = ClusterIndex(cluster_file)
+            self.assertTrue(index.snapshot is None)
+
+            # creates the snapshot
+            snap_index = ClusterIndex(cluster_file, use_snapshot = True)
+            self.assertTrue(os.path.isfile(snapshot_file))
+            self.assertFalse(snap_index.snapshot is None)
+
+            # reads the snapshot, without parsing the clusters
+            snapshot = ClusterIndexSnapshot.open(snapshot_file, cluster_file)
+            self.assertFalse(snapshot is None)
+            index_types = [ClusterIndex.POSTINGS, ClusterIndex.SETTRIE]
+            if not numpy is None:
+                index_types.append(ClusterIndex.BITSET)
+            for index_type in index_types:
+                snap_index = ClusterIndex(cluster_file, index_type, True)
+                for m in index.m2i:
+                    self.assertTrue(snap_index.i2m[snap_index.m2i[m]] == m)
+                    # the snapshot uses the method ids of the process
+                    self.assertEqual(snap_index.m2i[m], index.m2i[m])
+                self.assertEqual(sorted(snap_index.m2i), sorted(index.m2i))
+
+                all_methods = list(index.m2i.keys())
+                for k in range(0, 4):
+                    res = index.get_clusters(all_methods, k)
+                    snap_res = snap_index.get_clusters(all_methods, k)
+                    self.assertEqual(
+                        sorted([(c.id, c.methods_list) for c in res]),
+                        sorted([(c.id, c.methods_list) for c in snap_res]))
+                    [snap_res] = snap_index.get_clusters_batch([all_methods],
+                                                               k)
+                    self.assertEqual(
+                        sorted([(c.id, c.methods_list) for c in res]),
+                        sorted([(c.id, c.methods_list) for c in snap_res]))
+
+            # touching the file keeps the snapshot valid
+            stat = os.stat(cluster_file)
+            os.utime(cluster_file, (stat.st_atime, stat.st_mtime + 10))
+            self.assertFalse(ClusterIndexSnapshot.open(snapshot_file,
+                                                       cluster_file) is None)
+            # the new mtime is stored in the snapshot (no hash next time)
+            with open(snapshot_file, "rb") as f:
+                header = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+            self.assertEqual(header[2], os.stat(cluster_file).st_mtime)
+
+            # changing the file invalidates the snapshot
+            with open(cluster_file, "a") as f:
+                f.write("I:  android.util.Log.d, android.util.Log.e( 2 )\n")
+            self.assertTrue(ClusterIndexSnapshot.open(snapshot_file,
+                                                      cluster_file) is None)
+            snap_index = ClusterIndex(cluster_file, use_snapshot = True)
+            res = snap_index.get_clusters(["android.util.Log.d",
+                                           "android.util.Log.e"], 2)
+            self.assertTrue(len(res) == 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_patterns(self):
+        test_path = os.path.dirname(fixrsearch.test.__file__)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            cluster_path = os.path.join(tmp_dir, "clusters")
+            shutil.copytree(os.path.join(test_path, "data", "clusters"),
+                            cluster_path)
+            cluster_file = os.path.join(cluster_path, "clusters.txt")
+            index = ClusterIndex(cluster_file, patterns_cache_entries = 2)
+
+            cluster_info = [c for c in index._parse_clusters()
+                            if c.id == 2][0]
+            patterns = index.get_patterns(cluster_info)
+            self.assertTrue(len(patterns) > 0)
+            self.assertTrue(index.get_patterns(cluster_info) is patterns)
+            self.assertTrue(index.pattern_map.hits == 1)
+
+            # read a single pattern using the offsets
+            for p in patterns:
+                pattern = index.get_pattern(cluster_info, p.type.lower(),
+                                            p.id)
+                self.assertFalse(pattern is None)
+                self.assertEqual((p.type, p.id, p.groum_files),
+                                 (pattern.type, pattern.id,
+                                  pattern.groum_files))
+            self.assertTrue(index.get_pattern(cluster_info, "popular",
+                                              1000) is None)
+            self.assertTrue(len(index.pattern_map) == 2)
+            self.assertTrue(index.pattern_map.evictions > 0)
+
+            # the offsets are stored next to the info file
+            info_file = index._get_cluster_info_file(2)
+            self.assertTrue(os.path.isfile("%s.offsets" % info_file))
+            other_index = ClusterIndex(cluster_file)
+            other_index.build_pattern_offsets()
+            self.assertEqual(other_index.pattern_offsets[2].patterns,
+                             index.pattern_offsets[2].patterns)
 
+            # the copy of the index does not change the patterns of the
+            # original index
+            n_cached = len(index.pattern_map)
+            new_index = index.copy()
+            new_index.remove_cluster(2)
+            self.assertTrue(2 in index.pattern_offsets)
+            self.assertTrue(len(index.pattern_map) == n_cached)
+            self.assertTrue(len(new_index.pattern_map) < n_cached)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,174 @@
+""" Test the selection of the clusters to search
+
+"""
+
+import os
+import time
+import logging
+
+try:
+  import unittest2 as unittest
+except ImportError:
+  import unittest
+
+import fixrsearch
+from fixrsearch.index import ClusterIndex
+from fixrsearch.search import Search, ClusterRanker, SearchBudget
+from fixrsearch.search_backend import SEARCH_TIMEOUT
+
+class ClusterStub(object):
+  def __init__(self, cluster_id, methods_list):
+    self.id = cluster_id
+    self.methods_list = methods_list
+
+
+class TestSearch(unittest.TestCase):
+  def __init__(self, *args, **kwargs):
+    super(TestSearch, self).__init__(*args, **kwargs)
+    self.cluster_path = None
+
+  def setUp(self):
+    test_path = os.path.dirname(fixrsearch.test.__file__)
+    self.cluster_path = os.path.join(test_path, "data", "clusters")
+
+  def _get_search(self, **kwargs):
+    search = Search(self.cluster_path, "searchlattice",
+                    avoid_duplicates = False,
+                    use_blacklist = False,
+                    **kwargs)
+
+    # Do not run the search, just record the searched clusters
+    clusters = [ClusterStub(1, ["a", "b", "c", "d"]),
+                ClusterStub(2, ["a", "b"]),
+                ClusterStub(3, ["a", "e", "f", "g"])]
+    overlaps = [(clusters[0], 2), (clusters[1], 2), (clusters[2], 1)]
+    search.searched = []
+    def get_clusters(groum_path):
+      ranked = search.ranker.rank(overlaps)
+      return [c for (c, score) in ranked
+              if search.min_score is None or score >= search.min_score]
+    def search_cluster(groum_path, cluster_info, filter_for_bugs,
+                       timeout = None):
+      search.searched.append(cluster_info.id)
+      return None
+    search._get_clusters = get_clusters
+    search.search_cluster = search_cluster
+    return search
+
+  def test_rank(self):
+    ranker = ClusterRanker()
+    c1 = ClusterStub(1, ["a", "b", "c", "d"])
+    c2 = ClusterStub(2, ["a", "b"])
+    c3 = ClusterStub(3, ["a", "e", "f", "g"])
+
+    ranked = ranker.rank([(c1, 2), (c2, 2), (c3, 1)])
+    self.assertTrue([c.id for (c, score) in ranked] == [2, 1, 3])
+    for (c, score) in ranked:
+      self.assertTrue(0 <= score and score <= 1)
+
+    self.assertTrue(ranker.rank([]) == [])
+
+  def test_rank_hit_rate(self):
+    ranker = ClusterRanker()
+    c1 = ClusterStub(1, ["a", "b"])
+    c2 = ClusterStub(2, ["c", "d"])
+
+    ranked = ranker.rank([(c1, 1), (c2, 1)])
+    self.assertTrue([c.id for (c, score) in ranked] == [1, 2])
+
+    for i in range(5):
+      ranker.record(1, False)
+      ranker.record(2, True)
+    ranked = ranker.rank([(c1, 1), (c2, 1)])
+    self.assertTrue([c.id for (c, score) in ranked] == [2, 1])
+
+  def test_max_clusters(self):
+    search = self._get_search()
+    search.search_from_groum("groum.acdfg.bin")
+    self.assertTrue(search.searched == [2, 1, 3])
+
+    search = self._get_search(max_clusters = 2)
+    search.search_from_groum("groum.acdfg.bin")
+    self.assertTrue(search.searched == [2, 1])
+
+    search = self._get_search(max_clusters = 2)
+    search.search_from_groum("groum.acdfg.bin", filter_cluster = {1, 3})
+    self.assertTrue(search.searched == [1, 3])
+
+  def test_min_score(self):
+    search = self._get_search(min_score = 0.55)
+    search.search_from_groum("groum.acdfg.bin")
+    self.assertTrue(search.searched == [2, 1])
+
+    # no results, the hit rate of the searched clusters goes down
+    search.search_from_groum("groum.acdfg.bin")
+    search.search_from_groum("groum.acdfg.bin")
+    search.searched = []
+    search.search_from_groum("groum.acdfg.bin")
+    self.assertTrue(search.searched == [2])
+
+  def test_concurrent_search(self):
+    def get_results(max_workers):
+      search = self._get_search(max_workers = max_workers)
+      def search_cluster(groum_path, cluster_info, filter_for_bugs,
+                         timeout = None):
+        # the first cluster is the slowest one
+        time.sleep(0.1 if cluster_info.id == 2 else 0)
+        if cluster_info.id == 3:
+          raise Exception("searchlattice crashed")
+        return {"search_results" : [{"popular" : {"frequency" : 1}}]}
+      search.search_cluster = search_cluster
+      return search.search_from_groum("groum.acdfg.bin")
+
+    results = get_results(1)
+    self.assertEqual([r["cluster_info"]["id"] for r in results], [2, 1])
+    self.assertEqual(get_results(3), results)
+
+  def test_budget(self):
+    search = self._get_search(max_workers = 1)
+    timeouts = []
+    def search_cluster(groum_path, cluster_info, filter_for_bugs,
+                       timeout = None):
+      timeouts.append(timeout)
+      # the first cluster uses all the budget
+      time.sleep(0.3 if cluster_info.id == 2 else 0)
+      return {"search_results" : [{"popular" : {"frequency" : 1}}]}
+    search.search_cluster = search_cluster
+
+    budget = SearchBudget(0.2)
+    results = search.search_from_groum("groum.acdfg.bin", budget = budget)
+    self.assertEqual([r["cluster_info"]["id"] for r in results], [2])
+    self.assertTrue(budget.is_partial())
+    self.assertEqual(budget.unsearched, [("groum.acdfg.bin", 1),
+                                         ("groum.acdfg.bin", 3)])
+    self.assertTrue(timeouts[0] <= 0.2)
+
+    budget = SearchBudget(10)
+    results = search.search_from_groum("groum.acdfg.bin", budget = budget)
+    self.assertEqual(len(results), 3)
+    self.assertFalse(budget.is_partial())
+
+    # only the searches stopped at the timeout are not searched
+    def search_cluster_timeout(groum_path, cluster_info, filter_for_bugs,
+                               timeout = None):
+      return SEARCH_TIMEOUT if cluster_info.id == 2 else None
+    search.search_cluster = search_cluster_timeout
+    budget = SearchBudget(10)
+    results = search.search_from_groum("groum.acdfg.bin", budget = budget)
+    self.assertEqual(results, [])
+    self.assertEqual(budget.unsearched, [("groum.acdfg.bin", 2)])
+
+  def test_iter_search(self):
+    search = self._get_search(max_workers = 3)
+    def search_cluster(groum_path, cluster_info, filter_for_bugs,
+                       timeout = None):
+      # the best ranked cluster is the slowest one
+      time.sleep(0.3 if cluster_info.id == 2 else 0)
+      if cluster_info.id == 3:
+        return None
+      return {"search_results" : [{"popular" : {"frequency" : 1}}]}
+    search.search_cluster = search_cluster
+
+    results = search.iter_search_from_groum("groum.acdfg.bin")
+    self.assertEqual(next(results)["cluster_info"]["id"], 1)
+    self.assertEqual([r["cluster_info"]["id"] for r in results], [2])
@@ -0,0 +1,139 @@
+""" Test the backends running searchlattice
+
+"""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+try:
+  import unittest2 as unittest
+except ImportError:
+  import unittest
+
+import fixrsearch
+from fixrsearch.search_backend import (
+  ProcessSearchBackend,
+  PooledSearchBackend,
+  RecordingSearchBackend,
+  CachedSearchBackend,
+  get_replay_file,
+  OUTPUT_MODES,
+  SEARCH_TIMEOUT
+)
+
+class TestSearchBackend(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.replay_dir = os.path.join(self.tmp_dir, "replay")
+    os.makedirs(self.replay_dir)
+
+    self.groum_path = os.path.join(self.tmp_dir, "groum.acdfg.bin")
+    self.lattice_path = os.path.join(self.tmp_dir, "lattice.bin")
+    for (path, data) in [(self.groum_path, b"groum"),
+                         (self.lattice_path, b"lattice")]:
+      with open(path, "wb") as f:
+        f.write(data)
+    self.results = b"\x0a\x00recorded\x00results"
+    with open(get_replay_file(self.replay_dir, self.groum_path,
+                              self.lattice_path), "wb") as f:
+      f.write(self.results)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _get_worker_args(self, *args):
+    root_path = os.path.dirname(os.path.dirname(fixrsearch.__file__))
+    code = ("import sys; sys.path.insert(0, %r); " \
+            "from fixrsearch.search_worker import main; main()" % root_path)
+    return [sys.executable, "-c", code, self.replay_dir] + list(args)
+
+  def test_pooled(self):
+    backend = PooledSearchBackend(self._get_worker_args(), 2)
+    try:
+      for i in range(3):
+        res = backend.search(self.groum_path, self.lattice_path, 10)
+        self.assertEqual(self.results, res)
+
+      # no results recorded
+      res = backend.search(self.groum_path, self.groum_path, 10)
+      self.assertIsNone(res)
+
+      # the worker is restarted
+      worker = backend._idle.get()
+      worker.kill()
+      worker.wait()
+      backend._idle.put(worker)
+      for i in range(2):
+        res = backend.search(self.groum_path, self.lattice_path, 10)
+        self.assertEqual(self.results, res)
+    finally:
+      backend.close()
+
+  def test_pooled_timeout(self):
+    backend = PooledSearchBackend(self._get_worker_args("-d", "5"), 1)
+    try:
+      res = backend.search(self.groum_path, self.lattice_path, 0.5)
+      self.assertTrue(res is SEARCH_TIMEOUT)
+      # the killed worker is not reused
+      worker = backend._idle.get()
+      backend._idle.put(worker)
+      self.assertIsNone(worker)
+    finally:
+      backend.close()
+
+  def test_process(self):
+    # fake searchlattice writing the results in the -o file
+    search_lattice_path = os.path.join(self.tmp_dir, "searchlattice")
+    with open(search_lattice_path, "w") as f:
+      f.write("#!%s\n" \
+              "import sys\n" \
+              "with open(sys.argv[sys.argv.index('-o') + 1], 'wb') as f:\n" \
+              "  f.write(b'results')\n" % sys.executable)
+    os.chmod(search_lattice_path, stat.S_IRWXU)
+
+    for output_mode in OUTPUT_MODES:
+      backend = ProcessSearchBackend(search_lattice_path, output_mode)
+      try:
+        for i in range(2):
+          res = backend.search(self.groum_path, self.lattice_path, 10)
+          self.assertEqual(b"results", res)
+      finally:
+        backend.close()
+
+    replay_dir = os.path.join(self.tmp_dir, "recorded")
+    os.makedirs(replay_dir)
+    backend = RecordingSearchBackend(ProcessSearchBackend(search_lattice_path),
+                                     replay_dir)
+    res = backend.search(self.groum_path, self.lattice_path, 10)
+    self.assertEqual(b"results", res)
+    with open(get_replay_file(replay_dir, self.groum_path,
+                              self.lattice_path), "rb") as f:
+      self.assertEqual(b"results", f.read())
+
+  def test_cached(self):
+    cache_dir = os.path.join(self.tmp_dir, "cache")
+    backend = CachedSearchBackend(PooledSearchBackend(self._get_worker_args()),
+                                  cache_dir)
+    try:
+      res = backend.search(self.groum_path, self.lattice_path, 10)
+      self.assertEqual(self.results, res)
+      # no more recorded results, the result comes from the cache
+      shutil.rmtree(self.replay_dir)
+      os.makedirs(self.replay_dir)
+      res = backend.search(self.groum_path, self.lattice_path, 10)
+      self.assertEqual(self.results, res)
+
+      # a different groum content is a different search
+      with open(self.groum_path, "wb") as f:
+        f.write(b"other groum")
+      res = backend.search(self.groum_path, self.lattice_path, 10)
+      self.assertIsNone(res)
+
+      stats = backend.get_stats()
+      self.assertEqual(1, stats["hits"])
+      self.assertEqual(2, stats["misses"])
+    finally:
+      backend.close()
@@ -28,6 +28,7 @@ from fixrsearch.utils import (
 )
 from fixrsearch.index import IndexNode, ClusterIndex
 from fixrsearch.search_service import create_app, get_new_db, DB_CONFIG
+from fixrsearch.search_service import CLUSTER_INDEX
 from fixrsearch.anomaly import Anomaly 
 
 import fixrsearch.test
@@ -152,6 +153,43 @@ class TestServices(unittest.TestCase):
 
     self.assertTrue(found)
 
+  def test_get_apps_pages(self):
+    all_apps = json.loads(self.test_client.get('/get_apps').get_data(as_text=True))
+
+    apps = []
+    cursor = None
+    while True:
+      url = '/get_apps?limit=2'
+      if not cursor is None:
+        url = url + '&cursor=' + cursor
+      json_data = json.loads(self.test_client.get(url).get_data(as_text=True))
+      self.assertTrue(len(json_data["apps"]) <= 2)
+      apps += json_data["apps"]
+      cursor = json_data["next_cursor"]
+      if cursor is None:
+        break
+    self.assertEqual(apps, all_apps)
+
+    # stream the apps
+    response = self.test_client.get('/get_apps?stream=true')
+    lines = response.get_data(as_text=True).splitlines()
+    self.assertEqual([json.loads(l) for l in lines], all_apps)
+
+    response = self.test_client.get('/get_apps?limit=-1')
+    self.assertTrue(response.status_code == 400)
+
+  def test_update_clusters(self):
+    old_index = self.app.config[CLUSTER_INDEX]
+    response = self.test_client.post('/update_clusters',
+                                     data=json.dumps({}),
+                                     content_type='application/json')
+    json_data = json.loads(response.get_data(as_text=True))
+
+    # the clusters file did not change
+    self.assertTrue(json_data["status"] == 0)
+    self.assertTrue(json_data["added"] == [])
+    self.assertTrue(json_data["removed"] == [])
+    self.assertFalse(self.app.config[CLUSTER_INDEX] is old_index)
 
   def test_get_groums(self):
     data = {"app_key" : u'nadafigment/samples/5aaee46bb69a1e20ed8a7c97c1a8323dba76cf17'}
@@ -0,0 +1,36 @@
+""" Test the table of the method names
+
+"""
+
+try:
+  import unittest2 as unittest
+except ImportError:
+  import unittest
+
+from fixrsearch.symbols import SymbolTable, get_method_symbols
+
+class TestSymbols(unittest.TestCase):
+
+  def test_intern(self):
+    symbols = SymbolTable(["a", "b"])
+    self.assertTrue(len(symbols) == 2)
+    self.assertTrue(symbols.intern("a") == 0)
+    self.assertTrue(symbols.intern("c") == 2)
+    self.assertTrue(symbols.get_id("d") is None)
+    self.assertFalse("d" in symbols)
+    self.assertTrue(symbols.get_name(1) == "b")
+
+    name = "".join(["c"])
+    self.assertTrue(symbols.canonical(name) is symbols.get_name(2))
+
+  def test_remap(self):
+    symbols = SymbolTable(["a", "b", "c"])
+    names = symbols.get_names([2, 0])
+    self.assertTrue(names == ["c", "a"])
+
+    other = SymbolTable(["x", "a"])
+    remap = other.get_remap(names)
+    self.assertTrue(list(remap) == [2, 1])
+    self.assertTrue(other.get_names(remap) == names)
+
+    self.assertTrue(get_method_symbols() is get_method_symbols())